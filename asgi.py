@@ -0,0 +1,13 @@
+"""
+Asynchronous Server Gateway Interface (ASGI) entry point
+"""
+import os
+import uvicorn
+from service.async_app import create_async_app
+
+PORT = int(os.getenv("PORT", "8000"))
+
+app = create_async_app()
+
+if __name__ == "__main__":
+    uvicorn.run(app, host='0.0.0.0', port=PORT)
@@ -0,0 +1,66 @@
+"""
+Package: benchmarks
+Performance benchmarks for the Product service
+
+The benchmarks build the real application with create_app() against the
+database given on the command line, so point them at a scratch database:
+the product table is dropped and seeded again on every run.
+"""
+import os
+import time
+from statistics import median
+
+from sqlalchemy import text
+
+DEFAULT_DATABASE_URI = "sqlite:///benchmark.db"
+
+
+def create_benchmark_app(database_uri: str):
+    """Creates the Flask app against a benchmark database with a fresh product table"""
+    # config.py reads the environment when it is first imported
+    os.environ["DATABASE_URI"] = database_uri
+    # pylint: disable=import-outside-toplevel
+    from service import create_app
+    from service.models import db
+
+    app = create_app()
+    app.app_context().push()
+    db.drop_all()
+    db.create_all()
+    return app
+
+
+def seed_products(count: int):
+    """Inserts count synthetic Products with a single INSERT ... SELECT
+
+    The rows are generated by a recursive CTE so that seeding a million
+    Products takes seconds on both PostgreSQL and SQLite.
+    """
+    # pylint: disable=import-outside-toplevel
+    from service.models import db
+
+    db.session.execute(
+        text(
+            "WITH RECURSIVE seq(g) AS (SELECT 1 UNION ALL SELECT g + 1 FROM seq WHERE g < :count) "
+            "INSERT INTO product (name, description, price, available) "
+            "SELECT 'product-' || g, "
+            "CASE g % 5 WHEN 0 THEN 'red fruit ' WHEN 1 THEN 'green vegetable ' "
+            "WHEN 2 THEN 'fresh bread ' WHEN 3 THEN 'aged cheese ' ELSE 'sparkling water ' END "
+            "|| 'batch ' || g, "
+            "(g % 10000) / 100.0, "
+            "g % 2 = 0 "
+            "FROM seq"
+        ),
+        {"count": count},
+    )
+    db.session.commit()
+
+
+def time_call(func, repeat: int = 5) -> float:
+    """Returns the median wall time of func() in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return median(timings)
@@ -0,0 +1,95 @@
+"""
+HTTP load helpers shared by the benchmarks
+
+Starts the service in a server subprocess and sends it requests from many
+concurrent clients while timing every one of them.
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from statistics import quantiles
+
+import httpx
+
+SERVERS = {
+    "wsgi": [sys.executable, "-m", "gunicorn", "--bind", "127.0.0.1:{port}", "--workers", "{workers}", "wsgi:app"],
+    "asgi": [sys.executable, "-m", "uvicorn", "--host", "127.0.0.1", "--port", "{port}", "--workers", "{workers}", "asgi:app"],
+}
+
+
+@contextmanager
+def serve(name: str, port: int, workers: int, database_uri: str, **env):
+    """Runs one of the SERVERS until the block ends and yields its URL
+
+    Args:
+        name (str): "wsgi" for gunicorn sync workers or "asgi" for uvicorn
+        port (int): the local port to listen on
+        workers (int): the number of worker processes
+        database_uri (str): the database that the server uses
+        env: more environment variables for the server
+    """
+    command = [part.format(port=port, workers=workers) for part in SERVERS[name]]
+    env = dict(os.environ, DATABASE_URI=database_uri, CHANGE_BROKER="memory", **env)
+    with subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as server:
+        url = f"http://127.0.0.1:{port}"
+        try:
+            wait_until_healthy(url)
+            yield url
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def wait_until_healthy(url: str, timeout: float = 30.0):
+    """Waits for the /health endpoint of a server to answer"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if httpx.get(f"{url}/health").status_code == 200:
+                return
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise
+        time.sleep(0.2)
+
+
+async def drive(url: str, requests: list, concurrency: int) -> dict:
+    """Sends requests, concurrency at a time, and summarizes their latency
+
+    Args:
+        url (str): the base URL of the server
+        requests (list): (method, path, json body or None) for every request
+        concurrency (int): the number of requests in flight at any time
+
+    Returns:
+        dict: the number of requests and errors, the requests per second and
+            the p50, p95 and p99 latency in milliseconds
+    """
+    latencies, errors = [], 0
+    queue = iter(requests)
+
+    async def worker(client):
+        nonlocal errors
+        for method, path, body in queue:
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            latencies.append((time.perf_counter() - start) * 1000)
+            errors += response.status_code >= 400
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60.0) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    cuts = quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(cuts[49], 3),
+        "p95_ms": round(cuts[94], 3),
+        "p99_ms": round(cuts[98], 3),
+    }
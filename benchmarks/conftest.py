@@ -0,0 +1,52 @@
+"""
+Fixtures of the model microbenchmarks
+
+The microbenchmarks are a pytest-benchmark suite outside of the unit tests,
+run them with ``make benchmark``. Finders are measured against a product
+table of every size given with --rows, so the same test shows how its cost
+grows with the table.
+"""
+import pytest
+from sqlalchemy import text
+
+from benchmarks import DEFAULT_DATABASE_URI, create_benchmark_app, seed_products
+
+DEFAULT_ROWS = "1000,100000,1000000"
+
+
+def pytest_addoption(parser):
+    """Adds the table sizes and the scratch database to the command line"""
+    group = parser.getgroup("product benchmarks")
+    group.addoption(
+        "--rows", default=DEFAULT_ROWS, help=f"comma separated product table sizes (default: {DEFAULT_ROWS})"
+    )
+    group.addoption(
+        "--database-uri", default=DEFAULT_DATABASE_URI, help="scratch database whose product table is dropped"
+    )
+
+
+def pytest_generate_tests(metafunc):
+    """Runs every benchmark that uses the rows fixture once per table size"""
+    if "rows" in metafunc.fixturenames:
+        sizes = [int(size) for size in metafunc.config.getoption("rows").split(",")]
+        metafunc.parametrize("rows", sizes, indirect=True, scope="session", ids=lambda size: f"{size}rows")
+
+
+@pytest.fixture(scope="session")
+def app(pytestconfig):
+    """The Flask app with its context pushed, against the scratch database"""
+    return create_benchmark_app(pytestconfig.getoption("database_uri"))
+
+
+@pytest.fixture(scope="session")
+def rows(request, app):  # pylint: disable=redefined-outer-name, unused-argument
+    """Fills the product table with request.param Products and returns the count"""
+    # pylint: disable=import-outside-toplevel
+    from service.models import db
+
+    db.drop_all()
+    db.create_all()
+    seed_products(request.param)
+    db.session.execute(text("ANALYZE product"))
+    db.session.commit()
+    return request.param
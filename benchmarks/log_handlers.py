@@ -0,0 +1,95 @@
+"""
+Benchmark: the cost of logging on the request path
+
+Times GET /api/products/{id} while the service logs to a stream that takes
+--write-delay-us microseconds per write, like a stdout pipe that the log
+collector drains too slowly, and prints the time per request in
+microseconds as JSON for each way of logging:
+
+    direct_text     the handlers write text in the request thread
+    queue_json      requests queue records for a listener thread writing JSON
+    queue_sampled   the same, keeping the info lines of 1 in --sample-rate requests
+
+The first is the default, the others are LOG_QUEUE=true with LOG_FORMAT=json,
+and LOG_SAMPLE_RATES=*=N. drain_ms is how long the listener took to write
+out what was still queued after the last request.
+
+Usage:
+    python -m benchmarks.log_handlers --requests 2000 --write-delay-us 50
+"""
+import argparse
+import json
+import logging
+import time
+
+from benchmarks import DEFAULT_DATABASE_URI, create_benchmark_app, seed_products, time_call
+
+SINK = "benchmarks.log_sink"
+
+
+class SlowStream:
+    """A stream that takes a while to write, and throws away what it is given"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.writes = 0
+
+    def write(self, _text: str):
+        """Waits as long as a blocked pipe would"""
+        self.writes += 1
+        time.sleep(self.delay)
+
+    def flush(self):
+        """Nothing to flush"""
+
+
+def main():
+    """Runs the benchmark and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-uri", default=DEFAULT_DATABASE_URI)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--write-delay-us", type=float, default=50.0)
+    parser.add_argument("--sample-rate", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_benchmark_app(args.database_uri)
+    seed_products(100)
+    # pylint: disable=import-outside-toplevel
+    from service.common import log_handlers
+
+    stream = SlowStream(args.write_delay_us / 1_000_000)
+    sink = logging.getLogger(SINK)
+    sink.setLevel(logging.INFO)
+    sink.handlers = [logging.StreamHandler(stream)]
+    modes = {
+        "direct_text": {"LOG_QUEUE": False, "LOG_FORMAT": "text", "LOG_SAMPLE_RATES": {}},
+        "queue_json": {"LOG_QUEUE": True, "LOG_FORMAT": "json", "LOG_SAMPLE_RATES": {}},
+        "queue_sampled": {"LOG_QUEUE": True, "LOG_FORMAT": "json", "LOG_SAMPLE_RATES": {"*": args.sample_rate}},
+    }
+    client = app.test_client()
+
+    def get_products():
+        for product_id in range(args.requests):
+            client.get(f"/api/products/{product_id % 100 + 1}")
+
+    results = {}
+    for name, config in modes.items():
+        app.config.update(config)
+        log_handlers.init_logging(app, SINK)
+        stream.writes = 0
+        milliseconds = time_call(get_products, args.repeat)
+        start = time.perf_counter()
+        log_handlers.stop_listener(app)
+        results[name] = {
+            "per_request_us": round(milliseconds * 1000 / args.requests, 1),
+            "lines_per_request": round(stream.writes / (args.requests * args.repeat), 2),
+            "drain_ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+    for timings in results.values():
+        timings["speedup"] = round(results["direct_text"]["per_request_us"] / timings["per_request_us"], 1)
+    print(json.dumps({"write_delay_us": args.write_delay_us, "requests": args.requests, "modes": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
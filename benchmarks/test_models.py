@@ -0,0 +1,114 @@
+"""
+Microbenchmarks of the Product model
+
+Times serialize and deserialize, which run for every Product of every
+request, and the finders, which are run once per table size so that their
+growth with the table shows. Every finder runs in a new session, like in a
+request, so Products are never returned from the identity map.
+"""
+# pylint: disable=redefined-outer-name, unused-argument, import-outside-toplevel
+from decimal import Decimal
+
+import pytest
+
+PAGE_SIZE = 100
+DATA = {"name": "apple", "description": "red fruit", "price": "1.25", "available": True}
+
+
+@pytest.fixture
+def product_class(app):
+    """The Product model, imported once the app exists"""
+    from service.models import Product
+
+    return Product
+
+
+def uncached(func):
+    """Wraps func to run in a new database session, like a request"""
+    from service.models import db
+
+    def run():
+        try:
+            return func()
+        finally:
+            db.session.remove()
+
+    return run
+
+
+######################################################################
+#  S E R I A L I Z A T I O N
+######################################################################
+def test_serialize(benchmark, product_class):
+    """Serializes a Product with every field"""
+    product = product_class(id=1, version=1, **{**DATA, "price": Decimal(DATA["price"])})
+    assert benchmark(product.serialize)["price"] == "1.25"
+
+
+def test_serialize_fields(benchmark, product_class):
+    """Serializes a Product with some of its fields"""
+    product = product_class(id=1, version=1, **{**DATA, "price": Decimal(DATA["price"])})
+    assert benchmark(product.serialize, ["id", "name", "price"]) == {"id": 1, "name": "apple", "price": "1.25"}
+
+
+def test_deserialize(benchmark, product_class):
+    """Deserializes a valid Product"""
+    product = benchmark(lambda: product_class().deserialize(DATA))
+    assert product.price == Decimal("1.25")
+
+
+def test_deserialize_invalid(benchmark, product_class):
+    """Rejects a Product whose availability is not a boolean"""
+    from service.models import DataValidationError
+
+    def deserialize():
+        try:
+            product_class().deserialize({**DATA, "available": "yes"})
+        except DataValidationError as error:
+            return error
+        return None
+
+    assert benchmark(deserialize) is not None
+
+
+######################################################################
+#  F I N D E R S
+######################################################################
+def test_find(benchmark, product_class, rows):
+    """Finds a Product by id"""
+    assert benchmark(uncached(lambda: product_class.find(rows // 2))).id == rows // 2
+
+
+def test_find_by_name(benchmark, product_class, rows):
+    """Finds the Product with a name"""
+    found = benchmark(uncached(lambda: product_class.find_by_name(f"product-{rows // 2}").all()))
+    assert len(found) == 1
+
+
+def test_find_by_description(benchmark, product_class, rows):
+    """Finds a page of Products whose description contains a term"""
+    found = benchmark(uncached(lambda: product_class.find_by_description(f"batch {rows // 2}", limit=PAGE_SIZE)))
+    assert found
+
+
+def test_find_by_price(benchmark, product_class, rows):
+    """Finds every Product with a price"""
+    assert benchmark(uncached(lambda: product_class.find_by_price(Decimal("4.20"))))
+
+
+def test_find_by_availability(benchmark, product_class, rows):
+    """Finds a page of available Products deep into the table"""
+    after = rows - rows // 10
+    found = benchmark(uncached(lambda: product_class.find_by_availability(True, limit=PAGE_SIZE, after=after).all()))
+    assert found
+
+
+def test_all_page(benchmark, product_class, rows):
+    """Lists the first page of Products"""
+    assert len(benchmark(uncached(lambda: product_class.all(limit=PAGE_SIZE)))) == PAGE_SIZE
+
+
+def test_all(benchmark, product_class, rows):
+    """Lists every Product, a few rounds only since it loads the whole table"""
+    found = benchmark.pedantic(uncached(product_class.all), rounds=3, iterations=1)
+    assert len(found) == rows
@@ -0,0 +1,28 @@
+"""
+Gunicorn settings
+
+Gunicorn reads this file from the working directory. When
+PROMETHEUS_MULTIPROC_DIR is set, it empties that directory before the
+workers start, and drops the gauges of every worker that exits, so that
+/metrics only adds up the metrics of this run and of the live workers.
+"""
+import glob
+import os
+
+from prometheus_client import multiprocess
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+
+def on_starting(_server):
+    """Starts the metrics of every worker from scratch"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(PROMETHEUS_MULTIPROC_DIR, "*.db")):
+            os.remove(path)
+
+
+def child_exit(_server, worker):
+    """Forgets the live gauges of a worker that exited"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(worker.pid)
@@ -22,7 +22,13 @@ import sys
 from flask import Flask
 from flask_restx import Api
 from service import config
-from service.common import log_handlers
+from service.common import broker, log_handlers
+from service.common.compression import compression
+from service.common.metrics import metrics
+from service.common.pool_metrics import pool_metrics
+from service.common.profiler import profiler
+from service.common.replicas import replicas
+from service.common.timing import timing
 
 
 # Will be initialize when app is created
@@ -40,9 +46,16 @@ def create_app():
 
     # Initialize Plugins
     # pylint: disable=import-outside-toplevel
-    from service.models import db
+    from service.models import db, product_cache
 
+    compression.init_app(app)
+    metrics.init_app(app)
+    timing.init_app(app)
+    profiler.init_app(app)
+    pool_metrics.init_app(app)
     db.init_app(app)
+    product_cache.init_app(app)
+    replicas.init_app(app)
 
     ######################################################################
     # Configure Swagger before initializing it
@@ -65,6 +78,9 @@ def create_app():
         from service import routes, models  # noqa: F401 E402
         from service.common import error_handlers, cli_commands  # noqa: F401, E402
 
+        # Count what the connection pool does and how long checkouts wait
+        pool_metrics.watch(db.engine)
+
         try:
             db.create_all()
         except Exception as error:  # pylint: disable=broad-except
@@ -72,6 +88,9 @@ def create_app():
             # gunicorn requires exit code 4 to stop spawning workers when they die
             sys.exit(4)
 
+        # Evict cached Products whenever any worker changes them
+        broker.init_broker(app, models.evict_cached_products)
+
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
 
@@ -0,0 +1,521 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Async Product Store Service
+
+Serves the /api/products contract of service.routes from an ASGI application
+with async handlers and an async SQLAlchemy engine, so that a worker keeps
+many requests waiting on the database at the same time instead of one.
+
+Paths:
+------
+GET /health - Tells that the service is up
+GET /api/products - Returns the Products, with the filters, sort, fields,
+    pages and streaming of service.routes, or the Products with the ids= given
+POST /api/products:lookup - Returns the Products with the posted ids and the missing ids
+GET /api/products/{id} - Returns the Product with a given id number
+POST /api/products - creates a new Product record in the database
+PUT /api/products/{id} - updates a Product record in the database
+DELETE /api/products/{id} - deletes a Product record in the database
+PUT /api/products/{id}/purchase - purchases a Product
+
+Products are validated and serialized by the same Product model, and the
+statements are built by the same classmethods, as in the Flask service.
+Batch writes, the product cache and read replicas are only served by Flask.
+"""
+import json
+import logging
+from contextlib import asynccontextmanager
+from decimal import Decimal
+from flask_restx import inputs
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from starlette.applications import Starlette
+from starlette.datastructures import MutableHeaders
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from service import config
+from service.common import status
+from service.common.contract import (
+    FILTERS, JSON, MISSING_IDS_HEADER, NDJSON, PRODUCT_FIELDS, coded_etag, collection_etag, decode_cursor,
+    encode_cursor, etag_versions, column_fields, dumps, lookup_conflicts, lookup_fingerprint, mask_fields,
+    product_document, product_etag, strip_codings
+)
+from service.models import DataConflictError, DataValidationError, Product
+
+logger = logging.getLogger("flask.app")
+
+# SQLAlchemy drivers with asyncio support for each database
+ASYNC_DRIVERS = {"postgresql": "postgresql+psycopg", "sqlite": "sqlite+aiosqlite"}
+
+MASK_HEADER = "X-Fields"
+
+
+def split(value: str) -> list:
+    """Splits a comma separated query string argument"""
+    return value.split(",")
+
+
+# query string arguments of the Product listing and how to parse them
+LISTING_ARGS = {
+    "name": str,
+    "description": str,
+    "available": inputs.boolean,
+    "price": Decimal,
+    "price_min": Decimal,
+    "price_max": Decimal,
+    "search": str,
+    "ids": split,
+    "sort": split,
+    "fields": split,
+    "limit": inputs.int_range(1, config.PAGE_SIZE_MAX),
+    "cursor": decode_cursor,
+    "stream": inputs.boolean,
+}
+
+
+def async_database_uri(uri: str) -> str:
+    """Returns the database URI with the asyncio driver of its database"""
+    url = make_url(uri)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver:
+        url = url.set(drivername=driver)
+    return url.render_as_string(hide_password=False)
+
+
+######################################################################
+# GET HEALTH CHECK
+######################################################################
+async def health_check(_request):
+    """Let them know our heart is still beating"""
+    return JSONResponse({"status": 200, "message": "Healthy"}, status.HTTP_200_OK)
+
+
+######################################################################
+#  PATH: /api/products
+######################################################################
+async def list_products(request):
+    """Returns the Products that match the query string"""
+    logger.info("Request to list Products...")
+    args = listing_args(request)
+    if args["ids"] is not None:
+        return await list_by_ids(request, args)
+    filters = {name: args[name] for name in FILTERS if args[name] is not None}
+    names = selected_fields(request, args["fields"])
+    statement = Product.apply_filters(
+        select(Product),
+        filters,
+        request.app.state.dialect,
+        sort=args["sort"],
+        fields=column_fields(names),
+        limit=args["limit"],
+        after=args["cursor"],
+    )
+    mimetype = parse_accept_header(request.headers.get("accept"), MIMEAccept).best_match([JSON, NDJSON])
+    async with request.app.state.sessions() as session:
+        fingerprint = tuple((await session.execute(Product.fingerprint_statement(statement, request.app.state.dialect))).one())
+        etag = collection_etag(fingerprint, mimetype, request.url.query, names)
+        if parse_etags(request.headers.get("if-none-match")).contains_weak(etag):
+            return not_modified(etag)
+        if mimetype == NDJSON or args["stream"]:
+            body = stream_products(request, statement, names, mimetype)
+            headers = {"ETag": quote_etag(etag), "Vary": MASK_HEADER}
+            return StreamingResponse(body, status.HTTP_200_OK, headers, mimetype or JSON)
+        rows_statement, columns = Product.select_rows(statement, column_fields(names), args["sort"])
+        rows = [dict(zip(columns, row)) for row in await session.execute(rows_statement)]
+
+    logger.info("[%s] Products returned", len(rows))
+    headers = next_page_headers(request, rows, args)
+    headers.update({"ETag": quote_etag(etag), "Vary": MASK_HEADER})
+    body = dumps([product_document(row, names) for row in rows])
+    return Response(body, status.HTTP_200_OK, headers, JSON)
+
+
+async def list_by_ids(request, args: dict) -> Response:
+    """Lists the Products of the ids argument in its order, naming the missing ones in a header"""
+    conflicts = lookup_conflicts(args)
+    if conflicts:
+        raise DataValidationError(f"ids cannot be combined with {', '.join(conflicts)}")
+    documents, missing, fingerprint = await lookup_products(request, args["ids"], args["fields"])
+    etag = collection_etag(fingerprint, JSON, request.url.query, selected_fields(request, args["fields"]))
+    if parse_etags(request.headers.get("if-none-match")).contains_weak(etag):
+        return not_modified(etag)
+    headers = {"ETag": quote_etag(etag), "Vary": MASK_HEADER}
+    if missing:
+        headers[MISSING_IDS_HEADER] = ",".join(map(str, missing))
+    return Response(dumps(documents), status.HTTP_200_OK, headers, JSON)
+
+
+async def lookup(request):
+    """Finds the Products with the posted ids, and tells which ones do not exist"""
+    logger.info("Request to Look up Products")
+    data = await json_payload(request)
+    if not isinstance(data, dict) or not isinstance(data.get("ids"), list):
+        raise DataValidationError("Expected a JSON object with a list of ids")
+    if not isinstance(data.get("fields", []), list):
+        raise DataValidationError("Expected a list of fields")
+    documents, missing, _ = await lookup_products(request, data["ids"], data.get("fields"))
+    return Response(dumps({"products": documents, "missing": missing}), status.HTTP_200_OK, media_type=JSON)
+
+
+async def lookup_products(request, ids: list, product_fields: list = None) -> tuple:
+    """Finds Products by id with a single query
+
+    Returns:
+        tuple: the Product documents in the order of ids, the missing ids and
+            the fingerprint of the Products that were found
+    """
+    if len(ids) > config.PAGE_SIZE_MAX:
+        raise DataValidationError(f"Cannot look up more than {config.PAGE_SIZE_MAX} ids at once")
+    names = selected_fields(request, product_fields)
+    Product.parse_fields(column_fields(names))
+    ids = [Product.parse_id(product_id) for product_id in ids]
+    statement = Product.find_many_statement(list(dict.fromkeys(ids)), request.app.state.dialect)
+    async with request.app.state.sessions() as session:
+        found = {product.id: (product.serialize(), product.version) for product in await session.scalars(statement)}
+    found, missing = Product.in_order(ids, found)
+    logger.info("[%s] Products found, [%s] missing", len(found), len(missing))
+    documents = [product_document(product, names) for product, _ in found]
+    return documents, missing, lookup_fingerprint(found)
+
+
+async def create_product(request):
+    """Creates a Product from the posted JSON"""
+    logger.info("Request to Create a Product")
+    product = Product().deserialize(await json_payload(request))
+    async with request.app.state.sessions() as session:
+        session.add(product)
+        try:
+            await session.flush()
+            await publish_changes(session, [{"id": product.id, "op": "create", "version": product.version}])
+            await session.commit()
+        except IntegrityError as error:
+            logger.error("Error creating record: %s", product)
+            raise DataValidationError("Product with the same name already exists") from error
+    logger.info("Product with new id [%s] created!", product.id)
+    location_url = str(request.url_for("get_product", product_id=product.id))
+    body = product_document(product.serialize(), selected_fields(request))
+    return JSONResponse(body, status.HTTP_201_CREATED, {"Location": location_url})
+
+
+######################################################################
+#  PATH: /api/products/{id}
+######################################################################
+async def get_product(request):
+    """Returns a single Product"""
+    product_id = Product.parse_id(request.path_params["product_id"])
+    logger.info("Request to Retrieve a product with id [%s]", product_id)
+    async with request.app.state.sessions() as session:
+        product = await session.get(Product, product_id)
+    if not product:
+        abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+    names = selected_fields(request)
+    etag = product_etag(product.id, product.version, names)
+    if parse_etags(request.headers.get("if-none-match")).contains_weak(etag):
+        return not_modified(etag)
+    body = product_document(product.serialize(), names)
+    return JSONResponse(body, status.HTTP_200_OK, {"ETag": quote_etag(etag), "Vary": MASK_HEADER})
+
+
+async def update_product(request):
+    """Updates a Product from the posted JSON"""
+    product_id = Product.parse_id(request.path_params["product_id"])
+    logger.info("Request to Update a product with id [%s]", product_id)
+    data = await json_payload(request)
+    async with request.app.state.sessions() as session:
+        product = await session.get(Product, product_id)
+        if not product:
+            abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        check_if_match(request, product)
+        product.deserialize(data)
+        product.id = product_id
+        product.validate()
+        try:
+            if session.is_modified(product):
+                await session.flush()
+                await publish_changes(session, [{"id": product_id, "op": "update", "version": product.version}])
+            await session.commit()
+        except StaleDataError as error:
+            raise DataConflictError(f"Product with id [{product_id}] was changed by another request") from error
+        except SQLAlchemyError as error:
+            logger.error("Error updating record: %s", product_id)
+            raise DataValidationError(error) from error
+    logger.info("Product with ID: %d updated.", product_id)
+    headers = {"ETag": quote_etag(product_etag(product.id, product.version))}
+    return JSONResponse(product_document(product.serialize(), selected_fields(request)), status.HTTP_200_OK, headers)
+
+
+async def delete_product(request):
+    """Deletes a Product"""
+    product_id = Product.parse_id(request.path_params["product_id"])
+    logger.info("Request to Delete a product with id [%s]", product_id)
+    async with request.app.state.sessions() as session:
+        product = await session.get(Product, product_id)
+        if product:
+            await session.delete(product)
+            try:
+                await session.flush()
+            except StaleDataError as error:
+                raise DataConflictError(f"Product with id [{product_id}] was changed by another request") from error
+            await publish_changes(session, [{"id": product_id, "op": "delete", "version": product.version}])
+            await session.commit()
+    logger.info("Product with ID: %d delete complete.", product_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+######################################################################
+#  PATH: /api/products/{id}/purchase
+######################################################################
+async def purchase_product(request):
+    """Purchases a Product with a single UPDATE ... RETURNING"""
+    product_id = Product.parse_id(request.path_params["product_id"])
+    logger.info("Request to Purchase a Product")
+    versions = etag_versions(parse_etags(request.headers.get("if-match")), product_id)
+    async with request.app.state.sessions() as session:
+        result = await session.scalars(
+            Product.purchase_statement(product_id, versions), execution_options={"populate_existing": True}
+        )
+        product = result.one_or_none()
+        if not product:
+            # only a failed purchase reads the Product to tell why it failed
+            product = await session.get(Product, product_id)
+            if not product:
+                abort(status.HTTP_404_NOT_FOUND, f"Product with id [{product_id}] was not found.")
+            check_if_match(request, product)
+            abort(status.HTTP_409_CONFLICT, f"Product with id [{product_id}] is not available.")
+        await publish_changes(session, [{"id": product_id, "op": "update", "version": product.version}])
+        await session.commit()
+    logger.info("Product with id [%s] has been purchased!", product_id)
+    headers = {"ETag": quote_etag(product_etag(product.id, product.version))}
+    return JSONResponse(product_document(product.serialize(), selected_fields(request)), status.HTTP_200_OK, headers)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+
+def abort(error_code: int, message: str):
+    """Logs errors before aborting"""
+    logger.error(message)
+    raise HTTPException(error_code, message)
+
+
+def listing_args(request) -> dict:
+    """Parses the query string arguments of the Product listing"""
+    args = {}
+    for name, parse in LISTING_ARGS.items():
+        value = request.query_params.get(name)
+        try:
+            args[name] = None if value is None else parse(value)
+        except (ArithmeticError, ValueError) as error:
+            raise DataValidationError(f"Invalid value for [{name}]: {error}") from error
+    return args
+
+
+async def json_payload(request):
+    """Returns the JSON document posted with a request"""
+    if request.headers.get("content-type", "").split(";")[0].strip() != JSON:
+        abort(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            f"Did not attempt to load JSON data because the request Content-Type was not '{JSON}'.",
+        )
+    try:
+        return await request.json()
+    except ValueError as error:
+        raise DataValidationError(f"Invalid JSON: {error}") from error
+
+
+async def publish_changes(session, events: list):
+    """Announces written Products to the Flask workers so they evict their cached copies
+
+    Only PostgreSQL can reach the other workers, with a NOTIFY that is sent
+    when the transaction of session commits.
+    """
+    if config.CHANGE_BROKER == "postgres":
+        await session.execute(select(func.pg_notify(config.CHANGE_CHANNEL, json.dumps(events))))
+
+
+def selected_fields(request, product_fields: list = None) -> list:
+    """Returns the fields to marshal, from the fields argument or the field mask header"""
+    if product_fields:
+        return product_fields
+    mask = request.headers.get(MASK_HEADER)
+    return mask_fields(mask) if mask else PRODUCT_FIELDS
+
+
+def check_if_match(request, product: Product):
+    """Aborts with 412 when If-Match does not name the current version of the Product"""
+    versions = etag_versions(parse_etags(request.headers.get("if-match")), product.id)
+    if versions is not None and product.version not in versions:
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Product with id [{product.id}] does not match the ETag in If-Match.",
+        )
+
+
+def not_modified(etag: str) -> Response:
+    """Tells the client that its copy with this ETag is still current"""
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": quote_etag(etag), "Vary": MASK_HEADER})
+
+
+def next_page_headers(request, rows: list, args: dict) -> dict:
+    """Returns a Link header pointing at the next page of Products"""
+    if not args["limit"] or len(rows) < args["limit"]:
+        return {}
+    if args["search"] and not args["sort"]:
+        return {}
+    next_url = request.url.include_query_params(cursor=encode_cursor(Product.row_sort_key(rows[-1], args["sort"])))
+    return {"Link": f'<{next_url}>; rel="next"'}
+
+
+async def stream_products(request, statement, names: list, mimetype: str):
+    """Writes Products as NDJSON or as a JSON array while they are read"""
+    statement, columns = Product.select_rows(statement, column_fields(names))
+    separator = b"" if mimetype == NDJSON else b"["
+    async with request.app.state.sessions() as session:
+        result = await session.stream(statement, execution_options={"yield_per": config.STREAM_CHUNK_SIZE})
+        async for page in result.partitions():
+            lines = [dumps(product_document(dict(zip(columns, row)), names)) for row in page]
+            if mimetype == NDJSON:
+                yield b"".join(line + b"\n" for line in lines)
+            else:
+                yield separator + b",".join(lines)
+                separator = b","
+    if mimetype != NDJSON:
+        yield b"]" if separator == b"," else b"[]"
+
+
+async def data_validation_error(_request, error):
+    """Handles Value Errors from bad data"""
+    message = str(error)
+    logger.error(message)
+    return JSONResponse(
+        {"status_code": status.HTTP_400_BAD_REQUEST, "error": "Bad Request", "message": message},
+        status.HTTP_400_BAD_REQUEST,
+    )
+
+
+async def data_conflict_error(_request, error):
+    """Handles writes that lost the race against another request"""
+    message = str(error)
+    logger.warning(message)
+    return JSONResponse(
+        {"status_code": status.HTTP_409_CONFLICT, "error": "Conflict", "message": message},
+        status.HTTP_409_CONFLICT,
+    )
+
+
+async def http_error(_request, error):
+    """Returns aborted requests as JSON like flask-restx does"""
+    return JSONResponse({"message": error.detail}, error.status_code, error.headers)
+
+
+class CodedETags:  # pylint: disable=too-few-public-methods
+    """Ends the ETags of gzip bodies with their coding, like the Flask service does
+
+    GZipMiddleware keeps the ETag of the identity body on the compressed one,
+    so this middleware wraps it: it appends the coding to the ETag of every
+    compressed response, strips it from If-None-Match and If-Match before
+    the routes compare them, and answers a 304 with the ETag that the client
+    named.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = MutableHeaders(scope=scope)
+        sent = headers.get("if-none-match", "")
+        for name in ("if-none-match", "if-match"):
+            if name in headers:
+                headers[name] = strip_codings(headers[name])
+
+        async def send_coded(message):
+            if message["type"] == "http.response.start":
+                response = MutableHeaders(scope=message)
+                etag = response.get("etag")
+                coding = response.get("content-encoding")
+                if etag and message["status"] == status.HTTP_304_NOT_MODIFIED:
+                    coding = "gzip" if coded_etag(etag, "gzip") in sent else None
+                if etag and coding:
+                    response["etag"] = coded_etag(etag, coding)
+            await send(message)
+
+        await self.app(scope, receive, send_coded)
+
+
+######################################################################
+# Create the ASGI application
+######################################################################
+@asynccontextmanager
+async def lifespan(app):
+    """Opens the async engine when the server starts and disposes of it when it stops"""
+    options = dict(config.SQLALCHEMY_ENGINE_OPTIONS)
+    if "pool_size" in options:
+        # aiosqlite would not pool file databases, so the pool settings apply to every database
+        options["poolclass"] = AsyncAdaptedQueuePool
+    engine = create_async_engine(async_database_uri(config.DATABASE_URI), **options)
+    async with engine.begin() as connection:
+        await connection.run_sync(Product.metadata.create_all)
+    app.state.dialect = engine.dialect.name
+    # committed Products are serialized after the commit without reading them again
+    app.state.sessions = async_sessionmaker(engine, expire_on_commit=False)
+    logger.info("Async service initialized!")
+    yield
+    await engine.dispose()
+
+
+def create_async_app() -> Starlette:
+    """Creates the ASGI application"""
+    routes = [
+        Route("/health", health_check),
+        Route("/api/products", list_products, methods=["GET"]),
+        Route("/api/products", create_product, methods=["POST"]),
+        Route("/api/products:lookup", lookup, methods=["POST"]),
+        Route("/api/products/{product_id}", get_product, methods=["GET"], name="get_product"),
+        Route("/api/products/{product_id}", update_product, methods=["PUT"]),
+        Route("/api/products/{product_id}", delete_product, methods=["DELETE"]),
+        Route("/api/products/{product_id}/purchase", purchase_product, methods=["PUT"]),
+    ]
+    # Starlette only speaks gzip, which it also applies to streams chunk by chunk
+    middleware = [
+        Middleware(CodedETags),
+        Middleware(GZipMiddleware, minimum_size=config.COMPRESSION_MIN_SIZE, compresslevel=config.COMPRESSION_LEVEL),
+    ]
+    return Starlette(
+        routes=routes,
+        middleware=middleware,
+        lifespan=lifespan,
+        exception_handlers={
+            DataValidationError: data_validation_error,
+            DataConflictError: data_conflict_error,
+            HTTPException: http_error,
+        },
+    )
@@ -0,0 +1,146 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Change Broker
+
+This module announces committed Product changes to every worker so that
+they can evict their cached copies. Events are dicts with the "id" of the
+Product and the "op" that changed it. A "reset" op means that events may
+have been missed and everything should be evicted.
+
+The PostgreSQL broker sends events with NOTIFY inside the writing
+transaction, so they are delivered only if it commits, and runs a LISTEN
+thread in each worker. The in-memory broker delivers events to subscribers
+in the same process and stands in for it on SQLite and in tests.
+"""
+import json
+import logging
+import threading
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger("flask.app")
+
+# session.info key of the events waiting for the transaction to commit
+PENDING_EVENTS = "pending_product_events"
+
+# NOTIFY payloads must stay under 8000 bytes
+EVENTS_PER_NOTIFY = 100
+
+
+class InMemoryBroker:
+    """Delivers change events to the subscribers in this process"""
+
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """Calls callback with a list of events whenever changes are committed"""
+        self._subscribers.append(callback)
+
+    def deliver(self, events: list):
+        """Hands events to every subscriber"""
+        for callback in self._subscribers:
+            callback(events)
+
+    def publish(self, session, events: list):
+        """Holds events until the transaction of session commits"""
+        session.info.setdefault(PENDING_EVENTS, []).extend(events)
+
+    def committed(self, session):
+        """Delivers the events of a committed transaction"""
+        events = session.info.pop(PENDING_EVENTS, None)
+        if events:
+            self.deliver(events)
+
+    def rolled_back(self, session):
+        """Drops the events of a transaction that was rolled back"""
+        session.info.pop(PENDING_EVENTS, None)
+
+    def start(self):
+        """Starts receiving events from other workers (nothing to do in memory)"""
+
+    def stop(self):
+        """Stops receiving events from other workers (nothing to do in memory)"""
+
+
+class PostgresBroker(InMemoryBroker):
+    """Shares change events between workers with PostgreSQL LISTEN/NOTIFY"""
+
+    def __init__(self, database_uri: str, channel: str, reconnect_delay: float = 5.0):
+        super().__init__()
+        # psycopg wants a libpq URI without the SQLAlchemy driver name
+        url = make_url(database_uri).set(drivername="postgresql")
+        self.conninfo = url.render_as_string(hide_password=False)
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def publish(self, session, events: list):
+        """Sends events with NOTIFY in the transaction of session
+
+        Events are still delivered to this worker right after the commit,
+        so a worker always reads its own writes without waiting for LISTEN.
+        """
+        super().publish(session, events)
+        for start in range(0, len(events), EVENTS_PER_NOTIFY):
+            payload = json.dumps(events[start:start + EVENTS_PER_NOTIFY])
+            session.execute(select(func.pg_notify(self.channel, payload)))
+
+    def start(self):
+        """Starts the LISTEN thread of this worker"""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.listen, name="product-change-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the LISTEN thread of this worker"""
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+
+    def listen(self):
+        """Delivers the events of every worker until stop() is called"""
+        # pylint: disable=import-outside-toplevel
+        import psycopg
+        from psycopg import sql
+
+        while not self._stopping.is_set():
+            try:
+                with psycopg.connect(self.conninfo, autocommit=True) as connection:
+                    connection.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                    # anything could have changed while we were not listening
+                    self.deliver([{"id": None, "op": "reset"}])
+                    while not self._stopping.is_set():
+                        for notify in connection.notifies(timeout=1.0):
+                            self.deliver(json.loads(notify.payload))
+            except psycopg.Error as error:
+                logger.warning("Product change listener lost its connection: %s", error)
+                self._stopping.wait(self.reconnect_delay)
+
+
+def init_broker(app, subscriber) -> InMemoryBroker:
+    """Creates the change broker configured by CHANGE_BROKER and subscribes to it"""
+    if app.config["CHANGE_BROKER"] == "postgres":
+        broker = PostgresBroker(app.config["SQLALCHEMY_DATABASE_URI"], app.config["CHANGE_CHANNEL"])
+    else:
+        broker = InMemoryBroker()
+    broker.subscribe(subscriber)
+    broker.start()
+    app.extensions["change_broker"] = broker
+    return broker
@@ -16,8 +16,26 @@
 """
 Flask CLI Command Extensions
 """
+import csv
+import io
+import json
+import time
+from decimal import Decimal
+from itertools import chain, islice
+import click
+import psycopg
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from sqlalchemy import insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from service.models import Product, db
+
+# Columns of the product table in the order they are exported
+COLUMNS = ("id", "name", "description", "price", "available", "version")
+REQUIRED_COLUMNS = {"name", "description", "price"}
+FORMATS = ("csv", "ndjson")
+# Types of the columns for psycopg to parse COPY rows with
+COPY_TYPES = ("int4", "varchar", "varchar", "numeric", "bool", "int4")
+COPY_BLOCK_SIZE = 64 * 1024
 
 
 ######################################################################
@@ -34,3 +52,248 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Commands to copy the product table to and from files
+# Usage:
+#   flask products-export products.csv
+#   flask products-import products.ndjson
+######################################################################
+@app.cli.command("products-export")
+@click.argument("path", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--format", "file_format", type=click.Choice(FORMATS), help="Guessed from the file extension by default")
+@click.option("--chunk-size", type=int, help="Rows read per round trip [default: STREAM_CHUNK_SIZE]")
+def products_export(path, file_format, chunk_size):
+    """
+    Writes every Product to a CSV or NDJSON file, - for stdout.
+    PostgreSQL streams the table with COPY ... TO STDOUT.
+    """
+    file_format = file_format or guess_format(path)
+    progress = Progress("Exported")
+    with click.open_file(path, "wb") as stream:
+        if db.engine.dialect.name == "postgresql":
+            rows = copy_out(stream, file_format, chunk_size or app.config["STREAM_CHUNK_SIZE"], progress)
+        else:
+            rows = export_rows(stream, file_format, chunk_size or app.config["STREAM_CHUNK_SIZE"], progress)
+    progress.finish(rows)
+
+
+@app.cli.command("products-import")
+@click.argument("path", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--format", "file_format", type=click.Choice(FORMATS), help="Guessed from the file extension by default")
+@click.option("--chunk-size", type=int, help="Rows written per transaction [default: BATCH_CHUNK_SIZE]")
+def products_import(path, file_format, chunk_size):
+    """
+    Loads Products from a CSV or NDJSON file, - for stdin.
+    PostgreSQL streams the file with COPY ... FROM STDIN in one transaction.
+    """
+    file_format = file_format or guess_format(path)
+    progress = Progress("Imported")
+    try:
+        with click.open_file(path, "rb") as stream:
+            if db.engine.dialect.name == "postgresql":
+                rows = copy_in(stream, file_format, progress)
+            else:
+                rows = import_rows(stream, file_format, chunk_size or app.config["BATCH_CHUNK_SIZE"], progress)
+    except (ArithmeticError, ValueError, SQLAlchemyError, psycopg.Error) as error:
+        db.session.rollback()
+        raise click.ClickException(f"Import stopped after {progress.rows:,} rows: {error}") from error
+    progress.finish(rows)
+
+
+class Progress:
+    """Shows how many rows were copied so far and how fast on stderr"""
+
+    def __init__(self, action: str, interval: float = 0.5):
+        self.action = action
+        self.interval = interval
+        self.rows = 0
+        self.started = time.perf_counter()
+        self.shown = self.started
+
+    @property
+    def elapsed(self) -> float:
+        """Returns the seconds since the copy started"""
+        return time.perf_counter() - self.started
+
+    @property
+    def rate(self) -> float:
+        """Returns the rows copied per second"""
+        return self.rows / max(self.elapsed, 1e-9)
+
+    def update(self, rows: int):
+        """Counts copied rows and shows the progress at most once per interval"""
+        self.rows += rows
+        now = time.perf_counter()
+        if now - self.shown >= self.interval:
+            self.shown = now
+            click.echo(f"\r{self.action} {self.rows:,} rows ({self.rate:,.0f} rows/sec)", nl=False, err=True)
+
+    def finish(self, rows: int = None):
+        """Shows the total, which replaces the running count when it is given"""
+        if rows is not None:
+            self.rows = rows
+        click.echo(
+            f"\r{self.action} {self.rows:,} rows in {self.elapsed:.2f} seconds ({self.rate:,.0f} rows/sec)",
+            err=True,
+        )
+
+
+def guess_format(path: str) -> str:
+    """Returns ndjson for .ndjson and .jsonl files and csv for anything else"""
+    return "ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"
+
+
+def chunks(rows, size: int):
+    """Yields lists of up to size rows"""
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+######################################################################
+# Row conversions shared by every database
+######################################################################
+def dump_rows(rows, file_format: str) -> bytes:
+    """Encodes rows of column values as CSV or NDJSON lines"""
+    if file_format == "ndjson":
+        lines = [
+            json.dumps({**dict(zip(COLUMNS, row)), "price": str(row[3])}) + "\n"
+            for row in rows
+        ]
+        return "".join(lines).encode()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    # same booleans as a PostgreSQL COPY, so the files can be loaded by either
+    writer.writerows([*row[:4], "t" if row[4] else "f", row[5]] for row in rows)
+    return buffer.getvalue().encode()
+
+
+def read_rows(stream, file_format: str):
+    """Yields a dictionary of column values for every line of a CSV or NDJSON file"""
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    try:
+        if file_format == "ndjson":
+            documents = (json.loads(line) for line in text if line.strip())
+        else:
+            documents = csv.DictReader(text)
+        for document in documents:
+            yield load_row(document)
+    finally:
+        text.detach()
+
+
+def load_row(document: dict) -> dict:
+    """Converts the fields of an exported Product into column values"""
+    check_columns(document)
+    row = {"name": document["name"], "description": document["description"], "price": Decimal(document["price"])}
+    for name in ("id", "version"):
+        if document.get(name) not in (None, ""):
+            row[name] = int(document[name])
+    if "available" in document:
+        available = document["available"]
+        row["available"] = available if isinstance(available, bool) else str(available).lower() in ("t", "true", "1")
+    return {name: row[name] for name in COLUMNS if name in row}
+
+
+def check_columns(columns):
+    """Fails the command when columns are unknown or required ones are missing"""
+    unknown = set(columns) - set(COLUMNS)
+    missing = REQUIRED_COLUMNS - set(columns)
+    if unknown or missing:
+        raise click.ClickException(f"Unknown columns {sorted(unknown)} or missing columns {sorted(missing)}")
+
+
+######################################################################
+# Chunked copies through SQLAlchemy for any database
+######################################################################
+def export_rows(stream, file_format: str, chunk_size: int, progress: Progress) -> int:
+    """Writes the product table chunk_size rows at a time"""
+    table = Product.__table__
+    if file_format == "csv":
+        stream.write((",".join(COLUMNS) + "\n").encode())
+    statement = select(*[table.c[name] for name in COLUMNS]).order_by(table.c.id)
+    result = db.session.execute(statement, execution_options={"yield_per": chunk_size})
+    for rows in result.partitions():
+        stream.write(dump_rows(rows, file_format))
+        progress.update(len(rows))
+    return progress.rows
+
+
+def import_rows(stream, file_format: str, chunk_size: int, progress: Progress) -> int:
+    """Inserts rows with one executemany INSERT and one commit per chunk"""
+    table = Product.__table__
+    for chunk in chunks(read_rows(stream, file_format), chunk_size):
+        # executemany needs the same columns in every row of the chunk
+        for columns in {tuple(sorted(row)) for row in chunk}:
+            db.session.execute(insert(table), [row for row in chunk if tuple(sorted(row)) == columns])
+        db.session.commit()
+        progress.update(len(chunk))
+    return progress.rows
+
+
+######################################################################
+# COPY through psycopg for PostgreSQL
+######################################################################
+def copy_out(stream, file_format: str, chunk_size: int, progress: Progress) -> int:
+    """Streams the product table with COPY ... TO STDOUT"""
+    connection = db.engine.raw_connection()
+    try:
+        with connection.driver_connection.cursor() as cursor:
+            if file_format == "csv":
+                statement = f"COPY (SELECT {', '.join(COLUMNS)} FROM product ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER)"
+                with cursor.copy(statement) as copy:
+                    # the blocks are written as they are, so progress counts lines
+                    for block in copy:
+                        stream.write(block)
+                        progress.update(bytes(block).count(b"\n"))
+            else:
+                statement = f"COPY (SELECT {', '.join(COLUMNS)} FROM product ORDER BY id) TO STDOUT"
+                with cursor.copy(statement) as copy:
+                    copy.set_types(COPY_TYPES)
+                    for rows in chunks(copy.rows(), chunk_size):
+                        stream.write(dump_rows(rows, file_format))
+                        progress.update(len(rows))
+            return cursor.rowcount
+    finally:
+        connection.close()
+
+
+def copy_in(stream, file_format: str, progress: Progress) -> int:
+    """Streams a file into the product table with COPY ... FROM STDIN"""
+    connection = db.engine.raw_connection()
+    try:
+        with connection.driver_connection.cursor() as cursor:
+            if file_format == "csv":
+                columns = next(csv.reader([stream.readline().decode("utf-8")]))
+                check_columns(columns)
+                statement = f"COPY product ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+                with cursor.copy(statement) as copy:
+                    while block := stream.read(COPY_BLOCK_SIZE):
+                        copy.write(block)
+                        progress.update(block.count(b"\n"))
+            else:
+                rows = read_rows(stream, file_format)
+                first = next(rows, None)
+                if first is None:
+                    return 0
+                # the columns of the first Product are copied for all of them
+                columns = list(first)
+                statement = f"COPY product ({', '.join(columns)}) FROM STDIN"
+                with cursor.copy(statement) as copy:
+                    for row in chain([first], rows):
+                        if set(row) != set(columns):
+                            raise click.ClickException(
+                                f"Product {progress.rows + 1:,} has columns {sorted(row)} instead of {sorted(columns)}"
+                            )
+                        copy.write_row([row[name] for name in columns])
+                        progress.update(1)
+            rows = cursor.rowcount
+            if "id" in columns:
+                # rows copied with their ids do not advance the id sequence
+                cursor.execute("SELECT setval(pg_get_serial_sequence('product', 'id'), max(id)) FROM product")
+        connection.commit()
+        return rows
+    finally:
+        connection.close()
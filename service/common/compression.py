@@ -0,0 +1,304 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Response Compression
+
+This module compresses responses with brotli or gzip, whichever the
+Accept-Encoding header of the client prefers. Responses smaller than
+COMPRESSION_MIN_SIZE are sent as they are, and streamed responses are
+compressed chunk by chunk, flushing after each one so that the client
+still receives every chunk as soon as it is written.
+
+Static files are compressed ahead of time instead, by running this module
+at build time, and served with long cache headers when their URL carries
+the version of their content.
+
+Usage:
+    python -m service.common.compression service/static
+"""
+import argparse
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import zlib
+from functools import lru_cache
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+from service.common.contract import CODING_SUFFIX
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Media types that are worth compressing, images and fonts already are
+COMPRESSIBLE = {
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "text/javascript",
+    "text/css",
+    "text/html",
+    "text/plain",
+    "image/svg+xml",
+}
+# File name suffixes of the precompressed copies of static files
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+# Links to static files in a page, like src="static/js/rest_api.js"
+STATIC_LINK = re.compile(r'(href|src)\s*=\s*"static/([^"?#]+)"')
+
+
+class GzipStream:
+    """Compresses a stream of chunks with gzip"""
+
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk and flushes it to a byte boundary"""
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        """Ends the stream"""
+        return self._compressor.flush()
+
+
+class BrotliStream:
+    """Compresses a stream of chunks with brotli"""
+
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk and flushes it"""
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        """Ends the stream"""
+        return self._compressor.finish()
+
+
+class Compression:
+    """Compresses responses and serves precompressed static files"""
+
+    def __init__(self):
+        self.min_size = 1024
+        self.level = 6
+        self.brotli_quality = 4
+        self.static_max_age = 365 * 24 * 3600
+        self.static_folder = None
+
+    def init_app(self, app):
+        """Compresses the responses of app and serves its static files
+
+        Call it before the other extensions so that it compresses the
+        responses last, after their after_request hooks changed them.
+        """
+        self.min_size = app.config["COMPRESSION_MIN_SIZE"]
+        self.level = app.config["COMPRESSION_LEVEL"]
+        self.brotli_quality = app.config["COMPRESSION_BROTLI_QUALITY"]
+        self.static_max_age = app.config["STATIC_MAX_AGE"]
+        self.static_folder = app.static_folder
+        app.before_request(self.strip_codings)
+        app.after_request(self.compress_response)
+        app.view_functions["static"] = self.send_static
+
+    @staticmethod
+    def encodings() -> list:
+        """Returns the content codings that can be sent, best first"""
+        return ["br", "gzip"] if brotli else ["gzip"]
+
+    def negotiate(self) -> str:
+        """Returns the content coding that the client prefers, or None"""
+        return request.accept_encodings.best_match(self.encodings())
+
+    def stream(self, encoding: str):
+        """Returns a compressor for a content coding"""
+        if encoding == "br":
+            return BrotliStream(self.brotli_quality)
+        return GzipStream(self.level)
+
+    ##################################################
+    # Dynamic responses
+    ##################################################
+
+    @staticmethod
+    def strip_codings():
+        """Strips the content codings off the ETags of conditional requests
+
+        A compressed body is other bytes than the identity one, so its strong
+        ETag ends with its coding, like "7-3-gzip". The routes compare
+        If-None-Match and If-Match with the ETag of the identity body, so
+        they are given "7-3" instead.
+        """
+        for header in ("HTTP_IF_NONE_MATCH", "HTTP_IF_MATCH"):
+            value = request.environ.get(header)
+            if value and CODING_SUFFIX.search(value):
+                request.environ[f"compression.{header}"] = value
+                request.environ[header] = CODING_SUFFIX.sub('"', value)
+
+    @staticmethod
+    def tag_coding(response, encoding: str):
+        """Appends a content coding to the ETag of a response"""
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+
+    def compress_response(self, response):
+        """Compresses a response when the client accepts it and it is big enough
+
+        Files are left alone, they are either precompressed or not worth it.
+        The ETag of a compressed body ends with its coding, and a 304 answers
+        with the ETag of the copy that the client named in If-None-Match.
+        """
+        if response.status_code == 304:
+            sent = request.environ.get("compression.HTTP_IF_NONE_MATCH", "")
+            encoding = next((coding for coding in self.encodings() if f'{response.get_etag()[0]}-{coding}"' in sent), None)
+            if encoding:
+                self.tag_coding(response, encoding)
+            return response
+        if response.mimetype not in COMPRESSIBLE or response.direct_passthrough:
+            return response
+        response.vary.add("Accept-Encoding")
+        if response.status_code < 200 or response.status_code in (204, 304) or "Content-Encoding" in response.headers:
+            return response
+        encoding = self.negotiate()
+        if not encoding:
+            return response
+        if response.is_streamed:
+            response.response = self.compress_chunks(response.response, self.stream(encoding))
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compressor = self.stream(encoding)
+            response.set_data(compressor.compress(data) + compressor.finish())
+        response.headers["Content-Encoding"] = encoding
+        self.tag_coding(response, encoding)
+        return response
+
+    @staticmethod
+    def compress_chunks(chunks, compressor):
+        """Compresses the chunks of a streamed response as they are written"""
+        try:
+            for chunk in chunks:
+                data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+                if data:
+                    yield data
+            yield compressor.finish()
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    ##################################################
+    # Static files
+    ##################################################
+
+    def send_static(self, filename: str):
+        """Sends a static file, or its precompressed copy when the client accepts it
+
+        Files requested with the ?v= version from static_page() can be cached
+        for STATIC_MAX_AGE, since a new version of the file gets a new URL.
+        """
+        encoding = self.negotiate()
+        path = safe_join(self.static_folder, filename + SUFFIXES[encoding]) if encoding else None
+        if path and os.path.isfile(path):
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            response = send_from_directory(self.static_folder, filename + SUFFIXES[encoding], mimetype=mimetype)
+            response.headers["Content-Encoding"] = encoding
+        else:
+            response = send_from_directory(self.static_folder, filename)
+        response.vary.add("Accept-Encoding")
+        if request.args.get("v"):
+            response.cache_control.public = True
+            response.cache_control.max_age = self.static_max_age
+            response.cache_control.immutable = True
+        return response
+
+    def static_page(self, filename: str) -> str:
+        """Returns a static page whose links to static files carry their versions"""
+        with open(os.path.join(self.static_folder, filename), encoding="utf-8") as file:
+            page = file.read()
+        return STATIC_LINK.sub(
+            lambda link: f'{link[1]}="static/{link[2]}?v={self.version(link[2])}"', page
+        )
+
+    def version(self, filename: str) -> str:
+        """Returns a short hash of the content of a static file"""
+        path = safe_join(self.static_folder, filename)
+        if not path or not os.path.isfile(path):
+            return "0"
+        return file_version(path, os.stat(path).st_mtime_ns)
+
+
+@lru_cache(maxsize=256)
+def file_version(path: str, _modified: int) -> str:
+    """Returns a short hash of a file, cached until it is modified"""
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()[:12]
+
+
+# The compression of the Flask app
+compression = Compression()
+
+
+######################################################################
+# Build step: precompress the static files
+######################################################################
+def precompress(directory: str, min_size: int = 1024) -> list:
+    """Writes .gz and, when brotli is installed, .br copies of static files
+
+    Only files of COMPRESSIBLE media types of at least min_size bytes are
+    compressed, at the best and slowest levels since it happens only once.
+
+    Returns:
+        list: the paths of the files that were written
+    """
+    written = []
+    for root, _dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            media_type, encoding = mimetypes.guess_type(name)
+            if encoding or media_type not in COMPRESSIBLE or os.path.getsize(path) < min_size:
+                continue
+            with open(path, "rb") as file:
+                data = file.read()
+            copies = {".gz": gzip.compress(data, 9, mtime=0)}
+            if brotli:
+                copies[".br"] = brotli.compress(data, quality=11)
+            for suffix, compressed in copies.items():
+                with open(path + suffix, "wb") as file:
+                    file.write(compressed)
+                written.append(path + suffix)
+    return written
+
+
+def main():
+    """Precompresses the static files given on the command line"""
+    parser = argparse.ArgumentParser(description="Writes precompressed copies of static files")
+    parser.add_argument("directory")
+    parser.add_argument("--min-size", type=int, default=1024)
+    args = parser.parse_args()
+    for path in precompress(args.directory, args.min_size):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Contract
+
+This module holds the parts of the /api/products contract that do not
+depend on the web framework, so that the Flask routes and the ASGI service
+page, tag and match Products in exactly the same way.
+"""
+import json
+import re
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from hashlib import sha1
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+
+# The content coding that ends the ETag of a compressed body, like "7-3-gzip"
+CODING_SUFFIX = re.compile(r'-(?:br|gzip)"')
+
+# query string arguments that filter the Product listing
+FILTERS = ("name", "description", "available", "price", "price_min", "price_max", "search")
+
+# query string arguments that page or reorder a listing, which a lookup by ids cannot do
+LISTING_OPTIONS = ("sort", "limit", "cursor", "stream")
+
+# header of a lookup by ids that lists the ids that were not found
+MISSING_IDS_HEADER = "X-Missing-Ids"
+
+# the fields of the documented Product model, in the order that marshal() writes them
+PRODUCT_FIELDS = ("_id", "id", "name", "description", "available", "price")
+
+
+######################################################################
+# Product documents
+######################################################################
+def mask_fields(mask: str) -> list:
+    """Returns the Product fields named in a field mask header like "{id,name}" """
+    names = (name.strip() for name in mask.strip().strip("{}").split(","))
+    return [name for name in names if name in PRODUCT_FIELDS]
+
+
+def column_fields(names) -> list:
+    """Returns the selected fields that are read from the product table
+
+    Args:
+        names: the selected Product fields, or None for all of them
+
+    Returns:
+        list: the fields without _id, which is not a column, or None for all of them
+    """
+    if not names:
+        return None
+    return [name for name in names if name != "_id"]
+
+
+def product_document(values: dict, names) -> dict:
+    """Shapes the serialized fields of a Product like marshal() does with the Product model
+
+    Args:
+        values (dict): the serialized fields, missing ones are written as null
+        names: the fields to write, in order
+    """
+    document = {name: values.get(name) for name in names}
+    if document.get("price") is not None:
+        document["price"] = float(document["price"])
+    return document
+
+
+def dumps(data) -> bytes:
+    """Encodes JSON with orjson when it is installed, and with the json module otherwise"""
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+######################################################################
+# Lookups by id
+######################################################################
+def lookup_conflicts(args: dict) -> list:
+    """Returns the listing arguments that were given together with ids"""
+    return [name for name in (*FILTERS, *LISTING_OPTIONS) if args.get(name) is not None]
+
+
+def lookup_fingerprint(found: list) -> tuple:
+    """Returns the count and the ids and versions of the Products found by a lookup
+
+    These identify the lookup like Product.fingerprint() identifies a listing,
+    so that collection_etag() works for both.
+
+    Args:
+        found (list): the serialized Products and their versions
+    """
+    versions = {product["id"]: version for product, version in found}
+    return len(found), ",".join(f"{product_id}:{versions[product_id]}" for product_id in sorted(versions))
+
+
+######################################################################
+# Pagination cursors
+######################################################################
+def encode_cursor(sort_key) -> str:
+    """Encodes the sort key of the last Product on a page as an opaque cursor"""
+    return urlsafe_b64encode(json.dumps({"after": sort_key}).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """Decodes a cursor created by encode_cursor back into a sort key"""
+    try:
+        after = json.loads(urlsafe_b64decode(cursor.encode()))["after"]
+    except (Base64Error, ValueError, TypeError, KeyError) as error:
+        raise ValueError("Invalid pagination cursor") from error
+    if not isinstance(after, (int, list)) or isinstance(after, bool):
+        raise ValueError("Invalid pagination cursor")
+    return after
+
+
+######################################################################
+# Entity tags
+######################################################################
+def product_etag(product_id: int, version: int, fields=None) -> str:
+    """Returns the ETag of a single Product, which changes with its version
+
+    A Product masked down to some of its fields is another representation,
+    so its ETag ends with a hash of those fields after the version.
+    """
+    return f"{product_id}-{version}{fields_tag(fields)}"
+
+
+def fields_tag(fields) -> str:
+    """Returns the ETag suffix of a selection of fields, empty when every field is sent"""
+    if not fields or set(fields) >= set(PRODUCT_FIELDS):
+        return ""
+    return "-" + sha1(",".join(sorted(set(fields))).encode()).hexdigest()[:8]
+
+
+def etag_versions(etags, product_id: int) -> list:
+    """Returns the versions of a Product named in parsed If-Match ETags
+
+    Args:
+        etags (werkzeug.datastructures.ETags): the parsed If-Match header
+        product_id (int): the id of the Product
+
+    Returns:
+        list: the versions, or None if any version will do
+    """
+    if not etags or etags.star_tag:
+        return None
+    prefix = f"{product_id}-"
+    # the version may be followed by the suffix of a field mask
+    versions = (etag[len(prefix):].split("-", 1)[0] for etag in etags.as_set() if etag.startswith(prefix))
+    return [int(version) for version in versions if version.isdigit()]
+
+
+def coded_etag(etag: str, coding: str) -> str:
+    """Returns the quoted ETag of a body compressed with a content coding
+
+    A compressed body is other bytes than the identity one, so its strong
+    ETag ends with its coding, like "7-3-gzip".
+    """
+    return f'{etag[:-1]}-{coding}"'
+
+
+def strip_codings(header: str) -> str:
+    """Strips the content codings off the ETags of an If-None-Match or If-Match header"""
+    return CODING_SUFFIX.sub('"', header)
+
+
+def collection_etag(fingerprint: tuple, mimetype: str, query_string: str, fields=None) -> str:
+    """Returns an ETag for a listing of Products without loading them
+
+    The ETag hashes the count and the ids and versions of the Products in
+    the listing together with the query string, media type and the fields
+    of the field mask header, since those change the representation without
+    changing the Products.
+    """
+    count, members = fingerprint
+    key = f"{count}:{members}:{mimetype}:{query_string}{fields_tag(fields)}"
+    return sha1(key.encode()).hexdigest()
@@ -19,7 +19,7 @@ Module: error_handlers
 # from flask import jsonify
 from flask import current_app as app  # Import Flask application
 from service import api
-from service.models import DataValidationError
+from service.models import DataConflictError, DataValidationError
 from . import status
 
 
@@ -42,6 +42,18 @@ def request_validation_error(error):
     }, status.HTTP_400_BAD_REQUEST
 
 
+@api.errorhandler(DataConflictError)
+def data_conflict_error(error):
+    """Handles writes that lost the race against another request"""
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        "status_code": status.HTTP_409_CONFLICT,
+        "error": "Conflict",
+        "message": message,
+    }, status.HTTP_409_CONFLICT
+
+
 # @api.errorhandler(DataConnectionError)
 # def database_connection_error(error):
 #     """Handles Database Errors from connection attempts"""
@@ -19,18 +19,130 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+With LOG_QUEUE on, requests only put their log records on a queue, and a
+listener thread formats them and writes them out, so that a slow or full
+stdout never blocks a request. LOG_FORMAT=json writes one JSON document per
+line, and LOG_SAMPLE_RATES keeps the info lines of only 1 in N requests of
+the routes it names.
 """
+import atexit
+import itertools
+import json
 import logging
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from flask import has_request_context, request
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as one JSON document per line"""
+
+    def format(self, record):
+        document = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "route", None):
+            document["route"] = record.route
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+class RequestFilter(logging.Filter):
+    """Stamps log records with the route of the request that logged them
+
+    Sampling 1 in N requests of a route keeps or drops every info line of a
+    request together, so that the lines that are kept tell a whole story.
+    Warnings and errors are always kept.
+    """
+
+    def __init__(self, sample_rates: dict = None):
+        super().__init__()
+        self.sample_rates = sample_rates or {}
+        self.default_rate = self.sample_rates.get("*", 1)
+        self._counts = {}
+
+    def filter(self, record):
+        if not has_request_context():
+            return True
+        record.route = f"{request.method} {request.endpoint or 'unmatched'}"
+        if record.levelno > logging.INFO:
+            return True
+        sampled = request.environ.get("service.log_sampled")
+        if sampled is None:
+            rate = self.sample_rates.get(request.endpoint, self.default_rate)
+            count = self._counts.setdefault(request.endpoint, itertools.count())
+            sampled = request.environ["service.log_sampled"] = rate <= 1 or next(count) % rate == 0
+        return sampled
+
+
+class BackgroundHandler(QueueHandler):
+    """Puts log records on a queue without formatting them
+
+    QueueHandler formats the message in the thread that logs it. This one
+    leaves the message and its arguments to the listener thread, so that
+    formatting a payload costs the request nothing. Records are never
+    pickled since the queue stays in the process.
+    """
+
+    def prepare(self, record):
+        return record
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
-    app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    handlers = gunicorn_logger.handlers
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+    for handler in handlers:
         handler.setFormatter(formatter)
+    request_filter = RequestFilter(app.config.get("LOG_SAMPLE_RATES"))
+    stop_listener(app)
+    if app.config.get("LOG_QUEUE"):
+        handlers = [queue_handler(app, handlers or [logging.StreamHandler()], formatter)]
+    for logger in service_loggers(app):
+        logger.propagate = False
+        logger.setLevel(gunicorn_logger.level)
+        for log_filter in list(logger.filters):
+            if isinstance(log_filter, RequestFilter):
+                logger.removeFilter(log_filter)
+        logger.addFilter(request_filter)
+        logger.handlers = list(handlers)
     app.logger.info("Logging handler established")
+
+
+def service_loggers(app) -> list:
+    """Returns the logger of app and the flask.app logger that the other modules of the service write to"""
+    shared = logging.getLogger("flask.app")
+    return [app.logger] if shared is app.logger else [app.logger, shared]
+
+
+def queue_handler(app, handlers: list, formatter: logging.Formatter) -> QueueHandler:
+    """Starts a thread that writes the records of a queue to handlers and returns the handler that fills it"""
+    records = queue.SimpleQueue()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    app.extensions["log_listener"] = listener
+    atexit.register(stop_listener, app)
+    return BackgroundHandler(records)
+
+
+def stop_listener(app):
+    """Writes out the queued log records of app and stops its listener thread"""
+    listener = app.extensions.pop("log_listener", None)
+    if listener:
+        listener.stop()
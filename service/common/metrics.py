@@ -0,0 +1,211 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Prometheus Metrics
+
+This module counts and times the requests of every resource and method,
+and the database queries of every Product method, and exposes them in the
+Prometheus text format on /metrics.
+
+Under gunicorn every worker keeps its own metrics, so set
+PROMETHEUS_MULTIPROC_DIR to an empty directory before the workers start:
+they then write their metrics to memory mapped files in it, and /metrics
+adds up the files of all workers, whichever worker answers the scrape.
+"""
+import functools
+import inspect
+import os
+import time
+from contextvars import ContextVar
+from flask import Response, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# The model method whose queries are running, like "Product.find"
+db_operation = ContextVar("db_operation", default=None)
+
+REQUESTS = Counter(
+    "http_requests_total", "HTTP requests by resource, method and status", ["resource", "method", "status"]
+)
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time to answer HTTP requests, without streaming the body, by resource and method",
+    ["resource", "method"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "HTTP requests being answered by resource and method",
+    ["resource", "method"],
+    multiprocess_mode="livesum",
+)
+DB_QUERIES = Counter("db_queries_total", "Database queries by model method", ["operation"])
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "Time to execute database queries by model method",
+    ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+
+######################################################################
+# Model instrumentation
+######################################################################
+def instrument(*instance_methods):
+    """Labels the queries of the classmethods of a model class with their names
+
+    Apply it to the class as a decorator, naming the instance methods that
+    run queries as well. When one method calls another, its queries count
+    for the outermost one, the one that the routes called.
+    """
+
+    def decorate(cls):
+        for name, attribute in list(vars(cls).items()):
+            if isinstance(attribute, classmethod) and not name.startswith("_"):
+                setattr(cls, name, classmethod(_labelled(attribute.__func__, f"{cls.__name__}.{name}")))
+            elif name in instance_methods:
+                setattr(cls, name, _labelled(attribute, f"{cls.__name__}.{name}"))
+        return cls
+
+    return decorate
+
+
+def _labelled(function, operation: str):
+    """Wraps a method so that the queries that it runs are labelled with operation"""
+    if inspect.isgeneratorfunction(function):
+
+        @functools.wraps(function)
+        def generator(*args, **kwargs):
+            # the label is set around every step, as the caller runs in between
+            steps = function(*args, **kwargs)
+            while True:
+                token = db_operation.set(db_operation.get() or operation)
+                try:
+                    item = next(steps)
+                except StopIteration:
+                    return
+                finally:
+                    db_operation.reset(token)
+                yield item
+
+        return generator
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = db_operation.set(db_operation.get() or operation)
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            db_operation.reset(token)
+        # queries that are returned run later, so they carry the label along
+        if hasattr(result, "execution_options"):
+            result = result.execution_options(metrics_operation=db_operation.get() or operation)
+        return result
+
+    return wrapper
+
+
+def operation_of(context) -> str:
+    """Returns the model method that ran or built the query of an execution context"""
+    return db_operation.get() or context.execution_options.get("metrics_operation", "other")
+
+
+class Metrics:
+    """Records the metrics of the requests of a Flask app and of its database queries"""
+
+    def init_app(self, app):
+        """Times every request of app and every query, and serves the metrics on /metrics"""
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+        app.teardown_request(self.leave_request)
+        app.add_url_rule("/metrics", "metrics", self.export)
+        # every engine, so that the queries sent to read replicas count as well
+        if not event.contains(Engine, "before_cursor_execute", self._before_execute):
+            event.listen(Engine, "before_cursor_execute", self._before_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_execute)
+
+    @staticmethod
+    def labels() -> tuple:
+        """Returns the resource and method labels of the current request"""
+        return request.endpoint or "unmatched", request.method
+
+    ##################################################
+    # Request hooks
+    ##################################################
+
+    def start_request(self):
+        """Counts the request as in progress and starts its timer"""
+        g.metrics_labels = self.labels()
+        g.metrics_start = time.perf_counter()
+        REQUESTS_IN_PROGRESS.labels(*g.metrics_labels).inc()
+
+    @staticmethod
+    def end_request(response):
+        """Counts and times the answered request"""
+        resource, method = g.get("metrics_labels") or Metrics.labels()
+        REQUESTS.labels(resource, method, str(response.status_code)).inc()
+        if "metrics_start" in g:
+            REQUEST_DURATION.labels(resource, method).observe(time.perf_counter() - g.metrics_start)
+        return response
+
+    @staticmethod
+    def leave_request(_error=None):
+        """Stops counting the request as in progress, even when it failed"""
+        labels = g.pop("metrics_labels", None)
+        if labels:
+            REQUESTS_IN_PROGRESS.labels(*labels).dec()
+
+    ##################################################
+    # Database hooks
+    ##################################################
+
+    @staticmethod
+    def _before_execute(connection, _cursor, _statement, _parameters, _context, _executemany):
+        """Starts the timer of a query"""
+        connection.info["metrics_start"] = time.perf_counter()
+
+    @staticmethod
+    def _after_execute(connection, _cursor, _statement, _parameters, context, _executemany):
+        """Counts and times a query for the model method that ran or built it"""
+        duration = time.perf_counter() - connection.info.pop("metrics_start")
+        operation = operation_of(context)
+        DB_QUERIES.labels(operation).inc()
+        DB_QUERY_DURATION.labels(operation).observe(duration)
+
+    ##################################################
+    # Exposition
+    ##################################################
+
+    @staticmethod
+    def registry():
+        """Returns the registry to export, which adds up every worker in multiprocess mode"""
+        if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            return REGISTRY
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+
+    def export(self):
+        """Returns the metrics in the Prometheus text format"""
+        return Response(generate_latest(self.registry()), content_type=CONTENT_TYPE_LATEST)
+
+
+# The metrics of the Flask app
+metrics = Metrics()
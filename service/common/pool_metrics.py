@@ -0,0 +1,122 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Connection Pool Metrics
+
+This module counts what the database connection pool of a worker does and
+how long requests wait for a connection, so that the pool can be sized from
+numbers instead of guesses.
+"""
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds in seconds of the wait time histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class PoolMetrics:
+    """Counts pool events and keeps a histogram of connection wait times"""
+
+    def __init__(self, buckets: tuple = WAIT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def init_app(self, app):
+        """Times the checkouts of pools sized with SQLALCHEMY_ENGINE_OPTIONS
+
+        Call it before the engine is created, that is before db.init_app().
+        """
+        # a copy, since the default options are shared by every app
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        if "pool_size" in options:
+            options.setdefault("poolclass", TimedQueuePool)
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    def watch(self, engine):
+        """Counts the connect, checkout, checkin and invalidate events of an engine"""
+        for name in ("connect", "checkout", "checkin", "invalidate"):
+            event.listen(engine, name, self._counter(name))
+
+    def _counter(self, name: str):
+        """Returns a pool event listener that counts the event"""
+
+        def count(*_args):
+            with self._lock:
+                self.events[name] += 1
+
+        return count
+
+    def reset(self):
+        """Forgets every count and wait time"""
+        with self._lock:
+            self.events = {"connect": 0, "checkout": 0, "checkin": 0, "invalidate": 0}
+            self.timeouts = 0
+            self.wait_count = 0
+            self.wait_sum = 0.0
+            self.wait_buckets = [0] * (len(self.buckets) + 1)
+
+    def observe_wait(self, seconds: float, timed_out: bool = False):
+        """Records how long a checkout waited for a connection"""
+        with self._lock:
+            self.wait_count += 1
+            self.wait_sum += seconds
+            self.timeouts += timed_out
+            index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+            self.wait_buckets[index] += 1
+
+    def stats(self, pool) -> dict:
+        """Returns the state of a pool with the counts and the wait time histogram
+
+        The buckets are cumulative like Prometheus histograms: each one holds
+        the checkouts that waited at most that many seconds.
+        """
+        with self._lock:
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip([*map(str, self.buckets), "+Inf"], self.wait_buckets):
+                cumulative += count
+                buckets[bound] = cumulative
+            counts = dict(self.events, timeout=self.timeouts)
+            wait = {"count": self.wait_count, "sum": round(self.wait_sum, 6), "buckets": buckets}
+        state = {
+            name: getattr(pool, name)()
+            for name in ("size", "checkedin", "checkedout", "overflow")
+            if hasattr(pool, name)
+        }
+        return {**state, "events": counts, "wait": wait}
+
+
+# Metrics of the pool of this worker
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that reports how long each checkout waited to pool_metrics"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.observe_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_metrics.observe_wait(time.perf_counter() - started)
+        return connection
@@ -0,0 +1,135 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Sampling Profiler
+
+This module profiles live requests with a stack sampler: while a profiled
+request runs, a thread records the stack of the thread that answers it
+every PROFILE_INTERVAL seconds. The stacks are appended in the collapsed
+format of flamegraph.pl and speedscope, one file per route, to
+PROFILE_DIRECTORY, like product_collection.GET.collapsed
+
+It profiles 1 in PROFILE_SAMPLE_RATE requests, and the requests whose
+X-Profile header carries PROFILE_TOKEN. With neither set, it does not hook
+into the app at all, so it costs nothing.
+"""
+import hmac
+import itertools
+import os
+import sys
+import threading
+from collections import Counter
+from flask import g, request
+
+# The header that asks for a request to be profiled
+PROFILE_HEADER = "X-Profile"
+
+
+def collapse(frame) -> str:
+    """Returns a stack in the collapsed format, outermost frame first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}".replace(" ", "_").replace(";", ":"))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of a thread until it is stopped"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        """Records the stack of the thread every interval"""
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self) -> Counter:
+        """Stops sampling and returns the number of samples of every stack"""
+        self._stopped.set()
+        self.join()
+        return self.stacks
+
+
+class Profiler:
+    """Profiles a sample of the requests of a Flask app"""
+
+    def __init__(self):
+        self.sample_rate = 0
+        self.token = ""
+        self.interval = 0.005
+        self.directory = None
+        self._count = itertools.count()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Profiles the requests of app when PROFILE_SAMPLE_RATE or PROFILE_TOKEN is set"""
+        self.sample_rate = app.config["PROFILE_SAMPLE_RATE"]
+        self.token = app.config["PROFILE_TOKEN"]
+        self.interval = app.config["PROFILE_INTERVAL"]
+        self.directory = app.config["PROFILE_DIRECTORY"]
+        if not self.sample_rate and not self.token:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        app.before_request(self.start_request)
+        app.teardown_request(self.end_request)
+
+    def wanted(self) -> bool:
+        """Tells whether to profile the current request"""
+        header = request.headers.get(PROFILE_HEADER)
+        if header and self.token and hmac.compare_digest(header.encode(), self.token.encode()):
+            return True
+        return bool(self.sample_rate) and next(self._count) % self.sample_rate == 0
+
+    def start_request(self):
+        """Starts sampling the stack of the request when it is profiled"""
+        if self.wanted():
+            g.profiler = StackSampler(threading.get_ident(), self.interval)
+            g.profiler.start()
+
+    def end_request(self, _error=None):
+        """Stops sampling and adds the stacks to the file of the route
+
+        This runs when the request context ends, so streamed responses are
+        profiled until their last chunk.
+        """
+        sampler = g.pop("profiler", None)
+        if sampler is None:
+            return
+        stacks = sampler.stop()
+        if stacks:
+            self.write(f"{request.endpoint or 'unmatched'}.{request.method}", stacks)
+
+    def write(self, route: str, stacks: Counter) -> str:
+        """Appends stacks to the collapsed stack file of a route and returns its path"""
+        path = os.path.join(self.directory, f"{route}.collapsed")
+        lines = "".join(f"{stack} {count}\n" for stack, count in stacks.items())
+        with self._lock, open(path, "a", encoding="utf-8") as file:
+            file.write(lines)
+        return path
+
+
+# The profiler of the Flask app
+profiler = Profiler()
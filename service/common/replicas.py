@@ -0,0 +1,228 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Read Replicas
+
+This module sends reads to the DATABASE_REPLICA_URIS round-robin while
+writes, and reads that must see them, stay on the primary DATABASE_URI.
+
+Reads go to a replica when they run inside a classmethod marked with
+@read_only or while handling a GET or HEAD request. Reads inside one marked
+with @read_primary always stay on the primary, even in a GET request and
+even when they call a @read_only one. A session sticks to the
+primary once it writes, for the rest of the request, and so do the requests
+of a client for DATABASE_REPLICA_LAG seconds after it wrote something.
+
+A session reads from the same replica until it commits, rolls back or
+closes, so that the queries of one response, like its ETag and its body,
+see the same state even when the replicas lag by different amounts.
+"""
+import functools
+import itertools
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from flask import current_app, g, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import Select
+
+logger = logging.getLogger("flask.app")
+
+# Whether the reads of the current context may be sent to a replica, where
+# None means that nothing decided it yet, which keeps them on the primary
+replica_reads = ContextVar("replica_reads", default=None)
+
+# Cookie that keeps the reads of a client on the primary after it wrote
+PRIMARY_COOKIE = "read_primary"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def read_only(function):
+    """Lets the queries run by a function go to a replica"""
+    return _route_reads(function, True)
+
+
+def read_primary(function):
+    """Keeps the queries run by a function on the primary, even in a GET request"""
+    return _route_reads(function, False)
+
+
+def _route_reads(function, to_replica: bool):
+    """Wraps a function so that its queries may, or may not, go to a replica"""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        # @read_primary always wins, @read_only only sends reads that are not kept on the primary
+        token = replica_reads.set(to_replica and replica_reads.get() is not False)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            replica_reads.reset(token)
+
+    return wrapper
+
+
+class RoutingSession(Session):
+    """A session that reads from a replica when it can and writes to the primary"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and replicas.engines:
+            if self._flushing or self._is_write(clause):
+                # read your own writes for the rest of the session
+                self.info["primary"] = True
+            elif clause is not None and replica_reads.get() and not self.info.get("primary"):
+                engine = self.info.get("replica")
+                if engine is None or not replicas.is_healthy(engine):
+                    engine = self.info["replica"] = replicas.choose()
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def commit(self):
+        self.info.pop("replica", None)
+        super().commit()
+
+    def rollback(self):
+        self.info.pop("replica", None)
+        super().rollback()
+
+    def close(self):
+        self.info.pop("replica", None)
+        super().close()
+
+    @staticmethod
+    def _is_write(clause) -> bool:
+        """Returns whether a statement writes or locks rows"""
+        if clause is None:
+            return False
+        return not isinstance(clause, Select) or clause._for_update_arg is not None  # pylint: disable=protected-access
+
+
+class ReplicaSet:
+    """Round-robin over the read replicas that passed their last health check"""
+
+    def __init__(self):
+        self.engines = []
+        self.lag = 5.0
+        self.check_interval = 5.0
+        self._health = {}
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Creates the replica engines and keeps write requests on the primary"""
+        self.lag = app.config["DATABASE_REPLICA_LAG"]
+        self.check_interval = app.config["DATABASE_REPLICA_CHECK_INTERVAL"]
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        # the pool metrics only describe the pool of the primary
+        options.pop("poolclass", None)
+        self.configure(app.config["DATABASE_REPLICA_URIS"], **options)
+        app.before_request(self.route_request)
+        app.after_request(self.remember_write)
+        app.teardown_request(self.end_request)
+
+    def configure(self, uris: list, **options):
+        """Replaces the replica engines with ones for the given URIs"""
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = [create_engine(uri, **options) for uri in uris]
+        self._health = {engine: (True, time.monotonic()) for engine in self.engines}
+        for engine in self.engines:
+            event.listen(engine, "handle_error", self._handle_error)
+        if uris:
+            logger.info("Reading from %d replicas", len(uris))
+
+    def choose(self):
+        """Returns the next healthy replica engine, or None to use the primary"""
+        for _ in range(len(self.engines)):
+            engine = self.engines[next(self._turns) % len(self.engines)]
+            if self.is_healthy(engine):
+                return engine
+        return None
+
+    def is_healthy(self, engine) -> bool:
+        """Returns the last health of a replica, checking it again once it is too old"""
+        healthy, checked_at = self._health[engine]
+        if time.monotonic() - checked_at < self.check_interval:
+            return healthy
+        # only one thread checks, the others use the last result meanwhile
+        if not self._lock.acquire(blocking=False):
+            return healthy
+        try:
+            healthy = self.check(engine)
+            self._health[engine] = (healthy, time.monotonic())
+        finally:
+            self._lock.release()
+        return healthy
+
+    @staticmethod
+    def check(engine) -> bool:
+        """Returns whether a replica answers a query"""
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return True
+        except DBAPIError as error:
+            logger.warning("Replica %s is down: %s", engine.url, error)
+            return False
+
+    def _handle_error(self, context):
+        """Stops reading from a replica whose connection failed"""
+        if context.is_disconnect or context.connection is None:
+            self._health[context.engine] = (False, time.monotonic())
+
+    def stats(self) -> list:
+        """Returns the URL, without password, and health of every replica"""
+        return [
+            {"url": engine.url.render_as_string(hide_password=True), "healthy": self._health[engine][0]}
+            for engine in self.engines
+        ]
+
+    ##################################################
+    # Request hooks
+    ##################################################
+
+    def route_request(self):
+        """Lets safe requests read from replicas unless their client just wrote"""
+        if not self.engines:
+            return
+        reads = request.method in SAFE_METHODS and PRIMARY_COOKIE not in request.cookies
+        session = current_app.extensions["sqlalchemy"].session
+        session.info["primary"] = not reads
+        session.info.pop("replica", None)
+        if reads:
+            g.replica_reads = replica_reads.set(True)
+
+    def remember_write(self, response):
+        """Keeps the next reads of a client that wrote on the primary for a while"""
+        if self.engines and request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(PRIMARY_COOKIE, "1", max_age=int(self.lag), httponly=True)
+        return response
+
+    @staticmethod
+    def end_request(_error=None):
+        """Stops the reads of the request from going to replicas"""
+        token = g.pop("replica_reads", None)
+        if token is not None:
+            replica_reads.reset(token)
+
+
+# Read replicas of this worker
+replicas = ReplicaSet()
@@ -0,0 +1,164 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Timing
+
+This module logs the database queries that take longer than
+SLOW_QUERY_THRESHOLD seconds, with their statement, the shape of their
+parameters, their row count and the route that sent them, and breaks the
+time of every request down into phases:
+
+    db          executing queries
+    fetch       turning results into Products or rows, without the db time
+    serialize   turning Products or rows into documents and JSON
+    marshal     applying the flask-restx model to documents
+
+When SERVER_TIMING is on, the phases are sent in a Server-Timing header,
+which browser developer tools show next to the request. Streamed responses
+only report what happened before their first chunk, as the header is sent
+before the body.
+"""
+import re
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.common.metrics import operation_of
+
+# Descriptions of the phases in the Server-Timing header, in their order
+PHASES = {
+    "db": "database queries",
+    "fetch": "loading results",
+    "serialize": "serializing",
+    "marshal": "marshalling",
+}
+# Longest statement written to the slow query log
+STATEMENT_MAX_LENGTH = 1000
+WHITESPACE = re.compile(r"\s+")
+
+
+def parameter_shape(parameters, executemany: bool = False) -> str:
+    """Describes the parameters of a query by their names and types, never their values"""
+    if executemany:
+        first = parameter_shape(parameters[0]) if parameters else "()"
+        return f"{len(parameters)} x {first}"
+    if isinstance(parameters, dict):
+        return "(" + ", ".join(f"{name}: {type(value).__name__}" for name, value in parameters.items()) + ")"
+    return "(" + ", ".join(type(value).__name__ for value in parameters or ()) + ")"
+
+
+def route() -> str:
+    """Returns the method and endpoint of the current request, or - outside of requests"""
+    if not has_request_context():
+        return "-"
+    return f"{request.method} {request.endpoint or request.path}"
+
+
+class Timing:
+    """Logs slow queries and times the phases of every request"""
+
+    def __init__(self):
+        self.logger = None
+        self.slow_query_threshold = 0.5
+        self.server_timing = False
+
+    def init_app(self, app):
+        """Times the requests of app and the queries of every engine"""
+        self.logger = app.logger
+        self.slow_query_threshold = app.config["SLOW_QUERY_THRESHOLD"]
+        self.server_timing = app.config["SERVER_TIMING"]
+        app.before_request(self.start_request)
+        app.after_request(self.add_header)
+        if not event.contains(Engine, "before_cursor_execute", self._before_execute):
+            event.listen(Engine, "before_cursor_execute", self._before_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_execute)
+
+    ##################################################
+    # Request phases
+    ##################################################
+
+    @staticmethod
+    def start_request():
+        """Starts the timers of the request"""
+        g.timing_start = time.perf_counter()
+        g.timings = {}
+
+    @staticmethod
+    def add(name: str, seconds: float):
+        """Adds seconds to a phase of the current request"""
+        if has_request_context() and "timings" in g:
+            g.timings[name] = g.timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def measure(self, name: str):
+        """Times a block of code as a phase of the current request
+
+        The time spent executing queries inside the block counts for db
+        only, so that the phases add up to the time of the request.
+        """
+        start = time.perf_counter()
+        db_before = g.get("timings", {}).get("db", 0.0)
+        try:
+            yield
+        finally:
+            db_time = g.get("timings", {}).get("db", 0.0) - db_before
+            self.add(name, time.perf_counter() - start - db_time)
+
+    def add_header(self, response):
+        """Sends the phases of the request in a Server-Timing header when SERVER_TIMING is on"""
+        if not self.server_timing or "timing_start" not in g:
+            return response
+        timings = g.get("timings", {})
+        metrics = [
+            f'{name};dur={timings[name] * 1000:.2f};desc="{description}"'
+            for name, description in PHASES.items()
+            if name in timings
+        ]
+        metrics.append(f'total;dur={(time.perf_counter() - g.timing_start) * 1000:.2f}')
+        response.headers["Server-Timing"] = ", ".join(metrics)
+        return response
+
+    ##################################################
+    # Database hooks
+    ##################################################
+
+    @staticmethod
+    def _before_execute(connection, _cursor, _statement, _parameters, _context, _executemany):
+        """Starts the timer of a query"""
+        connection.info["timing_start"] = time.perf_counter()
+
+    def _after_execute(self, connection, cursor, statement, parameters, context, executemany):
+        """Adds a query to the db phase and logs it when it was slow"""
+        duration = time.perf_counter() - connection.info.pop("timing_start")
+        self.add("db", duration)
+        if duration < self.slow_query_threshold or self.logger is None:
+            return
+        rows = cursor.rowcount if cursor.rowcount >= 0 else "?"
+        self.logger.warning(
+            "Slow query: %.1f ms, %s rows, route %s, operation %s, parameters %s: %s",
+            duration * 1000,
+            rows,
+            route(),
+            operation_of(context),
+            parameter_shape(parameters, executemany),
+            WHITESPACE.sub(" ", statement)[:STATEMENT_MAX_LENGTH],
+        )
+
+
+# The timing of the Flask app
+timing = Timing()
@@ -13,7 +13,86 @@ DATABASE_URI = os.getenv(
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-# SQLALCHEMY_POOL_SIZE = 2
+
+# Connection pool of each worker. Size it so that
+# (SQLALCHEMY_POOL_SIZE + SQLALCHEMY_MAX_OVERFLOW) x gunicorn workers x pods
+# stays below the max_connections of the database server.
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_pre_ping": os.getenv("SQLALCHEMY_POOL_PRE_PING", "true").lower() in ("true", "1", "yes"),
+    "pool_recycle": int(os.getenv("SQLALCHEMY_POOL_RECYCLE", "1800")),
+}
+# in-memory SQLite keeps a single connection, which cannot be pooled
+if DATABASE_URI not in ("sqlite://", "sqlite:///:memory:"):
+    SQLALCHEMY_ENGINE_OPTIONS.update(
+        pool_size=int(os.getenv("SQLALCHEMY_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("SQLALCHEMY_MAX_OVERFLOW", "10")),
+        pool_timeout=float(os.getenv("SQLALCHEMY_POOL_TIMEOUT", "30")),
+    )
+
+# Read replicas, as a comma separated list of URIs, that GET requests read from
+DATABASE_REPLICA_URIS = [uri.strip() for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri.strip()]
+# Seconds between health checks of a replica
+DATABASE_REPLICA_CHECK_INTERVAL = float(os.getenv("DATABASE_REPLICA_CHECK_INTERVAL", "5"))
+# Seconds that a client keeps reading from the primary after it wrote
+DATABASE_REPLICA_LAG = float(os.getenv("DATABASE_REPLICA_LAG", "5"))
+
+# Largest page a client may request with ?limit=
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Write listings straight from row tuples, with orjson when it is installed,
+# instead of loading Products and marshalling them
+FAST_JSON = os.getenv("FAST_JSON", "true").lower() in ("true", "1", "yes")
+
+# Responses smaller than this many bytes are not compressed
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# gzip level (1-9) and brotli quality (0-11) of compressed responses
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+# Seconds that browsers may cache versioned static files
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", str(365 * 24 * 3600)))
+
+# Queries that take longer than this many seconds are logged as slow queries
+SLOW_QUERY_THRESHOLD = float(os.getenv("SLOW_QUERY_THRESHOLD", "0.5"))
+# Break the time of every request down into db, fetch, serialize and marshal
+# time in a Server-Timing response header
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() in ("true", "1", "yes")
+
+# Profile 1 in PROFILE_SAMPLE_RATE requests (0: none), and the requests whose
+# X-Profile header carries PROFILE_TOKEN, sampling their stack every
+# PROFILE_INTERVAL seconds into one collapsed stack file per route
+PROFILE_SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_DIRECTORY = os.getenv("PROFILE_DIRECTORY", "/tmp/profiles")
+
+# Number of rows read from the database per chunk when streaming listings
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "500"))
+
+# Number of Products written per statement and transaction by batch requests
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "1000"))
+
+# In-process cache of serialized Products, per worker (0 disables it)
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "1024"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "60"))
+
+# Announces Product changes to every worker so they can evict cached copies:
+# "postgres" uses LISTEN/NOTIFY, "memory" only reaches the current process
+CHANGE_BROKER = os.getenv(
+    "CHANGE_BROKER", "postgres" if DATABASE_URI.startswith("postgresql") else "memory"
+)
+CHANGE_CHANNEL = os.getenv("CHANGE_CHANNEL", "product_changes")
+
+# Write log records from a background thread instead of the request threads
+LOG_QUEUE = os.getenv("LOG_QUEUE", "false").lower() in ("true", "1", "yes")
+# "text" or "json", one JSON document per line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# Keep the info lines of 1 in N requests per endpoint, as a comma separated
+# list like "product_collection=100,product_resource=10", where * sets the
+# rate of the other endpoints
+LOG_SAMPLE_RATES = {
+    name.strip(): int(rate)
+    for name, rate in (item.split("=", 1) for item in os.getenv("LOG_SAMPLE_RATES", "").split(",") if "=" in item)
+}
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
@@ -3,23 +3,42 @@ Models for Product
 
 All of the models are stored in this module
 """
+# pylint: disable=too-many-lines
 
 import logging
+import time
 from decimal import Decimal
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import DDL, and_, any_, bindparam, cast, delete, event, func, or_, literal, literal_column, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.exc import StaleDataError
+from service.common.cache import TTLCache
+from service.common.metrics import instrument
+from service.common.replicas import RoutingSession, read_only, read_primary
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# Serialized Products by id, sized by init_app() when the app is created
+product_cache = TTLCache()
 
 
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
-class Product(db.Model):
+class DataConflictError(Exception):
+    """Used when a Product was changed by someone else since it was read"""
+
+
+@instrument("create", "update", "delete")
+class Product(db.Model):  # pylint: disable=too-many-public-methods
     """
     Class that represents a Product
     """
@@ -31,7 +50,33 @@ class Product(db.Model):
     name = db.Column(db.String(100), nullable=False, unique=True)
     description = db.Column(db.String(250), nullable=False)
     price = db.Column(db.Numeric(scale=2), nullable=False)
-    available = db.Column(db.Boolean(), nullable=False, default=False)
+    # The server default lets COPY load files without an available column
+    available = db.Column(db.Boolean(), nullable=False, default=False, server_default=db.false())
+    # Incremented on every update, so the ETag of a Product changes with it
+    version = db.Column(db.Integer, nullable=False, default=1, server_default=db.text("1"))
+
+    # Every UPDATE and DELETE is issued with WHERE version = :read_version and
+    # bumps the version, so a write based on a stale read changes no rows and
+    # fails instead of overwriting someone else's changes (optimistic locking)
+    __mapper_args__ = {"version_id_col": version}
+
+    # The id is part of the price and availability indexes so that keyset
+    # pages filtered or sorted on them are read straight from the index.
+    # PostgreSQL also gets a trigram index so that description searches,
+    # ILIKE '%term%' included, no longer scan the whole table.
+    __table_args__ = (
+        db.Index("ix_product_price_id", "price", "id"),
+        db.Index("ix_product_available_id", "available", "id"),
+        db.Index(
+            "ix_product_description_trgm",
+            "description",
+            postgresql_using="gin",
+            postgresql_ops={"description": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
+
+    # Fields that clients may select and sort on
+    FIELDS = ("id", "name", "description", "price", "available")
 
     def __repr__(self):
         return f"<Product {self.name} id=[{self.id}]>"
@@ -56,33 +101,60 @@ class Product(db.Model):
         """
         Updates a Product in the database
         """
-        logger.info("Saving %s", self.name)
-        if not self.id:
-            raise DataValidationError("ID field cannot be empty")
-        # if not self.name:
-        #     raise DataValidationError("Name field cannot be empty")
-        if self.price is None or self.price < Decimal("0.00"):
-            raise DataValidationError("Price must be a positive number")
+        # reading expired attributes must not flush the changes in a separate UPDATE
+        with db.session.no_autoflush:
+            logger.info("Saving %s", self.name)
+            self.validate()
+            product_id = self.id
         try:
             db.session.commit()
+        except StaleDataError as e:
+            db.session.rollback()
+            logger.warning("Stale update of Product with id [%s]", product_id)
+            raise DataConflictError(
+                f"Product with id [{product_id}] was changed by another request"
+            ) from e
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
 
+    def validate(self):
+        """Checks that a Product can be saved over an existing one"""
+        if not self.id:
+            raise DataValidationError("ID field cannot be empty")
+        # if not self.name:
+        #     raise DataValidationError("Name field cannot be empty")
+        if self.price is None or self.price < Decimal("0.00"):
+            raise DataValidationError("Price must be a positive number")
+
     def delete(self):
         """Removes a Product from the data store"""
         logger.info("Deleting %s", self.name)
+        product_id = self.id
         try:
             db.session.delete(self)
             db.session.commit()
+        except StaleDataError as e:
+            db.session.rollback()
+            logger.warning("Stale delete of Product with id [%s]", product_id)
+            raise DataConflictError(
+                f"Product with id [{product_id}] was changed by another request"
+            ) from e
         except Exception as e:
             db.session.rollback()
             logger.error("Error deleting record: %s", self)
             raise DataValidationError(e) from e
 
-    def serialize(self) -> dict:
-        """Serializes a Product into a dictionary"""
+    def serialize(self, fields: list = None) -> dict:
+        """Serializes a Product into a dictionary
+
+        Args:
+            fields (list): only serialize these fields, so that columns which
+                were left out of the query are never loaded
+        """
+        if fields:
+            return {name: self._field_value(name) for name in fields}
         return {
             "id": self.id,
             "name": self.name,
@@ -91,6 +163,38 @@ class Product(db.Model):
             "available": self.available,
         }
 
+    def _field_value(self, name: str):
+        """Returns the serialized value of a single field"""
+        value = getattr(self, name)
+        return str(value) if isinstance(value, Decimal) else value
+
+    def sort_key(self, sort: list = None):
+        """Returns the keyset position of this Product in the given sort order
+
+        Args:
+            sort (list): field names to sort by, prefixed with - for descending
+        """
+        return self.row_sort_key({name: self._field_value(name) for name in self.sort_fields(sort)}, sort)
+
+    @classmethod
+    def sort_fields(cls, sort: list = None) -> list:
+        """Returns the names of the fields that make up a sort_key"""
+        return [column.key for column, _ in cls.parse_sort(sort)] + ["id"]
+
+    @classmethod
+    def row_sort_key(cls, values: dict, sort: list = None):
+        """Returns the keyset position of a row of values in the given sort order
+
+        Args:
+            values (dict): at least the sort_fields of the row, by name
+            sort (list): field names to sort by, prefixed with - for descending
+        """
+        if not sort:
+            return values["id"]
+        return [
+            str(values[name]) if isinstance(values[name], Decimal) else values[name] for name in cls.sort_fields(sort)
+        ]
+
     def deserialize(self, data: dict):
         """
         Deserializes a Product from a dictionary
@@ -100,7 +204,7 @@ class Product(db.Model):
         try:
             self.name = data["name"]
             self.description = data["description"]
-            self.price = round(Decimal(data["price"]), 2)
+            self.price = self.parse_price(data["price"])
             if isinstance(data["available"], bool):
                 self.available = data["available"]
             else:
@@ -125,60 +229,472 @@ class Product(db.Model):
     ##################################################
 
     @classmethod
-    def all(cls):
+    def paginate(cls, query, limit: int = None, after=None, order: list = None):
+        """Applies keyset pagination to a query of Products
+
+        Pages are read with ``WHERE id > :after ORDER BY id LIMIT :limit``
+        so that every page costs the same index range scan on the primary
+        key no matter how deep into the collection it is. When the query is
+        sorted the id becomes the tie-breaker of the sort columns instead.
+
+        Args:
+            query: the query to paginate
+            limit (int): the maximum number of Products to return
+            after: the sort_key of the last Product of the previous page
+            order (list): (column, descending) pairs from parse_sort
+        """
+        order = order or []
+        if limit is None and after is None and not order:
+            return query
+        if after is not None:
+            query = query.filter(cls._keyset_after(order, after))
+        query = query.order_by(
+            *[column.desc() if descending else column.asc() for column, descending in order], cls.id
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def _keyset_after(cls, order: list, after):
+        """Builds the clause that skips every row up to and including a sort_key"""
+        columns = [column for column, _ in order] + [cls.id]
+        directions = [descending for _, descending in order] + [False]
+        key = after if isinstance(after, list) else [after]
+        if len(key) != len(columns):
+            raise DataValidationError("Invalid pagination cursor")
+        try:
+            key = [literal(column.type.python_type(value), column.type) for column, value in zip(columns, key)]
+        except (ArithmeticError, TypeError, ValueError) as error:
+            raise DataValidationError("Invalid pagination cursor") from error
+        clauses = []
+        for i, (column, descending) in enumerate(zip(columns, directions)):
+            ties = [columns[j] == key[j] for j in range(i)]
+            clauses.append(and_(*ties, column < key[i] if descending else column > key[i]))
+        return or_(*clauses)
+
+    @classmethod
+    def parse_sort(cls, sort: list) -> list:
+        """Turns field names like "price" or "-name" into (column, descending) pairs"""
+        order = []
+        for name in sort or []:
+            field = name[1:] if name.startswith(("-", "+")) else name
+            if field not in cls.FIELDS:
+                raise DataValidationError(f"Unknown sort field [{field}]")
+            order.append((getattr(cls, field), name.startswith("-")))
+        return order
+
+    @classmethod
+    def parse_fields(cls, fields: list) -> list:
+        """Turns field names into the columns that have to be loaded for them"""
+        for name in fields:
+            if name not in cls.FIELDS:
+                raise DataValidationError(f"Unknown field [{name}]")
+        return [getattr(cls, name) for name in fields]
+
+    @classmethod
+    def filter_clauses(cls, filters: dict, dialect: str = None) -> list:
+        """Returns one SQL clause for each of the given filters
+
+        Args:
+            filters (dict): filter names and the values to match, None values are skipped
+            dialect (string): the database dialect, defaults to the one of db.engine
+        """
+        builders = {
+            "name": lambda value: cls.name == value,
+            "description": lambda value: cls.description.ilike(f"%{value}%"),
+            "available": lambda value: cls.available == value,
+            "price": lambda value: cls.price == value,
+            "price_min": lambda value: cls.price >= value,
+            "price_max": lambda value: cls.price <= value,
+            "search": lambda value: cls.search_clause(value, dialect),
+        }
+        clauses = []
+        for name, value in filters.items():
+            if name not in builders:
+                raise DataValidationError(f"Unknown filter [{name}]")
+            if value is not None:
+                clauses.append(builders[name](value))
+        return clauses
+
+    @classmethod
+    def search_clause(cls, term: str, dialect: str = None):
+        """Returns the clause that matches Products whose description contains a term
+
+        On PostgreSQL descriptions that are merely similar to the term match as
+        well, using the pg_trgm word similarity operator.
+
+        Args:
+            term (string): the text to look for in the description
+            dialect (string): the database dialect, defaults to the one of db.engine
+        """
+        clause = cls.description.ilike(f"%{term}%")
+        if (dialect or db.engine.dialect.name) == "postgresql":
+            clause = or_(clause, cls.description.op("%>")(term))
+        return clause
+
+    @classmethod
+    def search_ranking(cls, term: str, dialect: str = None) -> list:
+        """Returns the ORDER BY expressions that put the best search matches first"""
+        if (dialect or db.engine.dialect.name) == "postgresql":
+            return [func.word_similarity(term, cls.description).desc()]
+        # Without pg_trgm, earlier matches in shorter descriptions rank higher
+        position = func.instr(func.lower(cls.description), term.lower())
+        return [position.asc(), func.length(cls.description).asc()]
+
+    @classmethod
+    @read_only
+    def search(cls, term: str, limit: int = None) -> list:
+        """Returns the Products that match a search term, most relevant first
+
+        Args:
+            term (string): the text to look for in the description
+            limit (int): the maximum number of Products to return
+        """
+        logger.info("Processing search for %s ...", term)
+        return cls.find_by_filters({"search": term}, limit=limit).all()
+
+    @classmethod
+    @read_only
+    def find_by_filters(cls, filters: dict = None, **options):
+        """Returns the Products that match all of the given filters
+
+        Every filter, the sort order, the selected fields and the page are
+        compiled into a single SELECT statement.
+
+        Args:
+            filters (dict): any of name, description, available, price,
+                price_min, price_max and search with the values to match
+            sort (list): field names to sort by, prefixed with - for descending,
+                searches are ranked by relevance when this is not given
+            fields (list): only load these columns from the database
+            limit (int): the maximum number of Products to return
+            after: the sort_key of the last Product of the previous page
+        """
+        logger.info("Processing filter query for %s ...", filters)
+        return cls.apply_filters(cls.query, filters, **options)
+
+    @classmethod
+    def apply_filters(cls, query, filters: dict = None, dialect: str = None, **options):
+        """Adds filters, sort order, selected fields and page to a query or select()
+
+        This is the statement building half of find_by_filters, which the
+        async service executes with its own session.
+
+        Args:
+            query: a Query of Products or a select(Product) statement
+            filters (dict): the filters of find_by_filters
+            dialect (string): the database dialect, defaults to the one of db.engine
+            options: the sort, fields, limit and after of find_by_filters
+        """
+        filters = filters or {}
+        query = query.filter(*cls.filter_clauses(filters, dialect))
+        order = cls.parse_sort(options.get("sort"))
+        if filters.get("search") and not order:
+            if options.get("after") is not None:
+                raise DataValidationError("Ranked search results cannot be paged with a cursor, add a sort")
+            query = query.order_by(*cls.search_ranking(filters["search"], dialect))
+        if options.get("fields"):
+            columns = cls.parse_fields(options["fields"]) + [column for column, _ in order]
+            query = query.options(load_only(*columns))
+        return cls.paginate(query, options.get("limit"), options.get("after"), order)
+
+    @classmethod
+    def iter_chunks(cls, query, chunk_size: int):
+        """Yields the Products of a query in lists of up to chunk_size
+
+        The rows are fetched with yield_per, which reads them through a
+        server-side cursor on PostgreSQL instead of buffering the whole result.
+        """
+        result = db.session.scalars(query.statement, execution_options={"yield_per": chunk_size})
+        yield from result.partitions()
+
+    @classmethod
+    def select_rows(cls, query, fields: list = None, sort: list = None) -> tuple:
+        """Turns a query of Products into a select() of plain column tuples
+
+        Rows skip the construction of Product objects and the identity map,
+        which is most of the cost of loading a large listing.
+
+        Args:
+            query: a query of Products from find_by_filters, or a select() from apply_filters
+            fields (list): the fields to select, every field when not given
+            sort (list): the sort of the query, its sort_fields are selected as well
+
+        Returns:
+            tuple: the select() statement and the names of its columns in order
+        """
+        names = list(fields or cls.FIELDS)
+        names += [name for name in cls.sort_fields(sort) if name not in names]
+        statement = getattr(query, "statement", query)
+        return statement.with_only_columns(*[getattr(cls, name) for name in names]), names
+
+    @classmethod
+    @read_only
+    def fetch_rows(cls, statement, columns: list) -> list:
+        """Returns the rows of a select_rows() statement as dicts keyed by column"""
+        return [dict(zip(columns, row)) for row in db.session.execute(statement)]
+
+    @classmethod
+    def iter_row_chunks(cls, statement, chunk_size: int):
+        """Yields the rows of a select_rows() statement in lists of up to chunk_size"""
+        result = db.session.execute(statement, execution_options={"yield_per": chunk_size})
+        yield from result.partitions()
+
+    @classmethod
+    @read_only
+    def all(cls, limit: int = None, after: int = None):
         """Returns all of the Products in the database"""
         logger.info("Processing all Products")
-        return cls.query.all()
+        return cls.paginate(cls.query, limit, after).all()
+
+    @classmethod
+    def parse_id(cls, by_id) -> int:
+        """Converts a Product ID from a request into an integer
+
+        Only integers and strings of digits are IDs: int() would also take
+        True, 1.5 or " 1 ", which are not.
+        """
+        if isinstance(by_id, int) and not isinstance(by_id, bool):
+            return by_id
+        digits = by_id.removeprefix("-") if isinstance(by_id, str) else ""
+        if digits.isascii() and digits.isdigit():
+            return int(by_id)
+        raise DataValidationError("Invalid ID type. ID must be an integer.")
 
     @classmethod
+    def parse_price(cls, value) -> Decimal:
+        """Converts a price from a request into a finite Decimal with two places"""
+        try:
+            price = round(Decimal(value), 2)
+        except (ArithmeticError, TypeError, ValueError) as exc:
+            raise DataValidationError(f"Invalid price: {value!r}") from exc
+        if not price.is_finite():
+            raise DataValidationError(f"Invalid price: {value!r}")
+        return price
+
+    @classmethod
+    @read_only
     def find(cls, by_id):
         """Finds a Product by its ID"""
         logger.info("Processing lookup for id %s ...", by_id)
+        return cls.query.session.get(cls, cls.parse_id(by_id))
+
+    @classmethod
+    def purchase(cls, by_id, versions: list = None):
+        """Purchases a Product with a single UPDATE ... WHERE available RETURNING
+
+        The availability check and the write are one statement, so concurrent
+        buyers cannot both get the same Product and the purchase costs one
+        round trip plus the commit.
+
+        Args:
+            by_id: the id of the Product to purchase
+            versions (list): only purchase the Product if it is at one of these versions
+
+        Returns:
+            Product: the purchased Product, or None if no available Product matched
+        """
+        product_id = cls.parse_id(by_id)
+        logger.info("Processing purchase for id %s ...", product_id)
         try:
-            by_id = int(by_id)
-        except ValueError as exc:
-            raise DataValidationError(
-                "Invalid ID type. ID must be an integer."
-            ) from exc
-        return cls.query.session.get(cls, by_id)
+            product = db.session.scalars(
+                cls.purchase_statement(product_id, versions), execution_options={"populate_existing": True}
+            ).one_or_none()
+            if product:
+                publish_events(db.session, [{"id": product.id, "op": "update", "version": product.version}])
+                # keep the returned columns loaded instead of expiring them on commit
+                db.session.expunge(product)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error purchasing record: %s", product_id)
+            raise DataValidationError(e) from e
+        return product
+
+    @classmethod
+    def purchase_statement(cls, product_id: int, versions: list = None):
+        """Returns the UPDATE ... RETURNING statement that purchases a Product
+
+        Args:
+            product_id (int): the id of the Product to purchase
+            versions (list): only purchase the Product if it is at one of these versions
+        """
+        conditions = [cls.id == product_id, cls.available.is_(True)]
+        if versions is not None:
+            conditions.append(cls.version.in_(versions))
+        return (
+            update(cls)
+            .where(*conditions)
+            .values(available=False, version=cls.version + 1)
+            .returning(cls)
+        )
+
+    @classmethod
+    @read_primary
+    def find_serialized(cls, by_id) -> tuple:
+        """Finds a Product by its ID and returns it serialized with its version
+
+        Serialized Products are kept in the product cache, so repeated
+        lookups of the same Product do not go to the database until it is
+        created, updated or deleted again. Do not modify the returned dict.
+        The Product is read from the primary, since a lagging replica could
+        put a copy in the cache that was already invalidated.
+
+        Returns:
+            tuple: the serialized Product and its version, or None if not found
+        """
+        by_id = cls.parse_id(by_id)
+        found = product_cache.get(by_id)
+        if found is not None:
+            return found
+        generation = product_cache.generation
+        product = cls.find(by_id)
+        if not product:
+            return None
+        found = (product.serialize(), product.version)
+        product_cache.set(by_id, found, generation)
+        return found
+
+    @classmethod
+    @read_primary
+    def find_many(cls, ids, dialect: str = None) -> tuple:
+        """Finds Products by their IDs with a single query
+
+        Products in the product cache are not read again, the others are read
+        with one SELECT ... WHERE id = ANY(:ids) and cached like find_serialized
+        does. Do not modify the returned dicts.
+
+        Args:
+            ids: the ids of the Products to find
+            dialect (string): the database dialect, defaults to the one of db.engine
+
+        Returns:
+            tuple: the serialized Products and their versions in the order of
+                ids, without the ones that were not found, and the missing ids
+        """
+        ids = [cls.parse_id(by_id) for by_id in ids]
+        logger.info("Processing lookup for %d ids ...", len(ids))
+        found = {}
+        for product_id in dict.fromkeys(ids):
+            cached = product_cache.get(product_id)
+            if cached is not None:
+                found[product_id] = cached
+        wanted = [product_id for product_id in dict.fromkeys(ids) if product_id not in found]
+        if wanted:
+            generation = product_cache.generation
+            for product in db.session.scalars(cls.find_many_statement(wanted, dialect)):
+                found[product.id] = (product.serialize(), product.version)
+                product_cache.set(product.id, found[product.id], generation)
+        return cls.in_order(ids, found)
+
+    @classmethod
+    def find_many_statement(cls, ids: list, dialect: str = None):
+        """Returns the SELECT of the Products with the given ids
+
+        PostgreSQL gets the ids as a single array parameter, so that lookups
+        of any number of ids share one prepared statement.
+        """
+        if (dialect or db.engine.dialect.name) == "postgresql":
+            return select(cls).where(cls.id == any_(literal(ids, postgresql.ARRAY(db.Integer))))
+        return select(cls).where(cls.id.in_(ids))
+
+    @staticmethod
+    def in_order(ids: list, found: dict) -> tuple:
+        """Puts the Products found by id in the order of ids and lists the missing ids
+
+        Args:
+            ids (list): the ids that were looked up, duplicates are kept
+            found (dict): the Products that were found, by id
+
+        Returns:
+            tuple: the found Products in the order of ids and the missing ids
+        """
+        products = [found[product_id] for product_id in ids if product_id in found]
+        missing = [product_id for product_id in dict.fromkeys(ids) if product_id not in found]
+        return products, missing
+
+    @classmethod
+    @read_only
+    def fingerprint(cls, query) -> tuple:
+        """Returns the count and the ids and versions of the Products of a query
+
+        Any create, update or delete of a Product in the query, or a Product
+        joining or leaving it, changes the ids and versions, so they identify
+        its contents without loading it.
+        """
+        return tuple(db.session.execute(cls.fingerprint_statement(query.statement)).one())
+
+    @classmethod
+    def fingerprint_statement(cls, statement, dialect: str = None):
+        """Returns the SELECT of the count and the "id:version" pairs in id order of a select(Product)
+
+        PostgreSQL hashes the pairs with md5, so that only the hash leaves the
+        database.
+        """
+        rows = statement.with_only_columns(cls.id, cls.version).subquery()
+        pair = cast(rows.c.id, db.String) + ":" + cast(rows.c.version, db.String)
+        if (dialect or db.engine.dialect.name) == "postgresql":
+            members = func.md5(func.string_agg(pair, aggregate_order_by(literal_column("','"), rows.c.id)))
+            return select(func.count(), func.coalesce(members, "")).select_from(rows)
+        # group_concat() has no ORDER BY before SQLite 3.44, it follows the order of its rows
+        ordered = select(pair.label("pair")).order_by(rows.c.id).subquery()
+        return select(func.count(), func.coalesce(func.group_concat(ordered.c.pair, ","), "")).select_from(ordered)
 
     @classmethod
-    def find_by_name(cls, name: str) -> list:
+    @read_only
+    def find_by_name(cls, name: str, limit: int = None, after: int = None) -> list:
         """Returns all Products with the given name
 
         Args:
             name (string): the name of the Products you want to match
+            limit (int): the maximum number of Products to return
+            after (int): only return Products with an id greater than this
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls.paginate(cls.query.filter(cls.name == name), limit, after)
 
     @classmethod
-    def find_by_description(cls, description: str) -> list:
+    @read_only
+    def find_by_description(cls, description: str, limit: int = None, after: int = None) -> list:
         """Returns all Products with the given description
 
         Args:
             description (string): the description of the Products you want to match
+            limit (int): the maximum number of Products to return
+            after (int): only return Products with an id greater than this
         """
         logger.info("Processing description query for %s ...", description)
-        return cls.query.filter(cls.description.ilike(f"%{description}%")).all()
+        query = cls.query.filter(cls.description.ilike(f"%{description}%"))
+        return cls.paginate(query, limit, after).all()
 
     @classmethod
-    def find_by_price(cls, price: Decimal) -> list:
+    @read_only
+    def find_by_price(cls, price: Decimal, limit: int = None, after: int = None) -> list:
         """Returns all Products with the given price
 
         Args:
             price (Decimal): the price of the Products you want to match
+            limit (int): the maximum number of Products to return
+            after (int): only return Products with an id greater than this
         """
         logger.info("Processing price query for %s ...", price)
-        return cls.query.filter(cls.price == price).all()
+        return cls.paginate(cls.query.filter(cls.price == price), limit, after).all()
 
     @classmethod
-    def find_by_availability(cls, available: bool = True) -> list:
+    @read_only
+    def find_by_availability(cls, available: bool = True, limit: int = None, after: int = None) -> list:
         """Returns all Products by their availability
 
         :param available: True for products that are available
         :type available: str
 
+        :param limit: the maximum number of Products to return
+        :type limit: int
+
+        :param after: only return Products with an id greater than this
+        :type after: int
+
         :return: a collection of Products that are available
         :rtype: list
 
@@ -186,4 +702,384 @@ class Product(db.Model):
         # if not isinstance(available, bool):
         #     raise TypeError("Invalid availability, must be of type boolean")
         logger.info("Processing available query for %s ...", available)
-        return cls.query.filter(cls.available == available)
+        return cls.paginate(cls.query.filter(cls.available == available), limit, after)
+
+    ##################################################
+    # BULK WRITES
+    ##################################################
+
+    @classmethod
+    def create_many(cls, items, chunk_size: int = 1000) -> tuple:
+        """Creates Products in bulk, chunk_size Products per statement
+
+        Every chunk is a single INSERT ... ON CONFLICT (name) DO NOTHING
+        RETURNING statement in its own transaction, so a large import takes
+        one round trip and one commit per chunk instead of one per Product.
+        Items that are not valid or whose name is taken are reported and
+        skipped without failing the rest.
+
+        Args:
+            items: an iterable of Product dictionaries, where items that
+                could not be parsed are given as a DataValidationError
+            chunk_size (int): the number of Products written per transaction
+
+        Returns:
+            tuple: for each item in order {"index", "id"} when it was created
+                or {"index", "status", "message"} when it was not, and the
+                size and duration of every chunk
+        """
+        return cls._write_chunks(cls._new_rows(items), chunk_size, cls._insert_rows)
+
+    @classmethod
+    def update_many(cls, items, chunk_size: int = 1000) -> tuple:
+        """Updates Products in bulk by id, or upserts them by name
+
+        Items with an id only change the fields they hold. Items without an
+        id are matched by name: complete Products are upserted with
+        INSERT ... ON CONFLICT (name) DO UPDATE and partial ones change the
+        Product with that name. Each chunk runs as a handful of set-based
+        statements in one transaction without loading any Product.
+
+        Args:
+            items: an iterable of partial Product dictionaries, where items
+                that could not be parsed are given as a DataValidationError
+            chunk_size (int): the number of Products written per transaction
+
+        Returns:
+            tuple: for each item in order {"index", "id"} when it was written
+                or {"index", "status", "message"} when it was not, and the
+                size and duration of every chunk
+        """
+        return cls._write_chunks(cls._changed_rows(items), chunk_size, cls._update_rows)
+
+    @classmethod
+    def delete_many(cls, ids, chunk_size: int = 1000) -> tuple:
+        """Deletes Products in bulk with one DELETE ... WHERE id IN per chunk
+
+        Args:
+            ids: an iterable of Product ids
+            chunk_size (int): the number of Products deleted per transaction
+
+        Returns:
+            tuple: for each id in order {"index", "id", "deleted"}, or
+                {"index", "status", "message"} when it is not a valid id or
+                repeats an earlier one, and the size and duration of every chunk
+        """
+        return cls._write_chunks(cls._parsed_ids(ids), chunk_size, cls._delete_rows)
+
+    @classmethod
+    def parse_changes(cls, data) -> tuple:
+        """Validates a partial Product dictionary
+
+        Returns:
+            tuple: the ("id", id) or ("name", name) key of the Product and the
+                column values to change
+        """
+        if not isinstance(data, dict):
+            raise DataValidationError("Invalid Product: " + str(type(data)))
+        changes = {
+            name: cls._column_value(name, data[name]) for name in cls.FIELDS if name != "id" and name in data
+        }
+        if data.get("id") is not None:
+            key = ("id", cls.parse_id(data["id"]))
+        elif "name" in changes:
+            key = ("name", changes["name"])
+        else:
+            raise DataValidationError("Error: Missing id or name")
+        if not set(changes) - {key[0]}:
+            raise DataValidationError("Error: Missing fields to change")
+        return key, changes
+
+    @classmethod
+    def _column_value(cls, name: str, value):
+        """Validates the value of a single field of a Product"""
+        if name in ("name", "description") and isinstance(value, str) and value:
+            return value
+        if name == "available" and isinstance(value, bool):
+            return value
+        if name == "price":
+            try:
+                price = cls.parse_price(value)
+            except DataValidationError:
+                price = None
+            if price is not None and price >= Decimal("0.00"):
+                return price
+        raise DataValidationError(f"Invalid value for [{name}]: {value!r}")
+
+    @classmethod
+    def insert_statement(cls):
+        """Returns an INSERT of Products that supports ON CONFLICT on the database in use"""
+        if db.session.get_bind().dialect.name == "postgresql":
+            return postgresql.insert(cls.__table__)
+        return sqlite.insert(cls.__table__)
+
+    @classmethod
+    def _new_rows(cls, items):
+        """Yields (index, row) for every valid new Product, or the result of an invalid one"""
+        names = set()
+        for index, data in enumerate(items):
+            try:
+                if isinstance(data, DataValidationError):
+                    raise data
+                product = cls().deserialize(data)
+                if not product.name or product.description is None:
+                    raise DataValidationError("Name and description cannot be empty")
+            except DataValidationError as error:
+                yield {"index": index, "status": 400, "message": str(error)}
+                continue
+            if product.name in names:
+                yield {"index": index, "status": 409, "message": "Product with the same name already exists"}
+                continue
+            names.add(product.name)
+            yield index, {name: getattr(product, name) for name in cls.FIELDS if name != "id"}
+
+    @classmethod
+    def _changed_rows(cls, items):
+        """Yields (index, (key, changes)) for every valid change, or the result of an invalid one"""
+        keys = set()
+        for index, data in enumerate(items):
+            try:
+                if isinstance(data, DataValidationError):
+                    raise data
+                key, changes = cls.parse_changes(data)
+            except DataValidationError as error:
+                yield {"index": index, "status": 400, "message": str(error)}
+                continue
+            if key in keys:
+                yield {"index": index, "status": 409, "message": f"Product with {key[0]} [{key[1]}] is changed twice"}
+                continue
+            keys.add(key)
+            yield index, (key, changes)
+
+    @classmethod
+    def _parsed_ids(cls, ids):
+        """Yields (index, id) for every valid id, or the result of an invalid one"""
+        seen = set()
+        for index, value in enumerate(ids):
+            try:
+                product_id = cls.parse_id(value)
+            except DataValidationError as error:
+                yield {"index": index, "status": 400, "message": str(error)}
+                continue
+            if product_id in seen:
+                yield {"index": index, "status": 409, "message": f"Product [{product_id}] is deleted twice"}
+                continue
+            seen.add(product_id)
+            yield index, product_id
+
+    @classmethod
+    def _write_chunks(cls, entries, chunk_size: int, write) -> tuple:
+        """Writes (index, value) entries chunk_size at a time, one transaction per chunk
+
+        Args:
+            entries: the (index, value) pairs to write, mixed with the
+                results of the items that were rejected before writing
+            chunk_size (int): the number of entries written per transaction
+            write: writes a list of entries and returns their results
+        """
+        results = []
+        timings = []
+        chunk = []
+        for entry in entries:
+            if isinstance(entry, dict):
+                results.append(entry)
+                continue
+            chunk.append(entry)
+            if len(chunk) >= chunk_size:
+                results += cls._write_chunk(chunk, write, timings)
+                chunk = []
+        if chunk:
+            results += cls._write_chunk(chunk, write, timings)
+        results.sort(key=lambda result: result["index"])
+        return results, timings
+
+    @classmethod
+    def _write_chunk(cls, chunk: list, write, timings: list) -> list:
+        """Writes and commits a single chunk, recording how long it took"""
+        started = time.perf_counter()
+        try:
+            results = write(chunk)
+            db.session.commit()
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            if len(chunk) > 1:
+                # write the entries one by one so that only the bad ones fail
+                logger.warning("Error writing %d records, retrying one at a time: %s", len(chunk), error)
+                return [result for entry in chunk for result in cls._write_chunk([entry], write, timings)]
+            logger.error("Error writing %d records: %s", len(chunk), error)
+            message = str(getattr(error, "orig", None) or error)
+            results = [{"index": index, "status": 400, "message": message} for index, _ in chunk]
+        seconds = time.perf_counter() - started
+        timings.append({"size": len(chunk), "seconds": round(seconds, 6)})
+        logger.info("Wrote %d Products with %s in %.3f seconds", len(chunk), write.__name__, seconds)
+        return results
+
+    @classmethod
+    def _insert_rows(cls, chunk: list) -> list:
+        """Inserts new Products, skipping those whose name is taken"""
+        statement = (
+            cls.insert_statement()
+            .on_conflict_do_nothing(index_elements=["name"])
+            .returning(cls.id, cls.name)
+        )
+        # executemany with RETURNING is sent as batched multi-row INSERTs
+        rows = db.session.execute(statement, [row for _, row in chunk])
+        created = {name: product_id for product_id, name in rows}
+        publish_events(db.session, [{"id": product_id, "op": "create", "version": 1} for product_id in created.values()])
+        return [
+            {"index": index, "id": created[row["name"]]}
+            if row["name"] in created
+            else {"index": index, "status": 409, "message": "Product with the same name already exists"}
+            for index, row in chunk
+        ]
+
+    @classmethod
+    def _update_rows(cls, chunk: list) -> list:
+        """Upserts the complete Products of a chunk by name and updates the others"""
+        complete = len(cls.FIELDS) - 1
+        upserts = []
+        updates = []
+        for index, (key, changes) in chunk:
+            if key[0] == "name" and len(changes) == complete:
+                upserts.append((index, changes))
+            else:
+                updates.append((index, key, changes))
+        return cls._upsert_rows(upserts) + cls._update_by_key(updates)
+
+    @classmethod
+    def _upsert_rows(cls, upserts: list) -> list:
+        """Inserts Products or updates the ones with the same name"""
+        if not upserts:
+            return []
+        table = cls.__table__
+        statement = cls.insert_statement()
+        statement = statement.on_conflict_do_update(
+            index_elements=["name"],
+            set_={
+                "description": statement.excluded.description,
+                "price": statement.excluded.price,
+                "available": statement.excluded.available,
+                "version": table.c.version + 1,
+            },
+        ).returning(table.c.id, table.c.name, table.c.version)
+        rows = db.session.execute(statement, [changes for _, changes in upserts]).all()
+        publish_events(
+            db.session,
+            [{"id": product_id, "op": "create" if version == 1 else "update", "version": version}
+             for product_id, _, version in rows],
+        )
+        written = {name: product_id for product_id, name, _ in rows}
+        return [{"index": index, "id": written[changes["name"]]} for index, changes in upserts]
+
+    @classmethod
+    def _update_by_key(cls, updates: list) -> list:
+        """Updates Products by id or name with one executemany UPDATE per set of changed columns"""
+        if not updates:
+            return []
+        table = cls.__table__
+        found = cls._ids_by_key([key for _, key, _ in updates])
+        results = []
+        groups = {}
+        for index, key, changes in updates:
+            if key in found:
+                groups.setdefault((key[0], tuple(sorted(changes))), []).append((index, key, changes))
+            else:
+                results.append({"index": index, "status": 404, "message": f"Product with {key[0]} [{key[1]}] was not found"})
+        for (column, names), group in groups.items():
+            values = {name: bindparam(f"new_{name}") for name in names}
+            values["version"] = table.c.version + 1
+            statement = update(table).where(table.c[column] == bindparam("key")).values(values)
+            db.session.execute(
+                statement,
+                [{"key": key[1], **{f"new_{name}": changes[name] for name in names}} for _, key, changes in group],
+            )
+            results += [{"index": index, "id": found[key]} for index, key, _ in group]
+        events = [{"id": result["id"], "op": "update", "version": None} for result in results if "id" in result]
+        publish_events(db.session, events)
+        return results
+
+    @classmethod
+    def _ids_by_key(cls, keys: list) -> dict:
+        """Returns the ids of the Products with the given ("id", id) or ("name", name) keys"""
+        ids = [value for column, value in keys if column == "id"]
+        names = [value for column, value in keys if column == "name"]
+        found = {}
+        if ids:
+            rows = db.session.scalars(select(cls.id).where(cls.id.in_(ids)))
+            found.update({("id", product_id): product_id for product_id in rows})
+        if names:
+            rows = db.session.execute(select(cls.id, cls.name).where(cls.name.in_(names)))
+            found.update({("name", name): product_id for product_id, name in rows})
+        return found
+
+    @classmethod
+    def _delete_rows(cls, chunk: list) -> list:
+        """Deletes the Products of a chunk of ids"""
+        table = cls.__table__
+        statement = delete(table).where(table.c.id.in_([product_id for _, product_id in chunk])).returning(table.c.id)
+        deleted = set(db.session.scalars(statement))
+        publish_events(db.session, [{"id": product_id, "op": "delete", "version": None} for product_id in deleted])
+        return [{"index": index, "id": product_id, "deleted": product_id in deleted} for index, product_id in chunk]
+
+
+# Trigram indexes need the pg_trgm extension before the table is created
+event.listen(
+    Product.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+
+
+######################################################################
+# Change events
+######################################################################
+
+
+def product_events(session) -> list:
+    """Returns a change event for every Product that a flush is writing"""
+    changes = [(product, "create") for product in session.new]
+    changes += [(product, "update") for product in session.dirty if session.is_modified(product)]
+    changes += [(product, "delete") for product in session.deleted]
+    return [
+        {"id": product.id, "op": op, "version": product.version}
+        for product, op in changes
+        if isinstance(product, Product)
+    ]
+
+
+def publish_events(session, events: list):
+    """Publishes change events as part of the transaction of the session"""
+    broker = current_app.extensions.get("change_broker")
+    if events and broker:
+        broker.publish(session, events)
+
+
+@event.listens_for(db.session, "after_flush")
+def publish_product_changes(session, _flush_context):
+    """Publishes the Products written by a flush in its transaction"""
+    publish_events(session, product_events(session))
+
+
+@event.listens_for(db.session, "after_commit")
+def deliver_product_changes(session):
+    """Delivers the published changes once their transaction has committed"""
+    broker = current_app.extensions.get("change_broker")
+    if broker:
+        broker.committed(session)
+
+
+@event.listens_for(db.session, "after_soft_rollback")
+def discard_product_changes(session, _previous_transaction):
+    """Forgets the published changes of a transaction that was rolled back"""
+    broker = current_app.extensions.get("change_broker")
+    if broker:
+        broker.rolled_back(session)
+
+
+def evict_cached_products(events: list):
+    """Evicts the Products of change events from the product cache"""
+    for change in events:
+        if change["op"] == "reset":
+            product_cache.clear()
+        else:
+            product_cache.invalidate(change["id"])
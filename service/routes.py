@@ -22,18 +22,36 @@ Paths:
 ------
 GET / - Displays a UI for Selenium testing
 GET /products - Returns a list all of the Products
+GET /products?limit={n}&cursor={cursor} - Returns a page of Products
+GET /products?name=&description=&available=&price=&price_min=&price_max= - Returns the
+    Products that match all of the given filters, optionally with sort= and fields=
+GET /products?search={term} - Returns the Products that best match a search term
+GET /products?stream=true - Streams all of the Products as a chunked JSON array
+GET /products (Accept: application/x-ndjson) - Streams Products one per line
+GET /products?ids={id},{id} - Returns the Products with the given ids in that order
+POST /products:lookup - Returns the Products with the posted ids and the missing ids
 GET /products/{id} - Returns the Product with a given id number
 POST /products - creates a new Product record in the database
 PUT /products/{id} - updates a Product record in the database
 DELETE /products/{id} - deletes a Product record in the database
 """
 
+import json
 from decimal import Decimal
 from flask import current_app as app  # Import Flask application
-from flask import jsonify
-from flask_restx import Resource, fields, reqparse, inputs
-from service.models import Product
+from flask import jsonify, make_response, request, Response, stream_with_context
+from flask_restx import Resource, fields, reqparse, inputs, marshal
+from werkzeug.http import quote_etag
+from service.models import DataValidationError, Product, db, product_cache
 from service.common import status  # HTTP Status Codes
+from service.common.contract import (
+    FILTERS, JSON, MISSING_IDS_HEADER, NDJSON, PRODUCT_FIELDS, collection_etag, decode_cursor, dumps, encode_cursor,
+    etag_versions, column_fields, lookup_conflicts, lookup_fingerprint, mask_fields, product_document, product_etag
+)
+from service.common.compression import compression
+from service.common.pool_metrics import pool_metrics
+from service.common.replicas import replicas
+from service.common.timing import timing
 from . import api
 
 
@@ -43,7 +61,16 @@ from . import api
 @app.route("/health")
 def health_check():
     """Let them know our heart is still beating"""
-    return jsonify(status=200, message="Healthy"), status.HTTP_200_OK
+    return (
+        jsonify(
+            status=200,
+            message="Healthy",
+            cache=product_cache.stats(),
+            pool=pool_metrics.stats(db.engine.pool),
+            replicas=replicas.stats(),
+        ),
+        status.HTTP_200_OK,
+    )
 
 
 ######################################################################
@@ -52,7 +79,19 @@ def health_check():
 @app.route("/")
 def index():
     """Index page"""
-    return app.send_static_file("index.html")
+    response = make_response(compression.static_page("index.html"))
+    # the page names the current versions of the static files, so it is always revalidated
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.after_request
+def vary_on_field_mask(response):
+    """Tells caches that the Products of GET requests depend on the field mask header"""
+    if request.endpoint in ("product_collection", "product_resource") and request.method in ("GET", "HEAD"):
+        response.vary.add(app.config["RESTX_MASK_HEADER"])
+    return response
 
 
 # Define the model so that the docs reflect what can be sent
@@ -82,6 +121,22 @@ product_model = api.inherit(
     },
 )
 
+lookup_model = api.model(
+    "ProductLookup",
+    {
+        "ids": fields.List(fields.Integer, required=True, description="The ids of the Products to find"),
+        "fields": fields.List(fields.String, required=False, description="The fields to return for each Product"),
+    },
+)
+
+lookup_result_model = api.model(
+    "ProductLookupResult",
+    {
+        "products": fields.List(fields.Nested(product_model), description="The Products found, in the order of ids"),
+        "missing": fields.List(fields.Integer, description="The ids of the Products that were not found"),
+    },
+)
+
 # query string arguments
 product_args = reqparse.RequestParser()
 product_args.add_argument(
@@ -100,6 +155,64 @@ product_args.add_argument(
 product_args.add_argument(
     "price", type=Decimal, location="args", required=False, help="List Products by price"
 )
+product_args.add_argument(
+    "price_min", type=Decimal, location="args", required=False, help="List Products priced at least this"
+)
+product_args.add_argument(
+    "price_max", type=Decimal, location="args", required=False, help="List Products priced at most this"
+)
+product_args.add_argument(
+    "search",
+    type=str,
+    location="args",
+    required=False,
+    help="Search Product descriptions, best matches first unless sort is given",
+)
+product_args.add_argument(
+    "ids",
+    type=str,
+    action="split",
+    location="args",
+    required=False,
+    help="Comma separated ids of the Products to return, in that order",
+)
+product_args.add_argument(
+    "sort",
+    type=str,
+    action="split",
+    location="args",
+    required=False,
+    help="Comma separated fields to sort by, prefix a field with - to sort descending",
+)
+product_args.add_argument(
+    "fields",
+    type=str,
+    action="split",
+    location="args",
+    required=False,
+    help="Comma separated fields to return for each Product",
+)
+product_args.add_argument(
+    "limit",
+    type=inputs.int_range(1, app.config["PAGE_SIZE_MAX"]),
+    location="args",
+    required=False,
+    help="The maximum number of Products to return in one page",
+)
+product_args.add_argument(
+    "cursor",
+    type=decode_cursor,
+    location="args",
+    required=False,
+    help="The opaque cursor from the Link header of the previous page",
+)
+product_args.add_argument(
+    "stream",
+    type=inputs.boolean,
+    location="args",
+    required=False,
+    help="Stream the Products as a chunked JSON array while they are read",
+)
 
 
 ######################################################################
@@ -122,7 +235,8 @@ class ProductResource(Resource):
     # ------------------------------------------------------------------
     @api.doc("get_products")
     @api.response(404, "Product not found")
-    @api.marshal_with(product_model)
+    @api.response(304, "Product not modified since the ETag in If-None-Match")
+    @api.response(200, "Success", product_model)
     def get(self, product_id):
         """
         Retrieve a single Product
@@ -130,10 +244,17 @@ class ProductResource(Resource):
         This endpoint will return a Product based on it's id
         """
         app.logger.info("Request to Retrieve a product with id [%s]", product_id)
-        product = Product.find(product_id)
-        if not product:
+        with timing.measure("fetch"):
+            found = Product.find_serialized(product_id)
+        if not found:
             abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
-        return product.serialize(), status.HTTP_200_OK
+        product, version = found
+        etag = product_etag(product["id"], version, selected_fields())
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        with timing.measure("marshal"):
+            document = marshal_products(product)
+        return document, status.HTTP_200_OK, {"ETag": quote_etag(etag)}
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING PRODUCT
@@ -141,6 +262,8 @@ class ProductResource(Resource):
     @api.doc("update_products")
     @api.response(404, "Product not found")
     @api.response(400, "The posted Product data was not valid")
+    @api.response(409, "The Product was changed by another request")
+    @api.response(412, "The Product no longer matches the ETag in If-Match")
     @api.expect(product_model)
     @api.marshal_with(product_model)
     def put(self, product_id):
@@ -154,13 +277,14 @@ class ProductResource(Resource):
         product = Product.find(product_id)
         if not product:
             abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        check_if_match(product)
         app.logger.debug("Payload = %s", api.payload)
         data = api.payload
         product.deserialize(data)
-        product.id = product_id
+        product.id = Product.parse_id(product_id)
         product.update()
         app.logger.info("Product with ID: %d updated.", product.id)
-        return product.serialize(), status.HTTP_200_OK
+        return product.serialize(), status.HTTP_200_OK, etag_header(product)
 
     # ------------------------------------------------------------------
     # DELETE A PRODUCT
@@ -194,31 +318,54 @@ class ProductCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_products")
     @api.expect(product_args, validate=True)
-    @api.marshal_list_with(product_model)
+    @api.produces([JSON, NDJSON])
+    @api.response(304, "Products not modified since the ETag in If-None-Match")
+    @api.response(200, "Success", [product_model])
     def get(self):
-        """Returns all of the Products"""
+        """Returns all of the Products
+
+        Send an Accept header of application/x-ndjson to receive one Product
+        per line, or stream=true to receive a JSON array. Streamed listings are
+        written out chunk by chunk while they are being read from the database.
+        """
         app.logger.info("Request to list Products...")
-        products = []
         args = product_args.parse_args()
-        if args["description"]:
-            app.logger.info("Filtering by description: %s", args["description"])
-            products = Product.find_by_description(args["description"])
-        elif args["name"]:
-            app.logger.info("Filtering by name: %s", args["name"])
-            products = Product.find_by_name(args["name"])
-        elif args["available"]:
-            app.logger.info("Filtering by availability: %s", args["available"])
-            products = Product.find_by_availability(args["available"])
-        elif args["price"]:
-            app.logger.info("Filtering by price: %s", args["price"])
-            products = Product.find_by_price(Decimal(args["price"]))
-        else:
-            app.logger.info("Returning unfiltered list.")
-            products = Product.all()
-
-        # app.logger.info("[%s] Products returned", len(products))
-        results = [product.serialize() for product in products]
-        return results, status.HTTP_200_OK
+        if args["ids"] is not None:
+            return list_by_ids(args)
+        filters = {name: args[name] for name in FILTERS if args[name] is not None}
+        app.logger.info("Filtering by: %s", filters)
+        selected = selected_fields(args["fields"])
+        columns = column_fields(selected)
+        query = Product.find_by_filters(
+            filters,
+            sort=args["sort"],
+            fields=columns,
+            limit=args["limit"],
+            after=args["cursor"],
+        )
+        mimetype = request.accept_mimetypes.best_match([JSON, NDJSON])
+        etag = collection_etag(Product.fingerprint(query), mimetype, request.query_string.decode(), selected)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        names = (selected or list(PRODUCT_FIELDS)) if app.config["FAST_JSON"] else None
+        if mimetype == NDJSON or args["stream"]:
+            response = stream_products(query, selected, mimetype, names)
+            response.set_etag(etag)
+            return response
+        if names is not None:
+            return list_rows(query, args, names, etag)
+
+        with timing.measure("fetch"):
+            products = query.all()
+        app.logger.info("[%s] Products returned", len(products))
+        with timing.measure("serialize"):
+            results = [product.serialize(columns) for product in products]
+        last_key = products[-1].sort_key(args["sort"]) if products else None
+        headers = next_page_headers(len(products), last_key, args)
+        headers["ETag"] = quote_etag(etag)
+        with timing.measure("marshal"):
+            documents = marshal_products(results, selected)
+        return documents, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW PRODUCT
@@ -262,6 +409,102 @@ class ProductCollection(Resource):
     #     return "", status.HTTP_204_NO_CONTENT
 
 
+######################################################################
+#  PATH: /products:batch
+######################################################################
+@api.route("/products:batch")
+class ProductBatch(Resource):
+    """Handles writes of many Products in a single request"""
+
+    # ------------------------------------------------------------------
+    # ADD MANY NEW PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc("create_products_batch")
+    @api.expect([create_model])
+    @api.response(201, "All of the Products were created")
+    @api.response(207, "Some of the Products could not be created")
+    @api.response(400, "The posted data was not a list of Products")
+    def post(self):
+        """
+        Creates many Products
+
+        This endpoint takes a JSON array of Products, or one Product per line
+        with a Content-Type of application/x-ndjson, and reports the id or
+        the error of every one of them in the order they were posted
+        """
+        app.logger.info("Request to Create a batch of Products")
+        results, chunks = Product.create_many(batch_items(), app.config["BATCH_CHUNK_SIZE"])
+        return batch_response("created", results, chunks, status.HTTP_201_CREATED)
+
+    # ------------------------------------------------------------------
+    # UPDATE OR UPSERT MANY PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc("update_products_batch")
+    @api.response(200, "All of the Products were updated")
+    @api.response(207, "Some of the Products could not be updated")
+    @api.response(400, "The posted data was not a list of Products")
+    def patch(self):
+        """
+        Updates many Products
+
+        This endpoint takes a JSON array, or NDJSON, of partial Products.
+        Products with an id only change the fields that are posted, the
+        others are matched by name and created when they are complete and
+        no Product has that name yet
+        """
+        app.logger.info("Request to Update a batch of Products")
+        results, chunks = Product.update_many(batch_items(), app.config["BATCH_CHUNK_SIZE"])
+        return batch_response("updated", results, chunks, status.HTTP_200_OK)
+
+    # ------------------------------------------------------------------
+    # DELETE MANY PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc("delete_products_batch")
+    @api.response(200, "The Products were deleted")
+    @api.response(207, "Some of the ids were not valid")
+    @api.response(400, "The posted data was not a list of ids")
+    def delete(self):
+        """
+        Deletes many Products
+
+        This endpoint takes a JSON array, or NDJSON, of Product ids and
+        reports whether each of them was deleted
+        """
+        app.logger.info("Request to Delete a batch of Products")
+        results, chunks = Product.delete_many(batch_items(), app.config["BATCH_CHUNK_SIZE"])
+        return batch_response("deleted", results, chunks, status.HTTP_200_OK)
+
+
+######################################################################
+#  PATH: /products:lookup
+######################################################################
+@api.route("/products:lookup")
+class ProductLookup(Resource):
+    """Finds many Products by id in a single request"""
+
+    @api.doc("lookup_products")
+    @api.expect(lookup_model)
+    @api.response(200, "The Products that were found and the ids that were not", lookup_result_model)
+    @api.response(400, "The posted data was not a list of ids")
+    def post(self):
+        """
+        Finds many Products
+
+        This endpoint takes a JSON object with a list of ids, and optionally
+        of fields, and returns the Products in the order of the ids together
+        with the ids of the Products that do not exist
+        """
+        app.logger.info("Request to Look up Products")
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("ids"), list):
+            raise DataValidationError("Expected a JSON object with a list of ids")
+        if not isinstance(data.get("fields", []), list):
+            raise DataValidationError("Expected a list of fields")
+        documents, missing, _ = lookup_products(data["ids"], data.get("fields"))
+        body = dumps({"products": documents, "missing": missing})
+        return Response(body, status.HTTP_200_OK, mimetype=JSON)
+
+
 ######################################################################
 #  PATH: /products/{id}/purchase
 ######################################################################
@@ -273,6 +516,7 @@ class PurchaseResource(Resource):
     @api.doc("purchase_products")
     @api.response(404, "Product not found")
     @api.response(409, "The Product is not available for purchase")
+    @api.response(412, "The Product no longer matches the ETag in If-Match")
     def put(self, product_id):
         """
         Purchase a Product
@@ -280,15 +524,16 @@ class PurchaseResource(Resource):
         This endpoint will purchase a Product and make it unavailable
         """
         app.logger.info("Request to Purchase a Product")
-        product = Product.find(product_id)
+        product = Product.purchase(product_id, if_match_versions(product_id))
         if not product:
-            abort(status.HTTP_404_NOT_FOUND, f"Product with id [{product_id}] was not found.")
-        if not product.available:
+            # only a failed purchase reads the Product to tell why it failed
+            product = Product.find(product_id)
+            if not product:
+                abort(status.HTTP_404_NOT_FOUND, f"Product with id [{product_id}] was not found.")
+            check_if_match(product)
             abort(status.HTTP_409_CONFLICT, f"Product with id [{product_id}] is not available.")
-        product.available = False
-        product.update()
         app.logger.info("Product with id [%s] has been purchased!", product.id)
-        return product.serialize(), status.HTTP_200_OK
+        return product.serialize(), status.HTTP_200_OK, etag_header(product)
 
 
 ######################################################################
@@ -302,6 +547,204 @@ def abort(error_code: int, message: str):
     api.abort(error_code, message)
 
 
+def batch_items():
+    """Returns the items of a batch request, read line by line when it is NDJSON"""
+    if request.mimetype == NDJSON:
+        return ndjson_items(request.stream)
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        raise DataValidationError("Expected a JSON array")
+    return items
+
+
+def batch_response(action: str, results: list, chunks: list, code: int):
+    """Returns the results of a batch request, with 207 when some of them failed"""
+    failed = sum(1 for result in results if "message" in result)
+    done = sum(1 for result in results if result.get("deleted", "id" in result))
+    app.logger.info("Batch of %d Products %s with %d failures", done, action, failed)
+    body = {action: done, "failed": failed, "results": results, "chunks": chunks}
+    return body, status.HTTP_207_MULTI_STATUS if failed else code
+
+
+def ndjson_items(stream):
+    """Yields the documents of an NDJSON request body while it is being read"""
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as error:
+            yield DataValidationError(f"Invalid JSON: {error}")
+
+
+def marshal_products(data, product_fields: list = None):
+    """Marshals Products honoring the selected fields or the field mask header"""
+    if product_fields:
+        mask = ",".join(product_fields)
+    else:
+        mask = request.headers.get(app.config["RESTX_MASK_HEADER"])
+    return marshal(data, product_model, mask=mask)
+
+
+def selected_fields(product_fields: list = None) -> list:
+    """Returns the fields selected with the fields argument or the field mask header
+
+    Only these columns are read from the database, so a client that sends
+    fields=id,name or X-Fields: {id,name} never loads the description.
+    Returns None when every field is wanted.
+    """
+    if product_fields:
+        return product_fields
+    mask = request.headers.get(app.config["RESTX_MASK_HEADER"])
+    return mask_fields(mask) if mask else None
+
+
+def list_by_ids(args: dict) -> Response:
+    """Lists the Products of the ids argument in its order, naming the missing ones in a header"""
+    conflicts = lookup_conflicts(args)
+    if conflicts:
+        raise DataValidationError(f"ids cannot be combined with {', '.join(conflicts)}")
+    documents, missing, fingerprint = lookup_products(args["ids"], args["fields"])
+    etag = collection_etag(fingerprint, JSON, request.query_string.decode(), selected_fields(args["fields"]))
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    headers = {"ETag": quote_etag(etag)}
+    if missing:
+        headers[MISSING_IDS_HEADER] = ",".join(map(str, missing))
+    with timing.measure("serialize"):
+        body = dumps(documents)
+    return Response(body, status.HTTP_200_OK, headers, mimetype=JSON)
+
+
+def lookup_products(ids: list, product_fields: list = None) -> tuple:
+    """Finds Products by id, from the product cache first
+
+    Returns:
+        tuple: the Product documents in the order of ids, the missing ids and
+            the fingerprint of the Products that were found
+    """
+    if len(ids) > app.config["PAGE_SIZE_MAX"]:
+        raise DataValidationError(f"Cannot look up more than {app.config['PAGE_SIZE_MAX']} ids at once")
+    names = selected_fields(product_fields) or list(PRODUCT_FIELDS)
+    Product.parse_fields(column_fields(names))
+    with timing.measure("fetch"):
+        found, missing = Product.find_many(ids)
+    app.logger.info("[%s] Products found, [%s] missing", len(found), len(missing))
+    with timing.measure("serialize"):
+        documents = [product_document(product, names) for product, _ in found]
+    return documents, missing, lookup_fingerprint(found)
+
+
+def list_rows(query, args: dict, names: list, etag: str) -> Response:
+    """Lists Products straight from row tuples, without Product objects or marshal()"""
+    statement, columns = Product.select_rows(query, column_fields(names), args["sort"])
+    with timing.measure("fetch"):
+        rows = Product.fetch_rows(statement, columns)
+    app.logger.info("[%s] Products returned", len(rows))
+    last_key = Product.row_sort_key(rows[-1], args["sort"]) if rows else None
+    headers = next_page_headers(len(rows), last_key, args)
+    headers["ETag"] = quote_etag(etag)
+    with timing.measure("serialize"):
+        body = dumps([product_document(row, names) for row in rows])
+    return Response(body, status.HTTP_200_OK, headers, mimetype=JSON)
+
+
+def stream_products(query, product_fields: list, mimetype: str, names: list = None) -> Response:
+    """Streams Products as NDJSON or as a JSON array while they are read
+
+    Args:
+        query: the query of Products to stream
+        product_fields (list): the selected fields, or None for all of them
+        mimetype (str): NDJSON for one Product per line, otherwise a JSON array
+        names (list): the fields to write from row tuples, or None to marshal Products
+    """
+    chunk_size = app.config["STREAM_CHUNK_SIZE"]
+    if names is None:
+        pages = (
+            marshal_products([product.serialize(column_fields(product_fields)) for product in page], product_fields)
+            for page in Product.iter_chunks(query, chunk_size)
+        )
+    else:
+        statement, columns = Product.select_rows(query, column_fields(names))
+        pages = (
+            [product_document(dict(zip(columns, row)), names) for row in page]
+            for page in Product.iter_row_chunks(statement, chunk_size)
+        )
+    if mimetype == NDJSON:
+        body = ndjson_lines(pages)
+    else:
+        mimetype = JSON
+        body = json_array(pages)
+    return Response(stream_with_context(body), status.HTTP_200_OK, mimetype=mimetype)
+
+
+def ndjson_lines(pages):
+    """Writes one JSON document per line for each page of Products"""
+    for page in pages:
+        yield b"".join(dumps(document) + b"\n" for document in page)
+
+
+def json_array(pages):
+    """Writes a JSON array one page of Products at a time"""
+    separator = b"["
+    for page in pages:
+        yield separator + b",".join(dumps(document) for document in page)
+        separator = b","
+    yield b"]" if separator == b"," else b"[]"
+
+
+def etag_header(product: Product) -> dict:
+    """Returns the ETag header of a Product that was just written"""
+    return {"ETag": quote_etag(product_etag(product.id, product.version))}
+
+
+def check_if_match(product: Product):
+    """Aborts with 412 when If-Match does not name the current version of the Product
+
+    Without an If-Match header the write goes ahead, and it is still only
+    applied if the Product was not changed since it was read.
+    """
+    versions = etag_versions(request.if_match, product.id)
+    if versions is not None and product.version not in versions:
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Product with id [{product.id}] does not match the ETag in If-Match.",
+        )
+
+
+def if_match_versions(product_id) -> list:
+    """Returns the versions of a Product named in If-Match, or None if any version will do"""
+    return etag_versions(request.if_match, Product.parse_id(product_id))
+
+
+def not_modified(etag: str) -> Response:
+    """Tells the client that its copy with this ETag is still current"""
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+
+def next_page_headers(count: int, last_key, args: dict) -> dict:
+    """Returns a Link header pointing at the next page of Products
+
+    There is no next page when the client did not ask for one, when this
+    page came back short of the limit, or when it holds ranked search results.
+
+    Args:
+        count (int): the number of Products on this page
+        last_key: the sort_key of the last Product on this page
+        args (dict): the parsed query string arguments
+    """
+    if not args["limit"] or count < args["limit"]:
+        return {}
+    if args["search"] and not args["sort"]:
+        return {}
+    params = request.args.to_dict()
+    params["cursor"] = encode_cursor(last_key)
+    next_url = api.url_for(ProductCollection, _external=True, **params)
+    return {"Link": f'<{next_url}>; rel="next"'}
+
+
 def data_reset():
     """Removes all Products from the database"""
     Product.remove_all()
@@ -4,8 +4,11 @@ Test Factory to make fake objects for testing
 
 import factory
 from factory.fuzzy import FuzzyDecimal, FuzzyChoice
+from faker import Faker
 from service.models import Product
 
+FAKE = Faker()
+
 
 class ProductFactory(factory.Factory):
     """Creates fake products for testing"""
@@ -16,7 +19,8 @@ class ProductFactory(factory.Factory):
         model = Product
 
     id = factory.Sequence(lambda n: n)
-    name = factory.Faker("word")
+    # the sequence number keeps names unique, which the name column requires
+    name = factory.Sequence(lambda n: f"{FAKE.word()}-{n}")
     description = factory.Faker("sentence", nb_words=6)
     price = FuzzyDecimal(1.0, 100.0)
     available = FuzzyChoice(choices=[True, False])
@@ -0,0 +1,74 @@
+"""
+Test cases for the in-process TTL cache
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+from service.common.cache import TTLCache
+
+
+######################################################################
+#  T T L   C A C H E   T E S T   C A S E S
+######################################################################
+class TestTTLCache(TestCase):
+    """Test Cases for TTLCache"""
+
+    def setUp(self):
+        self.cache = TTLCache(max_size=2, ttl=10)
+
+    def test_get_and_set(self):
+        """It should return cached values and count hits and misses"""
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, {"id": 1})
+        self.assertEqual(self.cache.get(1), {"id": 1})
+        self.assertEqual(self.cache.stats(), {"size": 1, "max_size": 2, "hits": 1, "misses": 1})
+
+    def test_evict_least_recently_used(self):
+        """It should evict the least recently used entry when full"""
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.get(1)
+        self.cache.set(3, "three")
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), "one")
+        self.assertEqual(self.cache.get(3), "three")
+
+    @patch("service.common.cache.time.monotonic")
+    def test_expire_entries(self, monotonic_mock):
+        """It should expire entries after their time to live"""
+        monotonic_mock.return_value = 100.0
+        self.cache.set(1, "one")
+        monotonic_mock.return_value = 109.0
+        self.assertEqual(self.cache.get(1), "one")
+        monotonic_mock.return_value = 111.0
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_invalidate(self):
+        """It should remove invalidated entries"""
+        self.cache.set(1, "one")
+        self.cache.invalidate(1)
+        self.cache.invalidate(2)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_skip_stale_set(self):
+        """It should not cache a value loaded before an invalidation"""
+        generation = self.cache.generation
+        self.cache.invalidate(1)
+        self.cache.set(1, "stale", generation)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, "fresh", self.cache.generation)
+        self.assertEqual(self.cache.get(1), "fresh")
+
+    def test_disabled(self):
+        """It should not cache anything when the size is zero"""
+        cache = TTLCache(max_size=0)
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
+
+    def test_clear(self):
+        """It should remove every entry and reset the counters"""
+        self.cache.set(1, "one")
+        self.cache.get(1)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats(), {"size": 0, "max_size": 2, "hits": 0, "misses": 0})
@@ -0,0 +1,62 @@
+"""
+Test cases for the parts of the API contract shared by both services
+"""
+from unittest import TestCase
+from unittest.mock import patch
+from werkzeug.http import parse_etags
+from service.common import contract
+
+
+######################################################################
+#  C O N T R A C T   T E S T   C A S E S
+######################################################################
+class TestContract(TestCase):
+    """Test Cases for the cursors, ETags and Product documents"""
+
+    def test_cursor_round_trip(self):
+        """It should decode the sort keys that it encodes"""
+        for sort_key in (7, ["1.50", "apple", 7]):
+            self.assertEqual(contract.decode_cursor(contract.encode_cursor(sort_key)), sort_key)
+        for cursor in ("not-a-cursor", contract.encode_cursor(True), contract.encode_cursor("7")):
+            self.assertRaises(ValueError, contract.decode_cursor, cursor)
+
+    def test_etag_versions(self):
+        """It should read the versions of a Product out of If-Match"""
+        self.assertIsNone(contract.etag_versions(parse_etags(None), 7))
+        self.assertIsNone(contract.etag_versions(parse_etags("*"), 7))
+        self.assertEqual(contract.etag_versions(parse_etags('"7-2", "8-3", "7-x"'), 7), [2])
+        masked = contract.product_etag(7, 3, ["id", "name"])
+        self.assertEqual(contract.etag_versions(parse_etags(f'"{masked}"'), 7), [3])
+
+    def test_etags_of_masked_products(self):
+        """It should give the Products masked down to some fields ETags of their own"""
+        self.assertEqual(contract.product_etag(7, 3), "7-3")
+        self.assertEqual(contract.product_etag(7, 3, contract.PRODUCT_FIELDS), "7-3")
+        self.assertNotEqual(contract.product_etag(7, 3, ["id"]), "7-3")
+        self.assertEqual(contract.product_etag(7, 3, ["name", "id"]), contract.product_etag(7, 3, ["id", "name"]))
+        fingerprint = (2, "7:3,9:2")
+        self.assertNotEqual(
+            contract.collection_etag(fingerprint, contract.JSON, "", ["id"]),
+            contract.collection_etag(fingerprint, contract.JSON, ""),
+        )
+
+    def test_mask_fields(self):
+        """It should keep the known fields of a field mask in its order"""
+        self.assertEqual(contract.mask_fields("{price, id}"), ["price", "id"])
+        self.assertEqual(contract.mask_fields("name,color"), ["name"])
+
+    def test_product_document(self):
+        """It should write a Product like marshal() does"""
+        values = {"id": 1, "name": "apple", "price": "1.50", "available": True}
+        self.assertEqual(
+            contract.product_document(values, contract.PRODUCT_FIELDS),
+            {"_id": None, "id": 1, "name": "apple", "description": None, "available": True, "price": 1.5},
+        )
+        self.assertEqual(contract.product_document(values, ["name"]), {"name": "apple"})
+
+    def test_dumps(self):
+        """It should encode the same JSON with or without orjson"""
+        data = [{"id": 1, "name": "äpple", "price": 1.5, "available": True, "_id": None}]
+        encoded = contract.dumps(data)
+        with patch.object(contract, "orjson", None):
+            self.assertEqual(contract.dumps(data), encoded)
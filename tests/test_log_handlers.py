@@ -0,0 +1,152 @@
+"""
+Test cases for the log handlers
+"""
+
+import io
+import json
+import logging
+from unittest import TestCase
+from flask import Flask
+from service.common.log_handlers import BackgroundHandler, JsonFormatter, RequestFilter, init_logging, stop_listener
+
+
+class RecordingHandler(logging.Handler):
+    """Keeps the records that it handles and the lines that it formats"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.lines = []
+
+    def emit(self, record):
+        self.records.append(record)
+        self.lines.append(self.format(record))
+
+
+def logging_app(**config) -> Flask:
+    """Returns a small app with a products route and the given logging settings"""
+    app = Flask(__name__)
+    app.config.update(config)
+    app.add_url_rule("/products", "product_collection", lambda: "", methods=["GET", "POST"])
+    app.add_url_rule("/products/<int:product_id>", "product_resource", lambda product_id: "")
+    return app
+
+
+######################################################################
+#  L O G   H A N D L E R S   T E S T   C A S E S
+######################################################################
+class TestLogHandlers(TestCase):
+    """Test Cases for the log handlers"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.handler = RecordingHandler()
+        self.sink = logging.getLogger("tests.log_sink")
+        self.sink.setLevel(logging.INFO)
+        self.sink.handlers = [self.handler]
+        # init_logging also sets up the flask.app logger of the other modules
+        shared = logging.getLogger("flask.app")
+        state = (shared.handlers, shared.filters, shared.level, shared.propagate)
+        self.addCleanup(self._restore, shared, state)
+
+    @staticmethod
+    def _restore(logger: logging.Logger, state: tuple):
+        """Puts back the handlers, filters, level and propagation of a logger"""
+        logger.handlers, logger.filters, level, logger.propagate = state
+        logger.setLevel(level)
+
+    def test_json_format(self):
+        """It should write a record as one JSON document with its route and exception"""
+        error = ValueError("bad price")
+        record = logging.LogRecord("service", logging.ERROR, __file__, 1, "Price %s", ("1.x",), (ValueError, error, None))
+        record.route = "POST product_collection"
+        document = json.loads(JsonFormatter().format(record))
+        self.assertEqual(document["level"], "ERROR")
+        self.assertEqual(document["message"], "Price 1.x")
+        self.assertEqual(document["route"], "POST product_collection")
+        self.assertIn("ValueError: bad price", document["exception"])
+        self.assertTrue(document["time"].endswith("+00:00"))
+
+    def test_sample_info_lines_per_route(self):
+        """It should keep every info line of 1 in N requests of a route, and every warning"""
+        app = logging_app()
+        log_filter = RequestFilter({"product_collection": 2})
+
+        def kept(path: str, lines: int = 2) -> list:
+            with app.test_request_context(path):
+                records = [logging.LogRecord("service", logging.INFO, __file__, 1, "line", (), None) for _ in range(lines)]
+                warning = logging.LogRecord("service", logging.WARNING, __file__, 1, "slow", (), None)
+                self.assertTrue(log_filter.filter(warning))
+                self.assertEqual(warning.route, "GET product_collection")
+                return [log_filter.filter(record) for record in records]
+
+        self.assertEqual(kept("/products"), [True, True])
+        self.assertEqual(kept("/products"), [False, False])
+        self.assertEqual(kept("/products"), [True, True])
+        with app.test_request_context("/products/1"):
+            self.assertTrue(log_filter.filter(logging.LogRecord("service", logging.INFO, __file__, 1, "", (), None)))
+        self.assertTrue(log_filter.filter(logging.LogRecord("service", logging.INFO, __file__, 1, "", (), None)))
+
+    def test_default_sample_rate(self):
+        """It should sample the routes that are not named at the * rate"""
+        app = logging_app()
+        log_filter = RequestFilter({"*": 3, "product_collection": 1})
+        results = []
+        for _ in range(3):
+            with app.test_request_context("/products/1"):
+                results.append(log_filter.filter(logging.LogRecord("service", logging.INFO, __file__, 1, "", (), None)))
+            with app.test_request_context("/products"):
+                self.assertTrue(log_filter.filter(logging.LogRecord("service", logging.INFO, __file__, 1, "", (), None)))
+        self.assertEqual(results, [True, False, False])
+
+    def test_queue_mode(self):
+        """It should write log records from a listener thread, formatting them there"""
+        app = logging_app(LOG_QUEUE=True, LOG_FORMAT="json")
+        init_logging(app, "tests.log_sink")
+        self.assertIsInstance(app.logger.handlers[0], BackgroundHandler)
+        payload = {"name": "Hat"}
+        with app.test_request_context("/products", method="POST"):
+            app.logger.info("Payload = %s", payload)
+        stop_listener(app)
+        self.assertEqual(json.loads(self.handler.lines[0])["message"], "Logging handler established")
+        record = self.handler.records[1]
+        self.assertIs(record.args, payload)
+        document = json.loads(self.handler.lines[1])
+        self.assertEqual(document["message"], "Payload = {'name': 'Hat'}")
+        self.assertEqual(document["route"], "POST product_collection")
+
+    def test_module_loggers(self):
+        """It should write the records of the flask.app logger of the models like those of the app"""
+        app = logging_app(LOG_QUEUE=True, LOG_FORMAT="json")
+        init_logging(app, "tests.log_sink")
+        with app.test_request_context("/products/1"):
+            logging.getLogger("flask.app").warning("Replica %s is down", "replica-1")
+        stop_listener(app)
+        document = json.loads(self.handler.lines[-1])
+        self.assertEqual(document["message"], "Replica replica-1 is down")
+        self.assertEqual(document["route"], "GET product_resource")
+
+    def test_reinitialize(self):
+        """It should stop the old listener thread when logging is set up again"""
+        app = logging_app(LOG_QUEUE=True)
+        init_logging(app, "tests.log_sink")
+        listener = app.extensions["log_listener"]
+        app.config["LOG_QUEUE"] = False
+        init_logging(app, "tests.log_sink")
+        self.assertIsNone(listener._thread)  # pylint: disable=protected-access
+        self.assertNotIn("log_listener", app.extensions)
+        self.assertEqual(app.logger.handlers, [self.handler])
+        self.assertEqual(len([f for f in app.logger.filters if isinstance(f, RequestFilter)]), 1)
+        self.assertTrue(self.handler.lines[-1].endswith("Logging handler established"))
+
+    def test_queue_without_handlers(self):
+        """It should write to stderr when the named logger has no handlers"""
+        app = logging_app(LOG_QUEUE=True)
+        stream = io.StringIO()
+        logging.getLogger("tests.no_handlers").handlers = []
+        init_logging(app, "tests.no_handlers")
+        listener = app.extensions["log_listener"]
+        listener.handlers[0].setStream(stream)
+        app.logger.warning("written")
+        stop_listener(app)
+        self.assertIn("[WARNING]", stream.getvalue())
@@ -7,10 +7,14 @@ It provides functionality for:
 
 import os
 import logging
+from itertools import combinations
 from unittest import TestCase
 from decimal import Decimal
+from sqlalchemy import event, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql
 from wsgi import app
-from service.models import Product, DataValidationError, db
+from service.models import Product, DataConflictError, DataValidationError, db, product_cache
 from .factories import ProductFactory
 
 DATABASE_URI = os.getenv(
@@ -44,6 +48,7 @@ class TestProduct(TestCase):
         """This runs before each test"""
         db.session.query(Product).delete()  # clean up the last tests
         db.session.commit()
+        product_cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -89,10 +94,12 @@ class TestProduct(TestCase):
         product = ProductFactory()
         product.create()
         self.assertIsNotNone(product.id)
+        self.assertEqual(product.version, 1)
         product.description = "Updated description"
         product.update()
         updated_product = Product.find(product.id)
         self.assertEqual(updated_product.description, "Updated description")
+        self.assertEqual(updated_product.version, 2)
 
     def test_delete_a_product(self):
         """It should delete a Product"""
@@ -236,6 +243,14 @@ class TestProduct(TestCase):
         with self.assertRaises(DataValidationError):
             Product.find("invalid_id")
 
+    def test_parse_id(self):
+        """It should only take integers and strings of digits as ids"""
+        self.assertEqual(Product.parse_id(7), 7)
+        self.assertEqual(Product.parse_id("42"), 42)
+        self.assertEqual(Product.parse_id("-1"), -1)
+        for by_id in (True, 1.5, " 1", "-", "1e3", "١", None, [1]):
+            self.assertRaises(DataValidationError, Product.parse_id, by_id)
+
     def test_find_by_description(self):
         """It should Find a Product by Description"""
         products = ProductFactory.create_batch(5)
@@ -281,3 +296,397 @@ class TestProduct(TestCase):
         data["available"] = "true"
         product = Product()
         self.assertRaises(DataValidationError, product.deserialize, data)
+
+    def test_deserialize_bad_price(self):
+        """It should not deserialize a price that is not a finite number"""
+        data = ProductFactory().serialize()
+        for price in ("abc", "NaN", "Infinity", "1e999999", [1]):
+            data["price"] = price
+            self.assertRaises(DataValidationError, Product().deserialize, data)
+
+    def test_paginate_all_products(self):
+        """It should return all Products one page at a time"""
+        products = ProductFactory.create_batch(5)
+        for product in products:
+            product.create()
+        ids = sorted(product.id for product in products)
+        first_page = Product.all(limit=2)
+        self.assertEqual([product.id for product in first_page], ids[:2])
+        second_page = Product.all(limit=2, after=first_page[-1].id)
+        self.assertEqual([product.id for product in second_page], ids[2:4])
+        last_page = Product.all(limit=2, after=second_page[-1].id)
+        self.assertEqual([product.id for product in last_page], ids[4:])
+
+    def test_paginate_finders(self):
+        """It should paginate every finder by id"""
+        for i in range(4):
+            Product(
+                name=f"page-{i}", description="paged", price=Decimal("5.00"), available=True
+            ).create()
+        ids = sorted(product.id for product in Product.all())
+        found = Product.find_by_description("paged", limit=3, after=ids[0])
+        self.assertEqual([product.id for product in found], ids[1:4])
+        found = Product.find_by_price(Decimal("5.00"), limit=1, after=ids[1])
+        self.assertEqual([product.id for product in found], [ids[2]])
+        found = Product.find_by_availability(True, limit=2)
+        self.assertEqual([product.id for product in found], ids[:2])
+        found = Product.find_by_name("page-3", after=ids[3])
+        self.assertEqual(found.count(), 0)
+
+    ######################################################################
+    #  F I L T E R   E N G I N E   T E S T   C A S E S
+    ######################################################################
+
+    @staticmethod
+    def _compile(query) -> str:
+        """Compiles a query into PostgreSQL with its parameters inlined"""
+        compiled = query.statement.compile(
+            dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+        )
+        return " ".join(str(compiled).split())
+
+    def _create_catalog(self) -> list:
+        """Creates a small catalog with duplicate prices for sorting"""
+        catalog = [
+            ("apple", "red fruit", "1.50", True),
+            ("banana", "yellow fruit", "0.75", True),
+            ("carrot", "orange vegetable", "0.75", False),
+            ("durian", "smelly fruit", "9.00", False),
+            ("eggplant", "purple vegetable", "1.50", True),
+        ]
+        products = []
+        for name, description, price, available in catalog:
+            product = Product(name=name, description=description, price=Decimal(price), available=available)
+            product.create()
+            products.append(product)
+        return products
+
+    def test_find_by_filters_sql(self):
+        """It should compile every combination of filters into one WHERE clause"""
+        filters = {
+            "name": "apple",
+            "description": "fruit",
+            "available": True,
+            "price": Decimal("1.50"),
+            "price_min": Decimal("1.00"),
+            "price_max": Decimal("2.00"),
+        }
+        expected = {
+            "name": "product.name = 'apple'",
+            "description": "product.description ILIKE '%%fruit%%'",
+            "available": "product.available = true",
+            "price": "product.price = 1.50",
+            "price_min": "product.price >= 1.00",
+            "price_max": "product.price <= 2.00",
+        }
+        for size in range(len(filters) + 1):
+            for names in combinations(filters, size):
+                sql = self._compile(Product.find_by_filters({name: filters[name] for name in names}))
+                self.assertEqual(sql.count("SELECT"), 1, sql)
+                if not names:
+                    self.assertNotIn("WHERE", sql)
+                    continue
+                where = sql.split(" WHERE ", 1)[1]
+                self.assertEqual(where, " AND ".join(expected[name] for name in names))
+
+    def test_find_by_filters_sort_and_page_sql(self):
+        """It should compile the sort order and keyset page into the same statement"""
+        query = Product.find_by_filters(
+            {"available": True}, sort=["-price", "name"], limit=10, after=["1.50", "apple", 7]
+        )
+        sql = self._compile(query)
+        self.assertIn(
+            "WHERE product.available = true AND (product.price < 1.50 "
+            "OR product.price = 1.50 AND product.name > 'apple' "
+            "OR product.price = 1.50 AND product.name = 'apple' AND product.id > 7)",
+            sql,
+        )
+        self.assertIn("ORDER BY product.price DESC, product.name ASC, product.id LIMIT 10", sql)
+
+    def test_find_by_filters_fields_sql(self):
+        """It should only select the requested fields"""
+        sql = self._compile(Product.find_by_filters(fields=["name", "price"]))
+        self.assertTrue(sql.startswith("SELECT product.id, product.name, product.price FROM product"), sql)
+
+    def test_find_by_filters_runs_one_statement(self):
+        """It should run a single SQL statement for all of the filters"""
+        self._create_catalog()
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            found = Product.find_by_filters(
+                {"description": "fruit", "available": True, "price_max": Decimal("1.00")}
+            ).all()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual([product.name for product in found], ["banana"])
+        self.assertEqual(len(statements), 1)
+
+    def test_find_by_filters_combined(self):
+        """It should find the Products that match all of the filters"""
+        self._create_catalog()
+        found = Product.find_by_filters({"description": "vegetable", "price_min": Decimal("1.00")}).all()
+        self.assertEqual([product.name for product in found], ["eggplant"])
+        found = Product.find_by_filters({"available": False}).all()
+        self.assertEqual(sorted(product.name for product in found), ["carrot", "durian"])
+        found = Product.find_by_filters({"price": Decimal("0.75"), "name": "banana"}).all()
+        self.assertEqual([product.name for product in found], ["banana"])
+
+    def test_find_by_filters_sorted_pages(self):
+        """It should page through sorted Products without skipping ties"""
+        self._create_catalog()
+        sort = ["-price", "available"]
+        expected = [product.name for product in Product.find_by_filters(sort=sort).all()]
+        self.assertEqual(expected, ["durian", "apple", "eggplant", "carrot", "banana"])
+        seen, after = [], None
+        while True:
+            page = Product.find_by_filters(sort=sort, limit=2, after=after).all()
+            seen.extend(product.name for product in page)
+            if len(page) < 2:
+                break
+            after = page[-1].sort_key(sort)
+        self.assertEqual(seen, expected)
+
+    def test_find_by_filters_fields(self):
+        """It should serialize only the selected fields"""
+        self._create_catalog()
+        product = Product.find_by_filters({"name": "apple"}, fields=["name", "price"]).first()
+        self.assertEqual(product.serialize(["name", "price"]), {"name": "apple", "price": "1.50"})
+
+    def test_find_by_filters_bad_input(self):
+        """It should not find Products with unknown filters, fields, sorts or cursors"""
+        self.assertRaises(DataValidationError, Product.find_by_filters, {"color": "red"})
+        self.assertRaises(DataValidationError, Product.find_by_filters, sort=["color"])
+        self.assertRaises(DataValidationError, Product.find_by_filters, fields=["color"])
+        self.assertRaises(DataValidationError, Product.find_by_filters, sort=["name"], after=3)
+        self.assertRaises(DataValidationError, Product.find_by_filters, sort=["price"], after=["abc", 3])
+
+    def test_iter_chunks(self):
+        """It should read the Products of a query in chunks"""
+        self._create_catalog()
+        chunks = list(Product.iter_chunks(Product.find_by_filters(sort=["name"]), 2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(chunks[0][0].name, "apple")
+
+    def test_indexes(self):
+        """It should index the columns that Products are filtered on"""
+        indexes = {index.name: [column.name for column in index.columns] for index in Product.__table__.indexes}
+        self.assertEqual(indexes["ix_product_price_id"], ["price", "id"])
+        self.assertEqual(indexes["ix_product_available_id"], ["available", "id"])
+        self.assertEqual(indexes["ix_product_description_trgm"], ["description"])
+
+    def test_search(self):
+        """It should search Product descriptions with the best matches first"""
+        self._create_catalog()
+        found = Product.search("FRUIT")
+        self.assertEqual([product.name for product in found], ["apple", "banana", "durian"])
+        found = Product.search("fruit", limit=1)
+        self.assertEqual([product.name for product in found], ["apple"])
+        found = Product.find_by_filters({"search": "vegetable"}, sort=["-name"]).all()
+        self.assertEqual([product.name for product in found], ["eggplant", "carrot"])
+
+    def test_search_with_cursor(self):
+        """It should not page ranked search results with a cursor"""
+        self.assertRaises(
+            DataValidationError, Product.find_by_filters, {"search": "fruit"}, limit=2, after=5
+        )
+
+    ######################################################################
+    #  P R O D U C T   C A C H E   T E S T   C A S E S
+    ######################################################################
+
+    def test_find_serialized_from_cache(self):
+        """It should serve repeated lookups from the product cache"""
+        product = ProductFactory()
+        product.create()
+        data, version = Product.find_serialized(str(product.id))
+        self.assertEqual(data, product.serialize())
+        self.assertEqual(version, 1)
+        hits = product_cache.hits
+        self.assertEqual(Product.find_serialized(product.id), (data, version))
+        self.assertEqual(product_cache.hits, hits + 1)
+        self.assertIsNone(Product.find_serialized(0))
+        self.assertRaises(DataValidationError, Product.find_serialized, "abc")
+
+    def test_find_many(self):
+        """It should find many Products in the order of their ids and name the missing ones"""
+        products = [ProductFactory() for _ in range(3)]
+        for product in products:
+            product.create()
+        ids = [products[2].id, 0, str(products[0].id), products[2].id]
+        found, missing = Product.find_many(ids)
+        self.assertEqual([data["id"] for data, _ in found], [products[2].id, products[0].id, products[2].id])
+        self.assertEqual(found[1], (products[0].serialize(), 1))
+        self.assertEqual(missing, [0])
+        hits = product_cache.hits
+        found, missing = Product.find_many([products[0].id, products[1].id])
+        self.assertEqual(product_cache.hits, hits + 1)
+        self.assertEqual(Product.find_many([]), ([], []))
+        self.assertRaises(DataValidationError, Product.find_many, ["abc"])
+
+    def test_find_many_statement(self):
+        """It should look up ids with one array parameter on PostgreSQL"""
+        statement = Product.find_many_statement([1, 2], "postgresql").compile(dialect=postgresql.dialect())
+        self.assertIn("product.id = ANY (%(param_1)s", str(statement))
+        self.assertEqual(statement.params["param_1"], [1, 2])
+        self.assertIn(" IN ", str(Product.find_many_statement([1, 2], "sqlite")))
+
+    def test_cache_invalidated_by_writes(self):
+        """It should invalidate cached Products when they are written"""
+        product = ProductFactory()
+        product.create()
+        Product.find_serialized(product.id)
+        product.description = "Updated description"
+        product.update()
+        data, version = Product.find_serialized(product.id)
+        self.assertEqual(data["description"], "Updated description")
+        self.assertEqual(version, 2)
+        product.delete()
+        self.assertIsNone(Product.find_serialized(product.id))
+
+    def test_fingerprint(self):
+        """It should fingerprint the Products of a query"""
+        self.assertEqual(Product.fingerprint(Product.find_by_filters()), (0, ""))
+        products = self._create_catalog()
+        query = Product.find_by_filters({"available": True}, fields=["name"], limit=2)
+        fingerprint = Product.fingerprint(query)
+        self.assertEqual(fingerprint, (2, f"{products[0].id}:1,{products[1].id}:1"))
+        products[1].available = False
+        products[1].update()
+        self.assertEqual(Product.fingerprint(query), (2, f"{products[0].id}:1,{products[4].id}:1"))
+
+    def test_fingerprint_statement(self):
+        """It should hash the ids and versions in id order on PostgreSQL"""
+        statement = Product.fingerprint_statement(select(Product), "postgresql").compile(dialect=postgresql.dialect())
+        self.assertIn("md5(string_agg(", str(statement))
+        self.assertIn(", ',' ORDER BY", str(statement))
+
+    def test_stale_update_and_delete(self):
+        """It should not Update or Delete a Product changed since it was read"""
+        product = ProductFactory()
+        product.create()
+        bump = text("UPDATE product SET version = version + 1 WHERE id = :id")
+        # another request commits a change after this one has read the Product
+        self.assertEqual(product.version, 1)
+        with db.engine.begin() as connection:
+            connection.execute(bump, {"id": product.id})
+        product.description = "Stale description"
+        self.assertRaises(DataConflictError, product.update)
+        product = Product.find(product.id)
+        self.assertEqual(product.version, 2)
+        self.assertNotEqual(product.description, "Stale description")
+        with db.engine.begin() as connection:
+            connection.execute(bump, {"id": product.id})
+        self.assertRaises(DataConflictError, product.delete)
+        self.assertIsNotNone(Product.find(product.id))
+
+    def test_purchase(self):
+        """It should Purchase an available Product with a single statement"""
+        product = ProductFactory(available=True)
+        product.create()
+        Product.find_serialized(product.id)
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            purchased = Product.purchase(str(product.id))
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith("UPDATE product"))
+        self.assertEqual(purchased.available, False)
+        self.assertEqual(purchased.version, 2)
+        data, version = Product.find_serialized(product.id)
+        self.assertEqual((data["available"], version), (False, 2))
+
+    def test_purchase_not_available(self):
+        """It should not Purchase a Product that is missing, unavailable or at another version"""
+        product = ProductFactory(available=True)
+        product.create()
+        self.assertIsNone(Product.purchase(product.id, versions=[2]))
+        self.assertIsNone(Product.purchase(0))
+        self.assertIsNotNone(Product.purchase(product.id, versions=[1]))
+        self.assertIsNone(Product.purchase(product.id))
+        self.assertRaises(DataValidationError, Product.purchase, "one")
+
+    def test_create_many(self):
+        """It should Create Products in chunks and report every item"""
+        existing = ProductFactory()
+        existing.create()
+        items = [ProductFactory.build().serialize() for _ in range(5)]
+        items[1]["name"] = existing.name
+        items[3] = {"name": "missing description"}
+        items.append(dict(items[0]))
+        items.append(DataValidationError("Invalid JSON"))
+        items.append(dict(ProductFactory.build().serialize(), price="abc"))
+        results, chunks = Product.create_many(items, chunk_size=2)
+        self.assertEqual([chunk["size"] for chunk in chunks], [2, 2])
+        self.assertEqual([result["index"] for result in results], list(range(8)))
+        self.assertEqual([result.get("status") for result in results], [None, 409, None, 400, None, 409, 400, 400])
+        self.assertEqual(results[6]["message"], "Invalid JSON")
+        for index in (0, 2, 4):
+            product = Product.find(results[index]["id"])
+            self.assertEqual(product.name, items[index]["name"])
+            self.assertEqual(product.version, 1)
+        self.assertEqual(len(Product.all()), 4)
+
+    def test_write_chunk_one_at_a_time(self):
+        """It should retry a chunk that failed one entry at a time and only fail the bad entries"""
+
+        def write(chunk):
+            if any(value == "bad" for _, value in chunk):
+                raise IntegrityError("INSERT", {}, Exception("value too long"))
+            return [{"index": index, "id": value} for index, value in chunk]
+
+        entries = [(0, "a"), (1, "bad"), (2, "c"), {"index": 3, "status": 400, "message": "Invalid JSON"}]
+        results, chunks = Product._write_chunks(entries, 3, write)  # pylint: disable=protected-access
+        self.assertEqual([result.get("status") for result in results], [None, 400, None, 400])
+        self.assertEqual(results[1]["message"], "value too long")
+        self.assertEqual([chunk["size"] for chunk in chunks], [1, 1, 1])
+
+    def test_update_many(self):
+        """It should Update Products by id and upsert them by name in chunks"""
+        products = self._create_catalog()
+        items = [
+            {"id": products[0].id, "price": "9.99"},
+            {"name": products[1].name, "available": False},
+            {"name": products[2].name, "description": "root", "price": 3, "available": True},
+            {"name": "fig", "description": "fruit", "price": "2.50", "available": True},
+            {"id": products[0].id, "price": "1.00"},
+            {"id": 0, "available": True},
+            {"name": "grape"},
+            {"id": products[3].id, "price": "-1"},
+            "durian",
+            {"id": products[3].id, "price": "NaN"},
+        ]
+        results, chunks = Product.update_many(items, chunk_size=3)
+        self.assertEqual([chunk["size"] for chunk in chunks], [3, 2])
+        self.assertEqual([result.get("status") for result in results], [None, None, None, None, 409, 404, 400, 400, 400, 400])
+        self.assertEqual(Product.find(products[0].id).price, Decimal("9.99"))
+        self.assertEqual(Product.find(products[0].id).version, 2)
+        self.assertEqual(Product.find(products[1].id).available, False)
+        carrot = Product.find(products[2].id)
+        self.assertEqual((carrot.description, carrot.price, carrot.version), ("root", Decimal("3.00"), 2))
+        fig = Product.find(results[3]["id"])
+        self.assertEqual((fig.name, fig.version), ("fig", 1))
+
+    def test_delete_many(self):
+        """It should Delete Products by id in chunks"""
+        products = self._create_catalog()
+        Product.find_serialized(products[0].id)
+        ids = [products[0].id, products[1].id, 0, "one", products[2].id, str(products[0].id), True, 1.5]
+        kept = products[3].id
+        results, chunks = Product.delete_many(ids, chunk_size=2)
+        self.assertEqual([chunk["size"] for chunk in chunks], [2, 2])
+        self.assertEqual([result.get("deleted") for result in results], [True, True, False, None, True, None, None, None])
+        self.assertEqual([result.get("status") for result in results[3:]], [400, None, 409, 400, 400])
+        self.assertIsNone(Product.find_serialized(ids[0]))
+        self.assertEqual(len(Product.all()), 2)
+        self.assertIsNotNone(Product.find(kept))
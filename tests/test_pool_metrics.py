@@ -0,0 +1,75 @@
+"""
+Test cases for the connection pool metrics
+"""
+
+import os
+import tempfile
+from unittest import TestCase
+from flask import Flask
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from service.common.pool_metrics import PoolMetrics, TimedQueuePool, pool_metrics
+
+
+######################################################################
+#  P O O L   M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestPoolMetrics(TestCase):
+    """Test Cases for PoolMetrics"""
+
+    def setUp(self):
+        self.metrics = PoolMetrics(buckets=(0.01, 0.1))
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.folder.name, 'pool.db')}",
+            poolclass=TimedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=0.05,
+        )
+        pool_metrics.reset()
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.folder.cleanup()
+
+    def test_observe_wait(self):
+        """It should count wait times in cumulative buckets"""
+        for seconds in (0.001, 0.05, 0.5):
+            self.metrics.observe_wait(seconds)
+        self.metrics.observe_wait(0.2, timed_out=True)
+        stats = self.metrics.stats(self.engine.pool)
+        self.assertEqual(stats["wait"]["buckets"], {"0.01": 1, "0.1": 2, "+Inf": 4})
+        self.assertEqual(stats["wait"]["count"], 4)
+        self.assertAlmostEqual(stats["wait"]["sum"], 0.751)
+        self.assertEqual(stats["events"]["timeout"], 1)
+        self.metrics.reset()
+        self.assertEqual(self.metrics.stats(self.engine.pool)["wait"]["count"], 0)
+
+    def test_watch_engine(self):
+        """It should count pool events and time checkouts of a TimedQueuePool"""
+        self.metrics.watch(self.engine)
+        with self.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            stats = self.metrics.stats(self.engine.pool)
+            self.assertEqual((stats["size"], stats["checkedout"]), (1, 1))
+            self.assertRaises(PoolTimeoutError, self.engine.connect)
+        stats = self.metrics.stats(self.engine.pool)
+        self.assertEqual(stats["checkedout"], 0)
+        self.assertEqual(
+            stats["events"], {"connect": 1, "checkout": 1, "checkin": 1, "invalidate": 0, "timeout": 0}
+        )
+        waits = pool_metrics.stats(self.engine.pool)
+        self.assertEqual((waits["wait"]["count"], waits["events"]["timeout"]), (2, 1))
+
+    def test_init_app(self):
+        """It should only time pools that are sized"""
+        app = Flask(__name__)
+        options = {"pool_size": 2}
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+        self.metrics.init_app(app)
+        self.assertIs(app.config["SQLALCHEMY_ENGINE_OPTIONS"]["poolclass"], TimedQueuePool)
+        self.assertEqual(options, {"pool_size": 2})
+        app = Flask(__name__)
+        self.metrics.init_app(app)
+        self.assertEqual(app.config["SQLALCHEMY_ENGINE_OPTIONS"], {})
@@ -0,0 +1,100 @@
+"""
+Test cases for the sampling profiler
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from flask import Flask
+from service.common.profiler import PROFILE_HEADER, Profiler, StackSampler, collapse
+
+
+def busy(seconds: float):
+    """Keeps the CPU busy for a while"""
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def profiled_app(directory: str, sample_rate: int = 0, token: str = "") -> tuple:
+    """Returns a small app profiled into directory, and its profiler"""
+    app = Flask(__name__)
+    app.config.update(
+        PROFILE_SAMPLE_RATE=sample_rate,
+        PROFILE_TOKEN=token,
+        PROFILE_INTERVAL=0.001,
+        PROFILE_DIRECTORY=directory,
+    )
+    app.add_url_rule("/work", "work", lambda: busy(0.05) or "done")
+    profiler = Profiler()
+    profiler.init_app(app)
+    return app, profiler
+
+
+######################################################################
+#  P R O F I L E R   T E S T   C A S E S
+######################################################################
+class TestProfiler(TestCase):
+    """Test Cases for the sampling profiler"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "work.GET.collapsed")
+
+    def read_stacks(self) -> list:
+        """Returns the lines of the collapsed stack file of the work route"""
+        with open(self.path, encoding="utf-8") as file:
+            return file.read().splitlines()
+
+    def test_collapse(self):
+        """It should write a stack outermost frame first"""
+        stack = collapse(sys._getframe())  # pylint: disable=protected-access
+        self.assertTrue(stack.endswith("test_profiler.py:test_collapse"))
+        self.assertNotIn(" ", stack)
+
+    def test_sample_a_thread(self):
+        """It should count the stacks of a busy thread"""
+        worker = threading.Thread(target=busy, args=(0.1,))
+        worker.start()
+        sampler = StackSampler(worker.ident, 0.001)
+        sampler.start()
+        worker.join()
+        stacks = sampler.stop()
+        self.assertTrue(any(stack.endswith("test_profiler.py:busy") for stack in stacks))
+
+    def test_profile_one_in_n_requests(self):
+        """It should write the stacks of 1 in PROFILE_SAMPLE_RATE requests per route"""
+        app, _ = profiled_app(self.directory, sample_rate=2)
+        client = app.test_client()
+        client.get("/work")
+        lines = self.read_stacks()
+        self.assertTrue(lines)
+        self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit() for line in lines))
+        self.assertTrue(any("test_profiler.py:busy " in line for line in lines))
+        client.get("/work")
+        self.assertEqual(self.read_stacks(), lines)
+        client.get("/work")
+        self.assertGreater(len(self.read_stacks()), len(lines))
+
+    def test_profile_requests_with_the_token(self):
+        """It should only profile requests carrying PROFILE_TOKEN when there is no sample rate"""
+        app, _ = profiled_app(self.directory, token="s3cr3t")
+        client = app.test_client()
+        client.get("/work", headers={PROFILE_HEADER: "guess"})
+        client.get("/work")
+        self.assertFalse(os.path.exists(self.path))
+        client.get("/work", headers={PROFILE_HEADER: "s3cr3t"})
+        self.assertTrue(self.read_stacks())
+
+    def test_disabled(self):
+        """It should not hook into the app when profiling is off"""
+        app, _ = profiled_app(os.path.join(self.directory, "off"))
+        self.assertFalse(app.before_request_funcs)
+        self.assertFalse(app.teardown_request_funcs)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "off")))
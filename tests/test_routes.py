@@ -3,13 +3,17 @@ TestProduct API Service Test Suite
 """
 
 import os
+import re
+import json
 import logging
 from unittest import TestCase
+from unittest.mock import patch
 from decimal import Decimal
 from urllib.parse import quote_plus
+from sqlalchemy import event
 from wsgi import app
 from service.common import status
-from service.models import db, Product
+from service.models import db, Product, product_cache
 from .factories import ProductFactory
 
 
@@ -47,6 +51,7 @@ class TestYourResourceService(TestCase):
         self.client = app.test_client()
         db.session.query(Product).delete()  # clean up the last tests
         db.session.commit()
+        product_cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -71,6 +76,12 @@ class TestYourResourceService(TestCase):
             products.append(test_product)
         return products
 
+    @staticmethod
+    def _next_link(response) -> str:
+        """Returns the url of the rel="next" Link header, if any"""
+        match = re.match(r'<([^>]+)>; rel="next"', response.headers.get("Link", ""))
+        return match.group(1) if match else None
+
     ######################################################################
     #  P L A C E   T E S T   C A S E S   H E R E
     ######################################################################
@@ -93,6 +104,9 @@ class TestYourResourceService(TestCase):
         data = response.get_json()
         self.assertEqual(data["status"], 200)
         self.assertEqual(data["message"], "Healthy")
+        self.assertIn("hits", data["cache"])
+        self.assertIn("checkedout", data["pool"])
+        self.assertIn("+Inf", data["pool"]["wait"]["buckets"])
 
     # ----------------------------------------------------------
     # TEST LIST
@@ -105,6 +119,101 @@ class TestYourResourceService(TestCase):
         data = response.get_json()
         self.assertEqual(len(data), 5)
 
+    def test_get_product_list_paginated(self):
+        """It should Get a list of Products one page at a time"""
+        products = self._create_products(5)
+        ids = sorted(product.id for product in products)
+        response = self.client.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([product["id"] for product in response.get_json()], ids[:2])
+        seen = []
+        url = f"{BASE_URL}?limit=2"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(product["id"] for product in response.get_json())
+            url = self._next_link(response)
+        self.assertEqual(seen, ids)
+
+    def test_get_product_list_paginated_with_filter(self):
+        """It should keep the filter in the next page link"""
+        for i in range(3):
+            product = ProductFactory(name=f"paged-{i}", available=True)
+            response = self.client.post(BASE_URL, json=product.serialize())
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(BASE_URL, query_string="available=true&limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 2)
+        next_url = self._next_link(response)
+        self.assertIn("available=true", next_url)
+        response = self.client.get(next_url)
+        data = response.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["name"], "paged-2")
+        self.assertNotIn("Link", response.headers)
+
+    def test_get_product_list_bad_cursor(self):
+        """It should not Get a page of Products with an invalid cursor"""
+        response = self.client.get(BASE_URL, query_string="limit=2&cursor=not-a-cursor")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_product_list_as_ndjson(self):
+        """It should Stream a list of Products as NDJSON"""
+        products = self._create_products(5)
+        self.enterContext(patch.dict(app.config, STREAM_CHUNK_SIZE=2))
+        response = self.client.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 5)
+        data = [json.loads(line) for line in lines]
+        self.assertEqual(data, self.client.get(BASE_URL).get_json())
+        self.assertEqual([product["id"] for product in data], sorted(p.id for p in products))
+
+    def test_stream_product_list_as_json_array(self):
+        """It should Stream a list of Products as a JSON array"""
+        self._create_products(5)
+        self.enterContext(patch.dict(app.config, STREAM_CHUNK_SIZE=2))
+        response = self.client.get(BASE_URL, query_string="stream=true&limit=3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/json")
+        data = response.get_json()
+        self.assertEqual(data, self.client.get(BASE_URL, query_string="limit=3").get_json())
+
+    def test_list_products_fast_json(self):
+        """It should List Products from row tuples exactly like it marshals them"""
+        self._create_products(5)
+        queries = [
+            ("", {}),
+            ("sort=-price,name&limit=2", {}),
+            ("fields=name,price&sort=price", {}),
+            ("sort=name", {"X-Fields": "{id,available}"}),
+            ("stream=true&fields=id,name&sort=-name", {}),
+            ("", {"Accept": "application/x-ndjson"}),
+        ]
+        for query_string, headers in queries:
+            fast = self._read_listing(query_string, headers)
+            app.config["FAST_JSON"] = False
+            marshalled = self._read_listing(query_string, headers)
+            app.config["FAST_JSON"] = True
+            self.assertEqual(fast, marshalled, query_string)
+
+    def _read_listing(self, query_string, headers):
+        """Lists Products and returns the status, media type, Link header and documents"""
+        response = self.client.get(BASE_URL, query_string=query_string, headers=headers)
+        documents = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        return response.status_code, response.mimetype, response.headers.get("Link"), documents
+
+    def test_stream_empty_product_list(self):
+        """It should Stream an empty list of Products"""
+        response = self.client.get(BASE_URL, query_string="stream=true")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), [])
+        response = self.client.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(response.get_data(as_text=True), "")
+
     # ----------------------------------------------------------
     # TEST READ
     # ----------------------------------------------------------
@@ -117,6 +226,95 @@ class TestYourResourceService(TestCase):
         data = response.get_json()
         self.assertEqual(data["name"], test_product.name)
 
+    def test_get_product_not_modified(self):
+        """It should not Get a Product again while its ETag is current"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = response.headers["ETag"]
+        self.assertEqual(etag, f'"{test_product.id}-1"')
+        response = self.client.get(f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(response.headers["ETag"], etag)
+        data = response.get_json(silent=True)
+        self.assertIsNone(data)
+        test_product.description = "changed"
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=test_product.serialize())
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["ETag"], f'"{test_product.id}-2"')
+
+    def test_masked_product_etags(self):
+        """It should give the copies masked with X-Fields ETags of their own"""
+        product = self._create_products(1)[0]
+        masked = {"X-Fields": "{id}"}
+        for url in (f"{BASE_URL}/{product.id}", BASE_URL):
+            full = self.client.get(url)
+            self.assertIn("X-Fields", full.headers["Vary"])
+            response = self.client.get(url, headers=masked)
+            self.assertIn("X-Fields", response.headers["Vary"])
+            self.assertNotEqual(response.headers["ETag"], full.headers["ETag"])
+            response = self.client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(url, headers={"If-None-Match": full.headers["ETag"], **masked})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = self.client.get(f"{BASE_URL}/{product.id}", headers=masked).headers["ETag"]
+        changed = dict(product.serialize(), description="changed")
+        response = self.client.put(f"{BASE_URL}/{product.id}", json=changed, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_get_product_list_not_modified(self):
+        """It should not Get a list of Products again while its ETag is current"""
+        products = self._create_products(3)
+        response = self.client.get(BASE_URL, query_string="limit=2")
+        etag = response.headers["ETag"]
+        response = self.client.get(BASE_URL, query_string="limit=2", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(BASE_URL, query_string="limit=1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(BASE_URL, headers={"Accept": "application/x-ndjson", "If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        changed = dict(products[0].serialize(), description="changed")
+        self.client.put(f"{BASE_URL}/{products[0].id}", json=changed)
+        self.client.put(f"{BASE_URL}/{products[1].id}", json={**products[1].serialize(), "description": "changed"})
+        response = self.client.get(BASE_URL, query_string="limit=2", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_get_product_list_swapped_member(self):
+        """It should Get a list of Products again when one Product joins it and another leaves it"""
+        products = []
+        for available in (False, True, True):
+            product = ProductFactory(available=available)
+            product.create()
+            products.append(product)
+        products[1].description = "changed"
+        products[1].update()
+        etag = self.client.get(BASE_URL, query_string="available=true").headers["ETag"]
+        products[0].available = True
+        products[0].update()
+        products[1].available = False
+        products[1].update()
+        response = self.client.get(BASE_URL, query_string="available=true", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([product["id"] for product in response.get_json()], [products[0].id, products[2].id])
+
+    def test_get_product_after_purchase(self):
+        """It should not Get a stale Product from the cache after a purchase"""
+        test_product = ProductFactory(available=True)
+        response = self.client.post(BASE_URL, json=test_product.serialize())
+        product_id = response.get_json()["id"]
+        response = self.client.get(f"{BASE_URL}/{product_id}")
+        self.assertEqual(response.get_json()["available"], True)
+        response = self.client.get(f"{BASE_URL}/{product_id}")
+        self.assertEqual(response.get_json()["available"], True)
+        self.assertEqual(product_cache.hits, 1)
+        response = self.client.put(f"{BASE_URL}/{product_id}/purchase")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/{product_id}")
+        self.assertEqual(response.get_json()["available"], False)
+
     def test_get_product_not_found(self):
         """It should not Get a Product thats not found"""
         response = self.client.get(f"{BASE_URL}/0")
@@ -159,6 +357,91 @@ class TestYourResourceService(TestCase):
     # ----------------------------------------------------------
     # TEST UPDATE
     # ----------------------------------------------------------
+    def test_create_products_batch(self):
+        """It should Create a batch of Products from a JSON array"""
+        items = [ProductFactory().serialize() for _ in range(3)]
+        response = self.client.post(f"{BASE_URL}:batch", json=items)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual((data["created"], data["failed"]), (3, 0))
+        for item, result in zip(items, data["results"]):
+            response = self.client.get(f"{BASE_URL}/{result['id']}")
+            self.assertEqual(response.get_json()["name"], item["name"])
+
+    def test_create_products_batch_ndjson(self):
+        """It should Create a batch of Products from NDJSON and report failures"""
+        product = self._create_products(1)[0]
+        lines = [json.dumps(ProductFactory().serialize()), "", "{not json", json.dumps(product.serialize())]
+        response = self.client.post(
+            f"{BASE_URL}:batch", data="\n".join(lines), content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        data = response.get_json()
+        self.assertEqual((data["created"], data["failed"]), (1, 2))
+        self.assertEqual([result.get("status") for result in data["results"]], [None, 400, 409])
+
+    def test_create_products_batch_bad_price(self):
+        """It should report a bad price as a failed item of a batch"""
+        items = [ProductFactory().serialize(), dict(ProductFactory().serialize(), price="abc")]
+        response = self.client.post(f"{BASE_URL}:batch", json=items)
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        data = response.get_json()
+        self.assertEqual((data["created"], data["failed"]), (1, 1))
+        self.assertEqual(data["results"][1]["status"], status.HTTP_400_BAD_REQUEST)
+        self.assertIn("Invalid price", data["results"][1]["message"])
+
+    def test_create_products_batch_not_a_list(self):
+        """It should not Create a batch of Products from something else than a list"""
+        response = self.client.post(f"{BASE_URL}:batch", json=ProductFactory().serialize())
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("Expected a JSON array", response.get_json()["message"])
+
+    def test_update_products_batch(self):
+        """It should Update and upsert a batch of Products"""
+        product = self._create_products(1)[0]
+        self.client.get(f"{BASE_URL}/{product.id}")
+        new_product = ProductFactory().serialize()
+        del new_product["id"]
+        items = [
+            {"id": product.id, "description": "changed"},
+            new_product,
+            {"id": 0, "available": True},
+            {"id": product.id, "price": "NaN"},
+        ]
+        response = self.client.patch(f"{BASE_URL}:batch", json=items)
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        data = response.get_json()
+        self.assertEqual((data["updated"], data["failed"]), (2, 2))
+        self.assertEqual(data["chunks"][0]["size"], 3)
+        self.assertEqual(data["results"][3]["status"], 400)
+        response = self.client.get(f"{BASE_URL}/{product.id}")
+        self.assertEqual(response.get_json()["description"], "changed")
+        response = self.client.get(f"{BASE_URL}/{data['results'][1]['id']}")
+        self.assertEqual(response.get_json()["name"], new_product["name"])
+
+    def test_delete_products_batch(self):
+        """It should Delete a batch of Products"""
+        products = self._create_products(3)
+        ids = [product.id for product in products[:2]]
+        response = self.client.delete(f"{BASE_URL}:batch", json=ids + [0])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual((data["deleted"], data["failed"]), (2, 0))
+        for product_id in ids:
+            response = self.client.get(f"{BASE_URL}/{product_id}")
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(f"{BASE_URL}/{products[2].id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_delete_products_batch_bad_ids(self):
+        """It should Delete each id of a batch once and reject ids that are not integers"""
+        product = self._create_products(1)[0]
+        response = self.client.delete(f"{BASE_URL}:batch", json=[product.id, "x", True, 1.5, product.id])
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        data = response.get_json()
+        self.assertEqual((data["deleted"], data["failed"]), (1, 4))
+        self.assertEqual([result.get("status") for result in data["results"]], [None, 400, 400, 400, 409])
+
     def test_update_product(self):
         """It should Update an existing Product"""
         # create a product to update
@@ -191,6 +474,22 @@ class TestYourResourceService(TestCase):
         data = response.get_json()
         self.assertIn("Price must be a positive number", data["message"])
 
+    def test_update_product_if_match(self):
+        """It should only Update a Product while the ETag in If-Match is current"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = response.headers["ETag"]
+        new_product = response.get_json()
+        new_product["description"] = "first"
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=new_product, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["ETag"], f'"{test_product.id}-2"')
+        new_product["description"] = "second"
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=new_product, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.get_json()["description"], "first")
+
     def test_update_product_not_found(self):
         """It should not Update a product that doesn't exist"""
         resp = self.client.put(
@@ -315,6 +614,167 @@ class TestYourResourceService(TestCase):
         # for product in data:
         #     self.assertEqual(product["available"], False)
 
+    def _create_catalog(self):
+        """Creates products with known names, prices and availability"""
+        catalog = [
+            ("apple", "red fruit", "1.50", True),
+            ("banana", "yellow fruit", "0.75", True),
+            ("carrot", "orange vegetable", "0.75", False),
+            ("durian", "smelly fruit", "9.00", False),
+        ]
+        for name, description, price, available in catalog:
+            response = self.client.post(
+                BASE_URL,
+                json={"name": name, "description": description, "price": price, "available": available},
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_query_by_combined_filters(self):
+        """It should Query Products that match all of the filters"""
+        self._create_catalog()
+        response = self.client.get(BASE_URL, query_string="description=fruit&available=true&price_max=1.00")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([product["name"] for product in response.get_json()], ["banana"])
+        response = self.client.get(BASE_URL, query_string="price_min=0.75&price_max=1.50&available=false")
+        self.assertEqual([product["name"] for product in response.get_json()], ["carrot"])
+
+    def test_query_sorted_with_fields(self):
+        """It should Query sorted Products with only the selected fields"""
+        self._create_catalog()
+        response = self.client.get(BASE_URL, query_string="sort=-price,name&fields=name,price")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([product["name"] for product in data], ["durian", "apple", "banana", "carrot"])
+        self.assertEqual(data[0], {"name": "durian", "price": 9.0})
+
+    def test_query_sorted_pages(self):
+        """It should page through sorted Products"""
+        self._create_catalog()
+        names = []
+        url = f"{BASE_URL}?sort=price,-name&limit=1&fields=name"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            names.extend(product["name"] for product in response.get_json())
+            url = self._next_link(response)
+        self.assertEqual(names, ["carrot", "banana", "apple", "durian"])
+
+    def test_query_streamed_with_fields(self):
+        """It should Stream sorted Products with only the selected fields"""
+        self._create_catalog()
+        response = self.client.get(
+            BASE_URL, query_string="sort=name&fields=name", headers={"Accept": "application/x-ndjson"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(lines, [{"name": name} for name in ["apple", "banana", "carrot", "durian"]])
+
+    def test_query_by_search(self):
+        """It should Search Products by description"""
+        self._create_catalog()
+        response = self.client.get(BASE_URL, query_string="search=fruit&limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([product["name"] for product in response.get_json()], ["apple", "banana"])
+        self.assertNotIn("Link", response.headers)
+        response = self.client.get(BASE_URL, query_string="search=fruit&sort=name&limit=2")
+        self.assertIn("Link", response.headers)
+
+    def test_query_selects_only_the_fields(self):
+        """It should leave the columns of unselected fields out of the SELECT"""
+        self._create_catalog()
+        requests = [
+            ("fields=id,name", {}),
+            ("sort=price", {"X-Fields": "{id,name}"}),
+            ("fields=name&sort=name", {"Accept": "application/x-ndjson"}),
+        ]
+        for fast_json in (True, False):
+            app.config["FAST_JSON"] = fast_json
+            for query_string, headers in requests:
+                status_code, data, statements = self._get_with_statements(query_string, headers)
+                self.assertEqual(status_code, status.HTTP_200_OK)
+                self.assertNotIn("description", data)
+                listing = [statement for statement in statements if "product.name" in statement]
+                self.assertTrue(listing, query_string)
+                for statement in listing:
+                    self.assertNotIn("product.description", statement, query_string)
+        app.config["FAST_JSON"] = True
+
+    def _get_with_statements(self, query_string: str, headers: dict) -> tuple:
+        """Lists Products and returns the status, the body and the SQL it ran"""
+        statements = []
+
+        def record(_connection, _cursor, statement, *_args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            response = self.client.get(BASE_URL, query_string=query_string, headers=headers)
+            data = response.get_data(as_text=True)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        return response.status_code, data, statements
+
+    def test_query_by_ids(self):
+        """It should List the Products with the given ids in their order"""
+        products = self._create_products(3)
+        ids = f"{products[2].id},0,{products[0].id}"
+        response = self.client.get(BASE_URL, query_string=f"ids={ids}&fields=id,name")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.get_json(),
+            [{"id": product.id, "name": product.name} for product in (products[2], products[0])],
+        )
+        self.assertEqual(response.headers["X-Missing-Ids"], "0")
+        etag = response.headers["ETag"]
+        response = self.client.get(BASE_URL, query_string=f"ids={ids}&fields=id,name", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        changed = dict(products[0].serialize(), description="changed")
+        self.client.put(f"{BASE_URL}/{products[0].id}", json=changed)
+        response = self.client.get(BASE_URL, query_string=f"ids={ids}&fields=id,name", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(BASE_URL, query_string=f"ids={products[1].id}")
+        self.assertEqual(response.get_json()[0]["name"], products[1].name)
+        self.assertNotIn("X-Missing-Ids", response.headers)
+
+    def test_query_by_ids_bad_args(self):
+        """It should not List Products by ids with bad or conflicting arguments"""
+        for query_string in ("ids=1,a", "ids=1&sort=name", "ids=1&available=true", "ids=1&fields=color"):
+            response = self.client.get(BASE_URL, query_string=query_string)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+        app.config["PAGE_SIZE_MAX"], page_size_max = 2, app.config["PAGE_SIZE_MAX"]
+        response = self.client.get(BASE_URL, query_string="ids=1,2,3")
+        app.config["PAGE_SIZE_MAX"] = page_size_max
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_products(self):
+        """It should Look up Products by id and tell which ones are missing"""
+        products = self._create_products(2)
+        body = {"ids": [products[1].id, 0, products[0].id], "fields": ["id", "price"]}
+        response = self.client.post(f"{BASE_URL}:lookup", json=body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([product["id"] for product in data["products"]], [products[1].id, products[0].id])
+        self.assertEqual(data["products"][0], {"id": products[1].id, "price": float(products[1].price)})
+        self.assertEqual(data["missing"], [0])
+        response = self.client.post(f"{BASE_URL}:lookup", json={"ids": [products[0].id]})
+        self.assertEqual(response.get_json()["products"][0]["name"], products[0].name)
+
+    def test_lookup_products_bad_data(self):
+        """It should not Look up Products without a list of ids"""
+        bodies = [[1, 2], {"ids": "1,2"}, {"ids": ["a"]}, {"ids": [1], "fields": "name"}, {"ids": [1], "fields": ["color"]}]
+        for body in bodies:
+            response = self.client.post(f"{BASE_URL}:lookup", json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+
+    def test_query_bad_sort_or_fields(self):
+        """It should not Query Products with unknown sort or fields"""
+        response = self.client.get(BASE_URL, query_string="sort=color")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="fields=name,color")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="price_min=cheap")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     # ----------------------------------------------------------
     # TEST ACTIONS
     # ----------------------------------------------------------
@@ -343,6 +803,27 @@ class TestYourResourceService(TestCase):
         response = self.client.put(f"{BASE_URL}/{product.id}/purchase")
         self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
 
+    def test_purchase_if_match(self):
+        """It should not Purchase a Product that changed since its ETag was read"""
+        response = self.client.post(BASE_URL, json=ProductFactory(available=True).serialize())
+        product_id = response.get_json()["id"]
+        response = self.client.put(f"{BASE_URL}/{product_id}/purchase", headers={"If-Match": f'"{product_id}-0"'})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.put(f"{BASE_URL}/{product_id}/purchase", headers={"If-Match": f'"{product_id}-1"'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["ETag"], f'"{product_id}-2"')
+
+    def test_purchase_twice(self):
+        """It should only Purchase a Product once"""
+        response = self.client.post(BASE_URL, json=ProductFactory(available=True).serialize())
+        product_id = response.get_json()["id"]
+        response = self.client.put(f"{BASE_URL}/{product_id}/purchase")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["available"], False)
+        response = self.client.put(f"{BASE_URL}/{product_id}/purchase")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn("is not available", response.get_json()["message"])
+
     def test_purchase_not_found(self):
         """It should not Purchase a Product that is not found"""
         response = self.client.put(f"{BASE_URL}/0/purchase")